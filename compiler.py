@@ -9,17 +9,27 @@ Author: RDDS Team
 
 Functions:
     parse_arguments: Parses incoming command line arguments.
+    run_checker: Checks a source file without generating any code.
     run_compiler: Executes the complete compilation process.
+    run_gcc: Builds a binary from generated code with gcc.
+    find_sources: Expands source arguments to a list of source files.
+    run_batch: Checks or compiles many source files with a process pool.
 """
 
 # Import standard libraries
 import argparse
+import contextlib
+import glob
+import io
+import os
 import subprocess
 import sys
-import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 # Import custom compiler libraries
 from lib.rd_parser import Parser
+from lib.codecache import CodeCache
 
 
 def parse_arguments():
@@ -36,17 +46,131 @@ def parse_arguments():
                         help='print comments in generated code',
                         action='store_true')
     parser.add_argument('source',
-                        help='source file to compile')
+                        help='source file to compile. Several files, '
+                             'directories or glob patterns compile every '
+                             'source file found in batch mode',
+                        nargs='+')
+    parser.add_argument('--check',
+                        help='only check the source for errors, do not '
+                             'generate or compile any code',
+                        action='store_true')
     parser.add_argument('-o', '--out',
                         help='target path for the compiled code',
                         action='store',
                         default='a.out')
+    parser.add_argument('--out-dir',
+                        help='directory for the binaries of batch mode, '
+                             'each named after its source file '
+                             '(default: the current directory)',
+                        default=None)
+    parser.add_argument('-j', '--jobs',
+                        help='number of processes compiling at once in '
+                             'batch mode (default: the number of CPUs)',
+                        type=int,
+                        default=None)
+    parser.add_argument('-p', '--profile',
+                        help='instrument the compiled code to write a '
+                             'runtime profile to PROFILE on exit',
+                        nargs='?',
+                        const='rdds_profile.txt',
+                        default=None)
+    parser.add_argument('-g', '--line-directives',
+                        help='emit #line directives so that debuggers and '
+                             'profilers point at the source file',
+                        action='store_true')
+    parser.add_argument('--source-map',
+                        help='write a JSON map of generated code lines to '
+                             'source lines next to the generated code',
+                        action='store_true')
+    parser.add_argument('--diagnostics',
+                        help='format of the warning and error report',
+                        choices=['text', 'json'],
+                        default='text')
+    parser.add_argument('--max-errors',
+                        help='stop compiling after this many errors',
+                        type=int,
+                        default=None)
+    parser.add_argument('--fail-fast',
+                        help='stop compiling at the first error',
+                        action='store_const',
+                        dest='max_errors',
+                        const=1)
+    parser.add_argument('-O', '--optimize',
+                        help='optimize the generated code: leave out code '
+                             'which is never used, inline small functions '
+                             'and speed up loops',
+                        action='store_true')
+    parser.add_argument('--fast-io',
+                        help='use a buffered runtime for reading and '
+                             'writing values, for programs doing a lot of '
+                             'I/O',
+                        action='store_true')
+    parser.add_argument('--recursion-depth',
+                        help='size the stack for this many nested calls of '
+                             'recursive functions (default: at least the '
+                             '65536 word image)',
+                        type=int,
+                        default=None)
+    parser.add_argument('--inline-size',
+                        help='with -O, inline functions whose body has at '
+                             'most this many lines of generated code '
+                             '(default: 40)',
+                        type=int,
+                        default=None)
+    parser.add_argument('--inline-report',
+                        help='with -O, print which function calls were '
+                             'inlined',
+                        action='store_true')
+    parser.add_argument('--short-circuit',
+                        help='skip the right operand of "&" and "|" on bool '
+                             'operands when the left operand decides the '
+                             'result',
+                        action='store_true')
+    parser.add_argument('--cache',
+                        help='reuse the generated code of unchanged '
+                             'functions between compiles, kept in CACHE',
+                        default=None)
     args = parser.parse_args()
 
     return args
 
 
-def run_compiler(source, target, debug=False):
+def run_checker(source, diagnostics='text', max_errors=None):
+    """Run Checker
+
+    Scans and parses a source file, running all scope and type checks, but
+    generates no code and does not run gcc. A fresh parser is used for each
+    call, so this may be called repeatedly from a long-running process.
+
+    Arguments:
+        source: The source file to check.
+        diagnostics: The format of the warning and error report, either
+            'text' or 'json'. (Default: 'text')
+        max_errors: If given, checking stops after this many errors.
+            (Default: None)
+
+    Returns:
+        True if the source has no errors, False otherwise.
+    """
+    parser = Parser(max_errors=max_errors)
+
+    result = parser.check(source)
+
+    # Report all warnings and errors at once
+    print(parser.render_diagnostics(diagnostics), end='')
+
+    if diagnostics == 'json':
+        print()
+
+    return result
+
+
+def run_compiler(source, target, debug=False, profile=None,
+                 line_directives=False, source_map=False,
+                 diagnostics='text', max_errors=None, cache=None,
+                 code_file='./RDDS.c', optimize=False, fast_io=False,
+                 recursion_depth=None, inline_size=None, inline_report=False,
+                 short_circuit=False, code_cache=None):
     """Run Compiler
 
     Executes the compilation process given a source file path.
@@ -55,38 +179,346 @@ def run_compiler(source, target, debug=False):
         source: The source file to compile.
         target: The destination binary executable file.
         debug: If True, verbose parsing details are shown. (Default: False)
+        profile: If given, the compiled program writes a profile of call,
+            loop iteration, time and cycle counts to this path when it
+            exits. (Default: None)
+        line_directives: If True, the generated code carries #line
+            directives and is compiled with debug info. (Default: False)
+        source_map: If True, a JSON source map is written next to the
+            generated code. (Default: False)
+        diagnostics: The format of the warning and error report, either
+            'text' or 'json'. (Default: 'text')
+        max_errors: If given, compilation stops after this many errors.
+            (Default: None)
+        cache: If given, the path of a code cache file. Functions which are
+            unchanged since an earlier compile reuse their generated code.
+            (Default: None)
+        code_file: The location for the intermediate C code. It is only
+            written when debuggers or the source map need to refer to it,
+            otherwise the code is piped straight to gcc.
+            (Default: './RDDS.c')
+        optimize: If True, code which is never used is left out, small
+            functions are inlined, self tail calls become jumps, values
+            are reused within straight-line code, loop invariant code is
+            hoisted out of for loops and array addresses in counted loops
+            are strength reduced. (Default: False)
+        fast_io: If True, the runtime functions read and write through
+            buffers instead of calling scanf and printf. (Default: False)
+        recursion_depth: If given, the stack of the program is sized for
+            this many nested calls of recursive functions. (Default: None)
+        inline_size: If given, functions with at most this many entries of
+            generated code are inlined under optimization. (Default: None)
+        inline_report: If True, a line is printed for each function call
+            considered for inlining. (Default: False)
+        short_circuit: If True, the right operand of "&" and "|" on bool
+            operands is skipped when the left operand decides the result.
+            (Default: False)
+        code_cache: If given, a CodeCache used instead of the cache file.
+            It is not saved, which is left to the caller. (Default: None)
 
     Returns:
         True on success, False otherwise.
     """
-    # Define a temporary location for the intermediate C code
-    TMP_CODE_FILE = './RDDS.c'
+    keep_code_file = line_directives or source_map
+
+    # Load the generated code of earlier compiles, unless the caller handles
+    # the cache
+    save_cache = code_cache is None and cache is not None
+    if save_cache:
+        code_cache = CodeCache(cache)
 
     # Create a Parser object to parse the inputted source file
-    parser = Parser(debug)
+    parser = Parser(debug, profile=profile, line_directives=line_directives,
+                    source_map=source_map, max_errors=max_errors,
+                    code_cache=code_cache, optimize=optimize,
+                    fast_io=fast_io, recursion_depth=recursion_depth,
+                    inline_size=inline_size, short_circuit=short_circuit)
+
+    # Parse the source file, to the intermediate code file if it is kept
+    parsed = parser.parse(source, code_file if keep_code_file else None)
 
-    # Parse the source file to the temporary code file
-    if not parser.parse(source, TMP_CODE_FILE):
-        print('Error while parsing "%s"' % source)
+    if save_cache:
+        code_cache.save()
+
+    # Report all warnings and errors at once
+    print(parser.render_diagnostics(diagnostics), end='')
+
+    if diagnostics == 'json':
+        print()
+
+    if not parsed:
+        if diagnostics == 'text':
+            print('Error while parsing "%s"' % source)
         return False
 
-    # Set up gcc compilation command
-    gcc_cmd = ['gcc', '-m32', '-o', target, TMP_CODE_FILE]
+    if inline_report:
+        print(parser.render_inline_report(), end='')
 
-    # Compile the temporary file with gcc. Output to the target location
-    if subprocess.call(gcc_cmd) != 0:
+    # Compile the generated code with gcc. Output to the target location
+    if keep_code_file:
+        built = run_gcc(target, code_file=code_file,
+                        debug_info=line_directives)
+    else:
+        built = run_gcc(target, code=parser.render()[0])
+
+    if not built:
         print('Error while compiling "%s"' % target)
         return False
 
     return True
 
 
+def run_gcc(target, code=None, code_file=None, debug_info=False):
+    """Run GCC
+
+    Builds a binary from generated code. Code given as text is piped to gcc,
+    so that it never has to be written to a file.
+
+    Arguments:
+        target: The destination binary executable file.
+        code: The generated code as text. (Default: None)
+        code_file: The path of a file holding the generated code, used if no
+            code text is given. (Default: None)
+        debug_info: If True, the binary is built with debug info.
+            (Default: False)
+
+    Returns:
+        True on success, False otherwise.
+    """
+    # Set up gcc compilation command. '-x c -' reads C code from stdin
+    if code is not None:
+        gcc_cmd = ['gcc', '-m32', '-o', target, '-x', 'c', '-']
+    else:
+        gcc_cmd = ['gcc', '-m32', '-o', target, code_file]
+
+    # Keep the line information for debuggers and profilers
+    if debug_info:
+        gcc_cmd.insert(1, '-g')
+
+    # The gcc output is printed like every other report, so that batch mode
+    # can collect it with the rest of the report of each source
+    result = subprocess.run(gcc_cmd, input=code, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, universal_newlines=True)
+    print(result.stdout, end='')
+
+    return result.returncode == 0
+
+
+def find_sources(paths):
+    """Find Sources
+
+    Expands source arguments to source files. Directories give every .src
+    file in them and glob patterns give every file they match, in name
+    order. Other paths are kept as they are.
+
+    Arguments:
+        paths: The source arguments.
+
+    Returns:
+        A list of source file paths, or None if a directory or pattern
+        matched no source files.
+    """
+    sources = []
+
+    for path in paths:
+        if os.path.isdir(path):
+            found = sorted(glob.glob(os.path.join(path, '*.src')))
+        elif any(char in path for char in '*?['):
+            found = sorted(glob.glob(path, recursive=True))
+        else:
+            found = [path]
+
+        if not found:
+            print('Error: "%s"' % path)
+            print('    No source files found')
+            return None
+
+        sources.extend(found)
+
+    return sources
+
+
+def _batch_job(job):
+    """Batch Job (Protected)
+
+    Checks or compiles one source file of a batch. The report printed while
+    doing so is collected rather than printed, so that the reports of jobs
+    running at once do not mix.
+
+    Arguments:
+        job: A (source, target, options) tuple. The target is None if the
+            source is only checked. The options are passed on to
+            run_checker() or run_compiler().
+
+    Returns:
+        A (result, seconds, report, added) tuple. The added dictionary holds
+        the code cache entries added by the job, by key.
+    """
+    source, target, options = job
+    report = io.StringIO()
+    start = time.perf_counter()
+
+    with contextlib.redirect_stdout(report):
+        if target is None:
+            result = run_checker(source, **options)
+        else:
+            result = run_compiler(source, target, **options)
+
+    code_cache = options.get('code_cache')
+    added = code_cache.added() if code_cache is not None else {}
+
+    return result, time.perf_counter() - start, report.getvalue(), added
+
+
+def run_batch(sources, out_dir=None, jobs=None, check=False, **options):
+    """Run Batch
+
+    Checks or compiles many source files, several at once. The report of
+    each source is printed once it is done, followed by a summary table
+    with the status and time of every source.
+
+    Arguments:
+        sources: The source files to compile.
+        out_dir: The directory for the binaries, each named after its source
+            file without the .src extension. (Default: the current directory)
+        jobs: The number of processes compiling at once. (Default: the
+            number of CPUs)
+        check: If True, the sources are only checked. (Default: False)
+        options: Options passed on to run_checker() or run_compiler().
+
+    Returns:
+        True if every source succeeded, False otherwise.
+    """
+    out_dir = out_dir if out_dir is not None else '.'
+    batch = []
+
+    # Jobs saving the code cache themselves would each overwrite the entries
+    # of the others. Every job starts from the cache as loaded here instead,
+    # and the entries they add are saved together once all are done
+    code_cache = None
+    if not check and options.get('cache') is not None:
+        code_cache = CodeCache(options['cache'])
+        options = dict(options, code_cache=code_cache)
+
+    for source in sources:
+        if check:
+            batch.append((source, None, options))
+            continue
+
+        # Each source gets its own binary and, with -g or --source-map, its
+        # own code file next to it
+        name = os.path.splitext(os.path.basename(source))[0]
+        target = os.path.join(out_dir, name)
+        batch.append((source, target, dict(options, code_file=target + '.c')))
+
+    # Two sources would overwrite each other's binary
+    targets = [target for _, target, _ in batch if target is not None]
+    if len(set(targets)) != len(targets):
+        print('Error: "%s"' % out_dir)
+        print('    Several sources would compile to the same binary name')
+        return False
+
+    if not check:
+        os.makedirs(out_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    results = []
+
+    with contextlib.ExitStack() as stack:
+        # Compile in this process if there is nothing to run at once
+        if jobs == 1 or len(batch) == 1:
+            done = map(_batch_job, batch)
+        else:
+            pool = stack.enter_context(ProcessPoolExecutor(max_workers=jobs))
+            done = pool.map(_batch_job, batch)
+
+        # Print the report of each source in order as it is done
+        for (source, target, _), (result, seconds, report,
+                                  added) in zip(batch, done):
+            if report:
+                print('==> %s <==' % source)
+                print(report, end='')
+
+            for key, entry in added.items():
+                code_cache.put(key, entry)
+
+            results.append((source, target, result, seconds))
+
+    if code_cache is not None:
+        code_cache.save()
+
+    total = time.perf_counter() - start
+
+    # Print the summary table
+    width = max(len(source) for source in sources)
+    header = '%-6s  %8s  %-*s' % ('STATUS', 'SECONDS', width, 'SOURCE')
+    print((header + '  BINARY') if not check else header.rstrip())
+
+    for source, target, result, seconds in results:
+        row = '%-6s  %8.3f  %-*s' % ('ok' if result else 'FAILED', seconds,
+                                     width, source)
+        if not check:
+            row += '  ' + (target if result else '-')
+        print(row.rstrip())
+
+    failed = sum(1 for result in results if not result[2])
+    print('%d of %d sources %s, %d failed in %.3f seconds' %
+          (len(results) - failed, len(results),
+           'checked' if check else 'compiled', failed, total))
+
+    return failed == 0
+
+
 if __name__ == '__main__':
     # Parse compiler arguments
     args = parse_arguments()
 
-    # Run compilation process
-    result = run_compiler(args.source, args.out, debug=args.debug)
-    os.system("gcc -m32 RDDS.c")
+    # Several sources, a directory or a pattern are compiled in batch mode
+    sources = find_sources(args.source)
+    batch_mode = (sources != args.source or len(sources) > 1 or
+                  args.out_dir is not None or args.jobs is not None)
+
+    if sources is None:
+        result = False
+    elif batch_mode:
+        if args.check:
+            result = run_batch(sources, jobs=args.jobs, check=True,
+                               diagnostics=args.diagnostics,
+                               max_errors=args.max_errors)
+        else:
+            result = run_batch(sources, out_dir=args.out_dir,
+                               jobs=args.jobs, debug=args.debug,
+                               profile=args.profile,
+                               line_directives=args.line_directives,
+                               source_map=args.source_map,
+                               diagnostics=args.diagnostics,
+                               max_errors=args.max_errors,
+                               cache=args.cache,
+                               optimize=args.optimize,
+                               fast_io=args.fast_io,
+                               recursion_depth=args.recursion_depth,
+                               inline_size=args.inline_size,
+                               inline_report=args.inline_report,
+                               short_circuit=args.short_circuit)
+    elif args.check:
+        # Only check the source for errors
+        result = run_checker(args.source[0], diagnostics=args.diagnostics,
+                             max_errors=args.max_errors)
+    else:
+        # Run compilation process
+        result = run_compiler(args.source[0], args.out, debug=args.debug,
+                              profile=args.profile,
+                              line_directives=args.line_directives,
+                              source_map=args.source_map,
+                              diagnostics=args.diagnostics,
+                              max_errors=args.max_errors,
+                              cache=args.cache,
+                              optimize=args.optimize,
+                              fast_io=args.fast_io,
+                              recursion_depth=args.recursion_depth,
+                              inline_size=args.inline_size,
+                              inline_report=args.inline_report,
+                              short_circuit=args.short_circuit)
+
     # Terminate program
     sys.exit(not result)
@@ -80,7 +80,7 @@ echo "OUTPUT </br> ";
   if (isset($_POST['textarea']))
 {
 echo shell_exec("python3 <path>compiler.py -o OUT test.src");
-echo shell_exec("./a.out < input.txt"); 
+echo shell_exec("./OUT < input.txt"); 
 }
     ?>
             </div>
@@ -8,27 +8,119 @@ Classes:
     CodeGenerator: A code generator interface for destination file outputting.
 """
 
+import json
+import re
+
+from lib.optimizer import CodeOptimizer
+
 
 class CodeGenerator:
+    # Holds the details of the runtime functions. These are the same for
+    # every compile, so they are shared by all instances and never changed
+    runtime_functions = {
+        'getstr': (('my_string', 'str', 'out'),),
+        'putstr': (('my_string', 'str', 'in'),),
+        'getbool': (('my_bool', 'bool', 'out'),),
+        'putbool': (('my_bool', 'bool', 'in'),),
+        'getint': (('my_integer', 'int', 'out'),),
+        'putint': (('my_integer', 'int', 'in'),),
+        'getfloat': (('my_float', 'float', 'out'),),
+        'putfloat': (('my_float', 'float', 'in'),),
+    }
+
+    # Maps each comparison to the comparison which is true when it is false
+    negated_comparisons = {
+        '<': '>=',
+        '>': '<=',
+        '<=': '>',
+        '>=': '<',
+        '==': '!=',
+        '!=': '==',
+    }
+
+    # Matches the code of a comparison stored in a register
+    _comparison_re = re.compile(r'R\[(\d+)\] = (R\[\d+\]) (<=|>=|==|!=|<|>) '
+                                r'(R\[\d+\]);$')
+
     def __init__(self):
         super().__init__()
 
-        # Holds the file path of the attached destination file
-        self._dest_path = ''
+        # If True, #line directives pointing at the source are written
+        self._line_directives = False
 
-        # Holds all generated code to be written to the file destination
-        self._generated_code = ''
+        # If True, a JSON map of generated lines to source lines is written
+        self._source_map = False
 
-        # Holds allocated size of main memory and num registers
+        # Holds allocated size of main memory and num registers. These are
+        # only used if the memory a program needs can not be worked out
         self._mm_size = 65536
         self._reg_size = 2048
         self._buf_size = 256
 
+        # Holds the most words of memory and registers kept on the C stack.
+        # Larger images are static, which is slower to address
+        self._stack_limit = 65536 + 2048
+
+        # Holds the number of nested calls of recursive procedures the memory
+        # is sized for, and the words of memory kept for strings. Unless the
+        # depth is given, recursive programs never get less memory than the
+        # default sizes
+        self._recursion_depth = 1000
+        self._recursion_depth_given = False
+        self._heap_size = 16384
+
+        # Holds the largest number of code entries in the body of a procedure
+        # which is inlined at its calls under optimization
+        self._inline_size = 40
+
         # Holds stack pointer, frame pointer, and heap pointer registers
         self._SP = 1
         self._FP = 2
         self._HP = 3
 
+        # Holds the profile output path. If None, no profiling code is made
+        self._profile_path = None
+
+        # If True, procedures, runtime routines, variables and statements
+        # which are never used are left out of the generated code
+        self._optimize = False
+
+        # If True, the runtime functions read and write through buffers of
+        # the generated program instead of calling scanf and printf
+        self._fast_io = False
+
+        # If True, the right operand of "&" and "|" on bools is only worked
+        # out if the left operand does not decide the result
+        self._short_circuit = False
+
+        self.reset_generator()
+
+        return
+
+    def reset_generator(self):
+        """Reset Code Generator
+
+        Drops all generated code and sets every counter back to its start,
+        so that the code generator may be used for another compile. The
+        options of the code generator are kept.
+        """
+        # Holds the file path of the attached destination file
+        self._dest_path = ''
+
+        # Holds all generated code to be written to the file destination.
+        # Each entry is a line (or block of lines) of generated code
+        self._generated_code = []
+
+        # Holds the source line each entry of generated code came from
+        self._generated_lines = []
+
+        # Holds the source line of the code currently being generated
+        self._src_line = None
+
+        # If True, the source is only checked. No code is generated and no
+        # registers or labels are allocated
+        self._check_only = False
+
         # Holds the pointer to the lowest unused register for allocation
         self._reg = 4
 
@@ -51,17 +143,43 @@ class CodeGenerator:
         # Holds an integer to distinguish multiple calls of a function
         self._unique_id = 0
 
-        # Holds the details of the runtime functions
-        self.runtime_functions = {
-            'getstr': [('my_string', 'str', 'out')],
-            'putstr': [('my_string', 'str', 'in')],
-            'getbool': [('my_bool', 'bool', 'out')],
-            'putbool': [('my_bool', 'bool', 'in')],
-            'getint': [('my_integer', 'int', 'out')],
-            'putint': [('my_integer', 'int', 'in')],
-            'getfloat': [('my_float', 'float', 'out')],
-            'putfloat': [('my_float', 'float', 'in')],
-        }
+        # Holds the profiled regions as (kind, name, scope, line) tuples. The
+        # index of a region is its slot in the generated profile counters
+        self._profile_slots = []
+
+        # Maps procedure labels to their profile slot
+        self._profile_labels = {}
+
+        # Holds the slots of the loops currently open in the parsed scope
+        self._profile_loops = []
+
+        # Holds the length of the generated header so it may be regenerated
+        self._header_len = 0
+
+        # Maps the label of every procedure (and of the program) to the
+        # [start, end) range of its generated code
+        self._procedures = {}
+
+        # Holds the labels of the procedures currently being generated, and
+        # the label of the program, which is opened first
+        self._open_procedures = []
+        self._program_label = None
+
+        # Holds every call as a (code index, caller label, callee label) tuple
+        self._calls = []
+
+        # Holds the stack frames of the procedures currently being generated
+        # (the program frame first) and of all finished procedures. The
+        # frame sizes are used to size the memory of the program
+        self._frames = []
+        self._closed_frames = []
+
+        # Holds the names of the runtime functions which are called. If None,
+        # all of them are
+        self._runtime_used = None
+
+        # Holds an InlineRecord for each call considered for inlining
+        self.inline_report = []
 
         return
 
@@ -87,24 +205,78 @@ class CodeGenerator:
 
         Adds all header code to the generated code buffer.
         """
+        self._src_line = None
+        self.generate(self._header_code(), tabs=0)
+        self._header_len = len(self._generated_code)
+
+        return
+
+    def update_header(self):
+        """Update Code Header
+
+        Regenerates the header code at the start of the generated code buffer.
+        This is used to fill in values which are only known once the whole
+        program has been parsed, such as the number of profile slots.
+        """
+        self._generated_code[:self._header_len] = [self._header_code()]
+        self._generated_lines[:self._header_len] = [None]
+        self._header_len = 1
+
+        return
+
+    def _header_code(self):
+        """Header Code (Protected)
+
+        Builds the header code for the current code generator state.
+
+        Returns:
+            The header code as a single string.
+        """
         code = [
             '#include <stdio.h>',
+            '#include <stdlib.h>',
             '#include <string.h>',
+        ]
+
+        if self._fast_io:
+            code.append('#include <unistd.h>')
+
+        mm_size, reg_size, heap_size, stack_gap = self._memory_sizes()
+        storage = 'static ' if mm_size + reg_size > self._stack_limit else ''
+
+        code.extend([
+            '',
+            '#define MM_SIZE   %d' % mm_size,
+            '#define R_SIZE    %d' % reg_size,
+            '#define BUF_SIZE  %d' % self._buf_size,
             '',
-            '#define MM_SIZE  %d' % self._mm_size,
-            '#define R_SIZE   %d' % self._reg_size,
-            '#define BUF_SIZE %d' % self._buf_size,
+            '// The heap takes the bottom of MM. Each procedure checks that',
+            '// this many words are left between the stack and the heap',
+            '#define HEAP_SIZE %d' % heap_size,
+            '#define STACK_GAP %d' % stack_gap,
             '',
             '// Define register locations of stack/frame ptr',
-            '#define SP       %d' % self._SP,
-            '#define FP       %d' % self._FP,
-            '#define HP       %d' % self._HP,
+            '#define SP        %d' % self._SP,
+            '#define FP        %d' % self._FP,
+            '#define HP        %d' % self._HP,
             '',
+        ])
+
+        code.extend(self._heap_header_code())
+
+        if self._fast_io:
+            code.extend(self._fast_io_header_code())
+
+        if self._profile_path is not None:
+            code.extend(self._profile_header_code())
+
+        code.extend([
             'int main(void)',
             '{',
-            '// Allocate main memory and register space',
-            'int MM[MM_SIZE];',
-            'int R[R_SIZE];',
+            '// Allocate main memory and register space. Large images are',
+            '// static so that they can not overflow the C stack',
+            '%sint MM[MM_SIZE];' % storage,
+            '%sint R[R_SIZE];' % storage,
             '',
             '// SP and FP start at the top of MM',
             'R[SP] = MM_SIZE - 1;',
@@ -120,88 +292,516 @@ class CodeGenerator:
             '// Allocate space for a string buffer',
             'char STR_BUF[BUF_SIZE];',
             '',
+        ])
+
+        if self._fast_io:
+            code.extend([
+                '// Write out the buffered output when the program exits',
+                'atexit(io_flush);',
+                '',
+            ])
+
+        code.extend([
             '////////////////////////////////////////////////////',
             '// PROGRAM START',
             '',
+        ])
+
+        return '\n'.join(code)
+
+    def _heap_header_code(self):
+        """Heap Header Code (Protected)
+
+        Builds the string heap functions used by getstr. Strings are kept in
+        blocks at the bottom of MM, each starting with a header word which
+        holds the size of the block in words and whether it is in use. When
+        the heap would outgrow HEAP_SIZE, every block which no value on the
+        stack or in a register points to is freed. Freed blocks are reused
+        first fit. If that does not make room, the heap grows into the part
+        of the stack which is not in use, and the program stops with an
+        error once it would reach the stack.
+
+        Returns:
+            A list of code lines.
+        """
+        return [
+            '// String heap. Holds the first free block, or -1',
+            'static int HEAP_FREE = -1;',
+            '',
+            'static int heap_compare(const void *a, const void *b)',
+            '{',
+            '    unsigned int x = *(const unsigned int*)a;',
+            '    unsigned int y = *(const unsigned int*)b;',
+            '    return x < y ? -1 : x > y;',
+            '}',
+            '',
+            '// Frees every block no string value points to',
+            'static void heap_collect(int *MM, int *R)',
+            '{',
+            '    unsigned int low = (unsigned int)(char*)&MM[0];',
+            '    unsigned int high = (unsigned int)(char*)&MM[R[HP]];',
+            '    unsigned int *roots;',
+            '    int count = 0, i, block, words, last = -1;',
+            '    int *link = &HEAP_FREE;',
+            '',
+            '    roots = malloc((MM_SIZE - R[SP] + R_SIZE) * sizeof(int));',
+            '    if (roots == NULL) return;',
+            '',
+            '    // Any value on the stack or in a register may be a string',
+            '    for (i = R[SP]; i < MM_SIZE; i++)',
+            '        if ((unsigned int)MM[i] > low && (unsigned int)MM[i] < high)',
+            '            roots[count++] = MM[i];',
+            '    for (i = 0; i < R_SIZE; i++)',
+            '        if ((unsigned int)R[i] > low && (unsigned int)R[i] < high)',
+            '            roots[count++] = R[i];',
+            '    qsort(roots, count, sizeof(int), heap_compare);',
+            '',
+            '    // Free the blocks not pointed to, joining neighbouring ones',
+            '    for (block = 0; block < R[HP]; block += 1 + words) {',
+            '        unsigned int data = (unsigned int)(char*)&MM[block + 1];',
+            '        words = MM[block] >> 1;',
+            '        if (bsearch(&data, roots, count, sizeof(int), heap_compare)) {',
+            '            MM[block] = (words << 1) | 1;',
+            '            last = -1;',
+            '        } else if (last != -1) {',
+            '            MM[last] += (1 + words) << 1;',
+            '        } else {',
+            '            MM[block] = words << 1;',
+            '            last = block;',
+            '        }',
+            '    }',
+            '    free(roots);',
+            '',
+            '    // Give a free block at the top of the heap back to the stack',
+            '    if (last != -1) R[HP] = last;',
+            '',
+            '    // Chain the free blocks together through their first word',
+            '    for (block = 0; block < R[HP]; block += 1 + (MM[block] >> 1)) {',
+            '        if (!(MM[block] & 1)) {',
+            '            *link = block;',
+            '            link = &MM[block + 1];',
+            '        }',
+            '    }',
+            '    *link = -1;',
+            '}',
+            '',
+            '// Returns the index in MM of space for the given number of words',
+            'static int heap_alloc(int *MM, int *R, int words)',
+            '{',
+            '    int tries, block, size, limit, *link;',
+            '',
+            '    for (tries = 0; tries < 2; tries++) {',
+            '        // Reuse the first free block which is large enough',
+            '        for (link = &HEAP_FREE; *link != -1; link = &MM[*link + 1]) {',
+            '            block = *link;',
+            '            size = MM[block] >> 1;',
+            '            if (size < words) continue;',
+            '            if (size - words >= 2) {',
+            '                // Split off the rest as a new free block',
+            '                MM[block + 1 + words] = (size - words - 1) << 1;',
+            '                MM[block + 2 + words] = MM[block + 1];',
+            '                *link = block + 1 + words;',
+            '                size = words;',
+            '            } else {',
+            '                *link = MM[block + 1];',
+            '            }',
+            '            MM[block] = (size << 1) | 1;',
+            '            return block + 1;',
+            '        }',
+            '',
+            '        // Otherwise grow the heap. Only once the unused blocks have',
+            '        // been freed may it grow past HEAP_SIZE, towards the stack',
+            '        limit = R[SP] - STACK_GAP;',
+            '        if (tries == 0 && limit > HEAP_SIZE) limit = HEAP_SIZE;',
+            '        if (R[HP] + 1 + words <= limit) {',
+            '            block = R[HP];',
+            '            MM[block] = (words << 1) | 1;',
+            '            R[HP] = R[HP] + 1 + words;',
+            '            return block + 1;',
+            '        }',
+            '',
+            '        if (tries == 0) heap_collect(MM, R);',
+            '    }',
+            '',
+            '    fprintf(stderr, "Error: out of memory, the string heap has "',
+            '                    "reached the stack\\n");',
+            '    exit(1);',
+            '}',
+            '',
         ]
 
-        self.generate('\n'.join(code), tabs=0)
+    def _fast_io_header_code(self):
+        """Fast I/O Header Code (Protected)
 
-        return
+        Builds the buffered input and output functions used by the runtime
+        functions when fast I/O is enabled. Output is written out when the
+        buffer is full, before more input is read and when the program
+        exits. Integers are formatted and parsed by hand. Floats are
+        formatted with snprintf so that they print exactly as with printf.
+
+        Returns:
+            A list of code lines.
+        """
+        return [
+            '// Buffered input and output',
+            '#define IO_BUF_SIZE 65536',
+            'static char IO_OUT[IO_BUF_SIZE];',
+            'static int IO_OUT_LEN = 0;',
+            'static char IO_IN[IO_BUF_SIZE];',
+            'static int IO_IN_POS = 0;',
+            'static int IO_IN_LEN = 0;',
+            '',
+            'static void io_flush(void)',
+            '{',
+            '    int done = 0;',
+            '    while (done < IO_OUT_LEN) {',
+            '        int n = write(1, IO_OUT + done, IO_OUT_LEN - done);',
+            '        if (n <= 0) break;',
+            '        done += n;',
+            '    }',
+            '    IO_OUT_LEN = 0;',
+            '}',
+            '',
+            'static void io_put(const char *s, int n)',
+            '{',
+            '    while (n > 0) {',
+            '        int k = IO_BUF_SIZE - IO_OUT_LEN;',
+            '        if (k > n) k = n;',
+            '        memcpy(IO_OUT + IO_OUT_LEN, s, k);',
+            '        IO_OUT_LEN += k;',
+            '        s += k;',
+            '        n -= k;',
+            '        if (IO_OUT_LEN == IO_BUF_SIZE) io_flush();',
+            '    }',
+            '}',
+            '',
+            'static void io_put_str(const char *s)',
+            '{',
+            '    io_put(s, strlen(s));',
+            '    io_put("\\n", 1);',
+            '}',
+            '',
+            'static void io_put_int(int v)',
+            '{',
+            '    char buf[16];',
+            '    int i = sizeof(buf);',
+            '    unsigned int u = v < 0 ? 0u - (unsigned int)v : (unsigned int)v;',
+            '    buf[--i] = \'\\n\';',
+            '    do {',
+            '        buf[--i] = \'0\' + u % 10;',
+            '        u /= 10;',
+            '    } while (u);',
+            '    if (v < 0) buf[--i] = \'-\';',
+            '    io_put(buf + i, sizeof(buf) - i);',
+            '}',
+            '',
+            'static void io_put_float(float v)',
+            '{',
+            '    char buf[64];',
+            '    io_put(buf, snprintf(buf, sizeof(buf), "%g\\n", v));',
+            '}',
+            '',
+            'static int io_peek(void)',
+            '{',
+            '    if (IO_IN_POS == IO_IN_LEN) {',
+            '        // Show all output, such as prompts, before waiting',
+            '        io_flush();',
+            '        IO_IN_POS = 0;',
+            '        IO_IN_LEN = read(0, IO_IN, IO_BUF_SIZE);',
+            '        if (IO_IN_LEN <= 0) {',
+            '            IO_IN_LEN = 0;',
+            '            return EOF;',
+            '        }',
+            '    }',
+            '    return (unsigned char)IO_IN[IO_IN_POS];',
+            '}',
+            '',
+            'static int io_skip_space(void)',
+            '{',
+            '    int c = io_peek();',
+            '    while (c == \' \' || (c >= \'\\t\' && c <= \'\\r\')) {',
+            '        IO_IN_POS++;',
+            '        c = io_peek();',
+            '    }',
+            '    return c;',
+            '}',
+            '',
+            '// Reads like scanf("%d"), leaving v unchanged if there is no number',
+            'static void io_get_int(int *v)',
+            '{',
+            '    unsigned int u = 0;',
+            '    int c = io_skip_space(), negative = 0, digits = 0;',
+            '    if (c == \'-\' || c == \'+\') {',
+            '        negative = c == \'-\';',
+            '        IO_IN_POS++;',
+            '        c = io_peek();',
+            '    }',
+            '    while (c >= \'0\' && c <= \'9\') {',
+            '        u = u * 10 + (c - \'0\');',
+            '        digits++;',
+            '        IO_IN_POS++;',
+            '        c = io_peek();',
+            '    }',
+            '    if (digits) *v = (int)(negative ? 0u - u : u);',
+            '}',
+            '',
+            '// Reads like scanf("%f"), leaving v unchanged if there is no number',
+            'static void io_get_float(float *v)',
+            '{',
+            '    char buf[64];',
+            '    int n = 0, c = io_skip_space();',
+            '    while (n < (int)sizeof(buf) - 1 && ((c >= \'0\' && c <= \'9\') ||',
+            '           c == \'.\' || c == \'-\' || c == \'+\' || c == \'e\' || c == \'E\')) {',
+            '        buf[n++] = c;',
+            '        IO_IN_POS++;',
+            '        c = io_peek();',
+            '    }',
+            '    buf[n] = 0;',
+            '    if (n) *v = strtof(buf, NULL);',
+            '}',
+            '',
+            '// Reads like fgets, leaving buf unchanged at the end of the input',
+            'static void io_get_line(char *buf, int size)',
+            '{',
+            '    int n = 0, c;',
+            '    while (n < size - 1 && (c = io_peek()) != EOF) {',
+            '        buf[n++] = c;',
+            '        IO_IN_POS++;',
+            '        if (c == \'\\n\') break;',
+            '    }',
+            '    if (n) buf[n] = 0;',
+            '}',
+            '',
+        ]
+
+    def _profile_header_code(self):
+        """Profile Header Code (Protected)
+
+        Builds the declarations of the profile counters and timers. Each
+        profiled region owns one slot in the counter arrays.
+
+        Returns:
+            A list of code lines to place before the main function.
+        """
+        return [
+            '// Profiling counters, timers and cycle counts',
+            '#include <time.h>',
+            '#if defined(__i386__) || defined(__x86_64__)',
+            '#include <x86intrin.h>',
+            '#define PROF_CYCLES_NOW() ((long long)__rdtsc())',
+            '#else',
+            '#define PROF_CYCLES_NOW() 0LL',
+            '#endif',
+            '',
+            '#define PROF_SLOTS %d' % max(len(self._profile_slots), 1),
+            '',
+            'static long long PROF_COUNT[PROF_SLOTS];',
+            'static long long PROF_TIME[PROF_SLOTS];',
+            'static long long PROF_CYCLES[PROF_SLOTS];',
+            'static long long PROF_START[PROF_SLOTS];',
+            'static long long PROF_START_CYCLES[PROF_SLOTS];',
+            'static int PROF_DEPTH[PROF_SLOTS];',
+            '',
+            'static long long prof_now(void)',
+            '{',
+            '    struct timespec ts;',
+            '    clock_gettime(CLOCK_MONOTONIC, &ts);',
+            '    return (long long)ts.tv_sec * 1000000000LL + ts.tv_nsec;',
+            '}',
+            '',
+            '// Only the outermost activation of a slot is timed so that',
+            '// recursion does not count the same time twice',
+            '#define PROF_ENTER(k) if (PROF_DEPTH[k]++ == 0) { '
+            'PROF_START[k] = prof_now(); '
+            'PROF_START_CYCLES[k] = PROF_CYCLES_NOW(); }',
+            '#define PROF_EXIT(k) if (--PROF_DEPTH[k] == 0) { '
+            'PROF_TIME[k] += prof_now() - PROF_START[k]; '
+            'PROF_CYCLES[k] += PROF_CYCLES_NOW() - PROF_START_CYCLES[k]; }',
+            '',
+        ]
 
     def generate_footer(self):
         """Generate Code Footer
 
         Adds all footer code to the generated code buffer.
         """
+        self._src_line = None
+
         code = [
             '',
             '    // Jump to the program exit',
             '    goto *(void*)MM[R[FP]];',
             '',
+        ]
+
+        if self._profile_path is not None:
+            code.extend(self._profile_dump_code())
+
+        code.extend([
+            '    // A procedure found the stack reaching the heap',
+            'stack_overflow:',
+            '    fprintf(stderr, "Error: stack overflow, the stack has "',
+            '                    "reached the heap\\n");',
+            '    exit(1);',
+            '',
             '////////////////////////////////////////////////////',
             '// RUNTIME FUNCTIONS',
-            '',
-            'putstr_1:',
-            '    R[0] = MM[R[FP]+2];',
-            '    printf("%s\\n", (char*)R[0]);',
-            '    R[0] = MM[R[FP]];',
-            '    goto *(void*)R[0];',
-            '',
-            'getstr_1:',
-            '    fgets(STR_BUF, BUF_SIZE, stdin);',
-            '    R[0] = strlen(STR_BUF) + 1;',
-            '    memcpy(&MM[R[HP]], &STR_BUF, R[0]);',
-            '    MM[R[FP]+2] = (int)((char*)&MM[R[HP]]);',
-            '    R[HP] = R[HP] + R[0];',
-            '    R[0] = MM[R[FP]];',
-            '    goto *(void*)R[0];',
-            '',
-            'putbool_1:',
-            '    R[0] = MM[R[FP]+2];',
-            '    printf("%s\\n", R[0] ? "true" : "false");',
-            '    R[0] = MM[R[FP]];',
-            '    goto *(void*)R[0];',
-            '',
-            'getbool_1:',
-            '    scanf("%d", &R[0]);',
-            '    R[0] = R[0] ? 1 : 0;',
-            '    MM[R[FP]+2] = R[0];',
-            '    R[0] = MM[R[FP]];',
-            '    goto *(void*)R[0];',
-            '',
-            'putint_1:',
-            '    R[0] = MM[R[FP]+2];',
-            '    printf("%d\\n", R[0]);',
-            '    R[0] = MM[R[FP]];',
-            '    goto *(void*)R[0];',
-            '',
-            'getint_1:',
-            '    scanf("%d", &R[0]);',
-            '    MM[R[FP]+2] = R[0];',
-            '    R[0] = MM[R[FP]];',
-            '    goto *(void*)R[0];',
-            '',
-            'putfloat_1:',
-            '    R[0] = MM[R[FP]+2];',
-            '    memcpy(&R_FLOAT_1, &R[0], sizeof(float));',
-            '    printf("%g\\n", R_FLOAT_1);',
-            '    R[0] = MM[R[FP]];',
-            '    goto *(void*)R[0];',
-            '',
-            'getfloat_1:',
-            '    scanf("%f", &R_FLOAT_1);',
-            '    memcpy(&R[0], &R_FLOAT_1, sizeof(float));',
-            '    MM[R[FP]+2] = R[0];',
-            '    R[0] = MM[R[FP]];',
-            '    goto *(void*)R[0];',
-            '}',
-        ]
+        ])
+
+        for name, routine in self._runtime_routines():
+            if self._runtime_used is None or name in self._runtime_used:
+                code.append('')
+                code.extend(routine)
+
+        code.append('}')
 
         self.generate('\n'.join(code), tabs=0)
 
         return
 
+    def _runtime_routines(self):
+        """Runtime Routines (Protected)
+
+        Builds the code of every runtime function.
+
+        Returns:
+            A list of (name, code lines) tuples, one for each runtime
+            function.
+        """
+        # Choose how the runtime functions read and write values
+        if self._fast_io:
+            put_str = 'io_put_str((char*)R[0]);'
+            get_str = 'io_get_line(STR_BUF, BUF_SIZE);'
+            put_bool = 'io_put_str(R[0] ? "true" : "false");'
+            get_int = 'io_get_int(&R[0]);'
+            put_int = 'io_put_int(R[0]);'
+            put_float = 'io_put_float(R_FLOAT_1);'
+            get_float = 'io_get_float(&R_FLOAT_1);'
+        else:
+            put_str = 'printf("%s\\n", (char*)R[0]);'
+            get_str = 'fgets(STR_BUF, BUF_SIZE, stdin);'
+            put_bool = 'printf("%s\\n", R[0] ? "true" : "false");'
+            get_int = 'scanf("%d", &R[0]);'
+            put_int = 'printf("%d\\n", R[0]);'
+            put_float = 'printf("%g\\n", R_FLOAT_1);'
+            get_float = 'scanf("%f", &R_FLOAT_1);'
+
+        return [
+            ('putstr', [
+                'putstr_1:',
+                '    R[0] = MM[R[FP]+2];',
+                '    ' + put_str,
+                '    R[0] = MM[R[FP]];',
+                '    goto *(void*)R[0];',
+            ]),
+            ('getstr', [
+                'getstr_1:',
+                '    ' + get_str,
+                '    R[0] = heap_alloc(MM, R, strlen(STR_BUF) / sizeof(int) + 1);',
+                '    strcpy((char*)&MM[R[0]], STR_BUF);',
+                '    MM[R[FP]+2] = (int)((char*)&MM[R[0]]);',
+                '    R[0] = MM[R[FP]];',
+                '    goto *(void*)R[0];',
+            ]),
+            ('putbool', [
+                'putbool_1:',
+                '    R[0] = MM[R[FP]+2];',
+                '    ' + put_bool,
+                '    R[0] = MM[R[FP]];',
+                '    goto *(void*)R[0];',
+            ]),
+            ('getbool', [
+                'getbool_1:',
+                '    ' + get_int,
+                '    R[0] = R[0] ? 1 : 0;',
+                '    MM[R[FP]+2] = R[0];',
+                '    R[0] = MM[R[FP]];',
+                '    goto *(void*)R[0];',
+            ]),
+            ('putint', [
+                'putint_1:',
+                '    R[0] = MM[R[FP]+2];',
+                '    ' + put_int,
+                '    R[0] = MM[R[FP]];',
+                '    goto *(void*)R[0];',
+            ]),
+            ('getint', [
+                'getint_1:',
+                '    ' + get_int,
+                '    MM[R[FP]+2] = R[0];',
+                '    R[0] = MM[R[FP]];',
+                '    goto *(void*)R[0];',
+            ]),
+            ('putfloat', [
+                'putfloat_1:',
+                '    R[0] = MM[R[FP]+2];',
+                '    memcpy(&R_FLOAT_1, &R[0], sizeof(float));',
+                '    ' + put_float,
+                '    R[0] = MM[R[FP]];',
+                '    goto *(void*)R[0];',
+            ]),
+            ('getfloat', [
+                'getfloat_1:',
+                '    ' + get_float,
+                '    memcpy(&R[0], &R_FLOAT_1, sizeof(float));',
+                '    MM[R[FP]+2] = R[0];',
+                '    R[0] = MM[R[FP]];',
+                '    goto *(void*)R[0];',
+            ]),
+        ]
+
+    def _profile_dump_code(self):
+        """Profile Dump Code (Protected)
+
+        Builds the code which writes all profile counters to the profile
+        file when the program exits. Every slot is written with the RDDS
+        name, enclosing scope and source line of the profiled region.
+
+        Returns:
+            A list of code lines to place in the footer.
+        """
+        kinds, names, scopes, lines = [], [], [], []
+
+        for kind, name, scope, line in self._profile_slots:
+            kinds.append('"%s"' % kind)
+            names.append('"%s"' % name)
+            scopes.append('"%s"' % scope)
+            lines.append(str(line if line is not None else 0))
+
+        program_slot = kinds.index('"program"')
+        path = self._profile_path.replace('\\', '\\\\').replace('"', '\\"')
+
+        return [
+            'prof_dump:',
+            '{',
+            '    static const char *PROF_KIND[] = {%s};' % ', '.join(kinds),
+            '    static const char *PROF_NAME[] = {%s};' % ', '.join(names),
+            '    static const char *PROF_SCOPE[] = {%s};' % ', '.join(scopes),
+            '    static const int PROF_LINE[] = {%s};' % ', '.join(lines),
+            '    FILE *prof_file;',
+            '    int prof_slot;',
+            '',
+            '    PROF_EXIT(%d)' % program_slot,
+            '    prof_file = fopen("%s", "w");' % path,
+            '    if (prof_file != NULL) {',
+            '        fprintf(prof_file, "kind\\tname\\tscope\\tline\\t'
+            'count\\ttime_ns\\tcycles\\n");',
+            '        for (prof_slot = 0; prof_slot < %d; prof_slot++) {' %
+            len(self._profile_slots),
+            '            fprintf(prof_file, "%s\\t%s\\t%s\\t%d\\t%lld\\t'
+            '%lld\\t%lld\\n",',
+            '                    PROF_KIND[prof_slot], PROF_NAME[prof_slot],',
+            '                    PROF_SCOPE[prof_slot], PROF_LINE[prof_slot],',
+            '                    PROF_COUNT[prof_slot], PROF_TIME[prof_slot],',
+            '                    PROF_CYCLES[prof_slot]);',
+            '        }',
+            '        fclose(prof_file);',
+            '    }',
+            '}',
+            '    return 0;',
+            '',
+        ]
+
     def generate(self, code, tabs=-1):
         """Generate Code
         
@@ -215,8 +815,49 @@ class CodeGenerator:
                 correspond to the tab location from tab_push() and tab_pop()
                 methods. (Default: -1)
         """
+        # Nothing is written in check-only mode. Every emitter goes through
+        # here, so none of them needs its own check
+        if self._check_only:
+            return
+
         tabs = tabs if tabs != -1 else self._tab_count
-        self._generated_code += ('    ' * tabs) + code + '\n'
+        self._generated_code.append(('    ' * tabs) + code)
+        self._generated_lines.append(self._src_line)
+
+        return
+
+    def generate_cached(self, code, counts, frames=(), calls=()):
+        """Generate Cached Code
+
+        Adds previously generated code to the generated code buffer as is,
+        and skips past the labels, call numbers and registers it uses.
+
+        Arguments:
+            code: The list of generated code entries to add.
+            counts: The number of labels, call numbers and registers used by
+                the code.
+            frames: The (label, param size, frame size) of every procedure
+                in the code. (Default: ())
+            calls: The (caller label, callee label) of every call in the
+                code. (Default: ())
+        """
+        if self._check_only:
+            return
+
+        for label, param_size, size in frames:
+            self._closed_frames.append({'label': label, 'params': param_size,
+                                        'size': size, 'vars': [], 'refs': [],
+                                        'alloc': None})
+
+        for caller, callee in calls:
+            self._calls.append((len(self._generated_code), caller, callee))
+
+        self._generated_code.extend(code)
+        self._generated_lines.extend([None] * len(code))
+
+        self._label_id += counts[0]
+        self._unique_id += counts[1]
+        self._reg += counts[2]
 
         return
 
@@ -253,6 +894,20 @@ class CodeGenerator:
         self._tab_count -= 1 if self._tab_count != 0 else 0
         return
 
+    def stop_generating(self):
+        """Stop Generating
+
+        Switches the code generator to check-only mode. Any code generated
+        so far is dropped and all further generation requests are ignored.
+        This is used once an error makes the generated code useless.
+        """
+        self._check_only = True
+        self._generated_code = []
+        self._generated_lines = []
+        self._header_len = 0
+
+        return
+
     def commit(self):
         """Commit Code Generation
 
@@ -262,9 +917,15 @@ class CodeGenerator:
         Returns:
             True if file is successfully written, False otherwise.
         """
+        code, line_map = self.render()
+
         try:
             with open(self._dest_path, 'w+') as f:
-                f.write(self._generated_code)
+                f.write(code)
+
+            if self._source_map:
+                with open(self._dest_path + '.map.json', 'w+') as f:
+                    json.dump(self._source_map_data(line_map), f)
         except IOError as e:
             print('Error: "%s"' % self._dest_path)
             print('    Could not write to destination file: %s' % e.strerror)
@@ -272,6 +933,534 @@ class CodeGenerator:
 
         return True
 
+    def render(self):
+        """Render Generated Code
+
+        Joins the generated code buffer into the final code text. If line
+        directives are enabled, #line directives are placed wherever the
+        generated code does not follow on from the previous source line.
+
+        Returns:
+            A (code, line_map) tuple. The line_map lists the source line of
+            each generated line (None where there is no source line), or is
+            None if neither line directives nor a source map are wanted.
+        """
+        if not self._line_directives and not self._source_map:
+            return '\n'.join(self._generated_code) + '\n', None
+
+        src_name = self._src_path.replace('\\', '\\\\').replace('"', '\\"')
+        dest_name = self._dest_path.replace('\\', '\\\\').replace('"', '\\"')
+
+        lines = []
+        line_map = []
+
+        # Holds the source line of the last generated line
+        last_line = None
+
+        for entry, src_line in zip(self._generated_code,
+                                   self._generated_lines):
+            for code in entry.split('\n'):
+                if self._line_directives and src_line is not None:
+                    stripped = code.strip()
+
+                    # Line comments would swallow any code joined after them
+                    if stripped.startswith('//'):
+                        stripped = '/* %s */' % stripped[2:].strip()
+                        code = code[:code.index('//')] + stripped
+
+                    # Keep all code from one source line on one line of C so
+                    # that a single #line directive covers all of it
+                    if src_line == last_line:
+                        if stripped:
+                            lines[-1] += ' ' + stripped
+                        continue
+
+                    # Point the C compiler back at the source file and line
+                    lines.append('#line %d "%s"' % (src_line, src_name))
+                    line_map.append(None)
+                elif self._line_directives and last_line is not None:
+                    # Point the C compiler back at the generated file
+                    lines.append('#line %d "%s"' % (len(lines) + 2,
+                                                    dest_name))
+                    line_map.append(None)
+
+                lines.append(code)
+                line_map.append(src_line)
+
+                last_line = src_line
+
+        return '\n'.join(lines) + '\n', line_map
+
+    def _source_map_data(self, line_map):
+        """Source Map Data (Protected)
+
+        Builds the JSON source map of the generated code.
+
+        Arguments:
+            line_map: The source line of each generated line as returned by
+                render().
+
+        Returns:
+            A dictionary mapping generated code lines to source lines.
+        """
+        return {
+            'version': 1,
+            'file': self._dest_path,
+            'source': self._src_path,
+            'lines': line_map,
+        }
+
+    def open_procedure(self, procedure_name, procedure_num, param_size=0):
+        """Open Procedure
+
+        Marks the start of the code and the stack frame of a procedure, or
+        of the program. Used to eliminate dead code and to size the memory
+        of the program.
+
+        Arguments:
+            procedure_name: The name of the procedure.
+            procedure_num: The label id of the procedure.
+            param_size: The number of parameters of the procedure.
+                (Default: 0)
+        """
+        if self._check_only:
+            return
+
+        label = '%s_%d' % (procedure_name, procedure_num)
+
+        if self._program_label is None:
+            self._program_label = label
+
+        self._procedures[label] = [len(self._generated_code), None]
+        self._open_procedures.append(label)
+        self._frames.append({'label': label, 'params': param_size, 'size': 0,
+                             'vars': [], 'refs': [], 'alloc': None})
+
+        return
+
+    def close_procedure(self):
+        """Close Procedure
+
+        Marks the end of the code and the stack frame of the procedure
+        opened last.
+        """
+        if self._check_only:
+            return
+
+        label = self._open_procedures.pop()
+
+        self._procedures[label][1] = len(self._generated_code)
+        self._closed_frames.append(self._frames.pop())
+
+        return
+
+    def frame_marks(self):
+        """Frame Marks
+
+        Returns:
+            A mark of the stack frames and calls recorded so far, to be
+            passed to frames_since().
+        """
+        return len(self._closed_frames), len(self._calls)
+
+    def frames_since(self, marks):
+        """Frames Since
+
+        Arguments:
+            marks: A mark returned by frame_marks().
+
+        Returns:
+            A tuple of the (label, param size, frame size) of every procedure
+            and the (caller label, callee label) of every call recorded
+            since the mark was made.
+        """
+        frames = [(frame['label'], frame['params'], frame['size'])
+                  for frame in self._closed_frames[marks[0]:]]
+        calls = [(caller, callee)
+                 for _, caller, callee in self._calls[marks[1]:]]
+
+        return frames, calls
+
+    def add_frame_variable(self, name, id_location, id_size, mm_ptr):
+        """Add Frame Variable
+
+        Records a variable declared in the stack frame of the procedure
+        being generated, so that it may be left out of the frame if it is
+        never used.
+
+        Arguments:
+            name: The name of the variable.
+            id_location: Either 'global' or 'local'.
+            id_size: The array size of the variable, or None.
+            mm_ptr: The offset of the variable in the frame.
+        """
+        if not self._optimize or self._check_only:
+            return
+
+        size = int(id_size) if id_size is not None else 1
+        self._frames[-1]['vars'].append(((id_location, name), size, mm_ptr))
+
+        return
+
+    def _add_frame_reference(self, id_obj, id_location, id_reg):
+        """Add Frame Reference (Protected)
+
+        Records the code which loads the frame offset of a variable, so that
+        the offset may be changed once the frame is packed.
+
+        Arguments:
+            id_obj: The Identifier class object containing id data.
+            id_location: Either 'global' or 'local'.
+            id_reg: The register the offset is loaded into.
+        """
+        if not self._optimize or self._check_only:
+            return
+
+        # Globals live in the frame of the program
+        frame = self._frames[0] if id_location == 'global' else self._frames[-1]
+        frame['refs'].append((len(self._generated_code), id_reg,
+                              (id_location, id_obj.name)))
+
+        return
+
+    def generate_frame_allocation(self, size, debug):
+        """Generate Frame Allocation
+
+        Generates the code which makes space for the local variables of the
+        procedure being generated. Procedures then check that the stack has
+        not come too close to the heap.
+
+        Arguments:
+            size: The total size of the local variables.
+            debug: Determines if comments should be written to the code.
+        """
+        # No frames are opened in check-only mode
+        if self._check_only:
+            return
+
+        self._frames[-1]['size'] = size
+
+        if size != 0:
+            self.comment('Allocating space for local variables', debug)
+
+            if self._optimize:
+                self._frames[-1]['alloc'] = len(self._generated_code)
+
+            self.generate('R[SP] = R[SP] - %d;' % size)
+
+        # The program frame always fits, as memory is sized for it
+        if len(self._frames) > 1:
+            self.generate('if (R[SP] < R[HP] + STACK_GAP) '
+                          'goto stack_overflow;')
+
+        return
+
+    def discard_code(self, start):
+        """Discard Code
+
+        Drops all code generated since the given point, such as the code of
+        a statement which can never run.
+
+        Arguments:
+            start: The length of the generated code buffer to go back to.
+        """
+        del self._generated_code[start:]
+        del self._generated_lines[start:]
+
+        self._calls = [call for call in self._calls if call[0] < start]
+
+        for frame in self._frames:
+            frame['refs'] = [ref for ref in frame['refs'] if ref[0] < start]
+
+        return
+
+    def _drop_code(self, index):
+        """Drop Code (Protected)
+
+        Drops one entry of generated code, moving back the positions of the
+        calls and variable references recorded after it.
+
+        Arguments:
+            index: The index of the entry in the generated code buffer.
+        """
+        del self._generated_code[index]
+        del self._generated_lines[index]
+
+        # Positions are recorded in order, so only the last ones move
+        for records in [self._calls] + [frame['refs']
+                                        for frame in self._frames]:
+            for position in range(len(records) - 1, -1, -1):
+                if records[position][0] <= index:
+                    break
+                records[position] = ((records[position][0] - 1,) +
+                                     records[position][1:])
+
+        return
+
+    def eliminate_dead_code(self):
+        """Eliminate Dead Code
+
+        Drops the code of every procedure which is never called from the
+        program, directly or through other procedures, and packs the stack
+        frames so that variables which are never used take no space. The
+        runtime functions which are never called are left out of the footer.
+        This must be called once the program has been generated, before the
+        footer.
+        """
+        if not self._optimize or self._check_only:
+            return
+
+        program = self._program_label
+
+        callees = {}
+        for _, caller, callee in self._calls:
+            callees.setdefault(caller, set()).add(callee)
+
+        # Find every procedure reachable from the program
+        live = {program}
+        pending = [program]
+        while pending:
+            for callee in callees.get(pending.pop(), ()):
+                if callee not in live:
+                    live.add(callee)
+                    pending.append(callee)
+
+        # Mark the code of every procedure which is never called
+        dead = bytearray(len(self._generated_code))
+        for label, (start, end) in self._procedures.items():
+            if label not in live:
+                dead[start:end] = b'\x01' * (end - start)
+
+        for frame in self._closed_frames:
+            self._pack_frame(frame, dead)
+
+        # Only keep the code which is still live
+        self._generated_code = [code for index, code in
+                                enumerate(self._generated_code)
+                                if not dead[index]]
+        self._generated_lines = [line for index, line in
+                                 enumerate(self._generated_lines)
+                                 if not dead[index]]
+
+        self._runtime_used = set(name for name in self.runtime_functions
+                                 if '%s_1' % name in live)
+
+        return
+
+    def optimize_code(self):
+        """Optimize Code
+
+        Runs the optimization passes over the generated code of the whole
+        program. This must be called once dead code has been eliminated,
+        before the footer.
+        """
+        if not self._optimize or self._check_only:
+            return
+
+        optimizer = CodeOptimizer(self._generated_code, self._generated_lines,
+                                  self.get_reg, self.get_label_id,
+                                  self.get_unique_call_id)
+
+        # Procedures which no longer call themselves need only one frame
+        looped = optimizer.eliminate_tail_calls()
+        self._calls = [call for call in self._calls
+                       if call[1] != call[2] or call[1] not in looped]
+
+        self.inline_report = optimizer.inline_procedures(self._inline_size)
+        optimizer.eliminate_common_subexpressions()
+        optimizer.hoist_loop_invariants()
+        optimizer.reduce_induction_variables()
+
+        return
+
+    def render_inline_report(self):
+        """Render Inline Report
+
+        Returns:
+            A line for each call considered for inlining, saying whether the
+            procedure was inlined and if not, why not.
+        """
+        report = []
+        for record in self.inline_report:
+            if record.reason is None:
+                report.append('Line %s: inlined %s (%d entries)\n' %
+                              (record.line, record.name, record.size))
+            else:
+                report.append('Line %s: did not inline %s (%s)\n' %
+                              (record.line, record.name, record.reason))
+
+        return ''.join(report)
+
+    def _pack_frame(self, frame, dead):
+        """Pack Frame (Protected)
+
+        Gives the variables of a stack frame which are used by live code new
+        offsets next to each other, and shrinks the frame to fit them.
+
+        Arguments:
+            frame: The stack frame to pack.
+            dead: Marks every entry of the generated code which is dropped.
+        """
+        refs = [ref for ref in frame['refs'] if not dead[ref[0]]]
+        used = set(key for _, _, key in refs)
+
+        # Leave the frame as it is if a use can not be matched to a variable
+        if not used.issubset(key for key, _, _ in frame['vars']):
+            return
+
+        offsets = {}
+        size = 0
+        for key, var_size, _ in frame['vars']:
+            if key in used:
+                offsets[key] = size + 1
+                size += var_size
+
+        for index, id_reg, key in refs:
+            self._replace_code(index, 'R[%d] = %d;' % (id_reg, offsets[key]))
+
+        frame['size'] = size
+
+        index = frame['alloc']
+        if index is not None:
+            if size != 0:
+                self._replace_code(index, 'R[SP] = R[SP] - %d;' % size)
+            else:
+                dead[index] = 1
+
+        return
+
+    def _replace_code(self, index, code):
+        """Replace Code (Protected)
+
+        Replaces an entry of the generated code, keeping its indentation.
+
+        Arguments:
+            index: The index of the entry in the generated code buffer.
+            code: The new code of the entry.
+        """
+        entry = self._generated_code[index]
+        indent = entry[:len(entry) - len(entry.lstrip())]
+        self._generated_code[index] = indent + code
+
+        return
+
+    def _memory_sizes(self):
+        """Memory Sizes (Protected)
+
+        Works out the memory the program needs. Registers are never reused,
+        so the register count is the number of registers allocated. The
+        stack must hold the deepest chain of calls made by the program.
+
+        Returns:
+            A (main memory, register, heap, stack gap) tuple of sizes in
+            words.
+        """
+        reg_size = self._reg + 1
+        costs = self._frame_costs()
+
+        # The heap is only needed if strings are ever read
+        heap_size = 0
+        if any(callee == 'getstr_1' for _, _, callee in self._calls):
+            heap_size = self._heap_size
+
+        sizes = None
+        if self._program_label is not None:
+            sizes = self._stack_depth(costs)
+
+        # Fall back to the default sizes if a call could not be followed,
+        # such as a call to a procedure reused from the code cache
+        if sizes is None:
+            return self._mm_size, max(reg_size, self._reg_size), heap_size, 1024
+
+        depth, recursive = sizes
+
+        # Any frame pushed onto the stack must fit in the gap
+        stack_gap = max(costs.values())
+        mm_size = heap_size + stack_gap + depth + 1
+
+        # Recursion may go deeper than it was counted, which the default
+        # sizes allowed for
+        if recursive and not self._recursion_depth_given:
+            mm_size = max(mm_size, self._mm_size)
+            reg_size = max(reg_size, self._reg_size)
+
+        return mm_size, reg_size, heap_size, stack_gap
+
+    def _frame_costs(self):
+        """Frame Costs (Protected)
+
+        Returns:
+            A dict mapping the label of every procedure, program and runtime
+            function to the stack space taken by one call of it. That is the
+            parameters, the caller FP, the return address and the local
+            variables.
+        """
+        costs = dict(('%s_1' % name, len(params) + 2)
+                     for name, params in self.runtime_functions.items())
+
+        for frame in self._closed_frames:
+            costs[frame['label']] = frame['params'] + 2 + frame['size']
+
+        return costs
+
+    def _stack_depth(self, costs):
+        """Stack Depth (Protected)
+
+        Finds the deepest the stack may get. Procedures calling each other
+        are counted as nested recursion_depth times.
+
+        Arguments:
+            costs: The stack space taken by one call of each procedure.
+
+        Returns:
+            A (depth, recursive) tuple holding the stack depth in words and
+            whether any procedures call each other, or None if a call could
+            not be followed.
+        """
+        callees = {}
+        for _, caller, callee in self._calls:
+            if callee not in costs:
+                return None
+            callees.setdefault(caller, set()).add(callee)
+
+        # Find every procedure reachable from each procedure
+        reach = {}
+        for label in costs:
+            seen = set()
+            pending = [label]
+            while pending:
+                for callee in callees.get(pending.pop(), ()):
+                    if callee not in seen:
+                        seen.add(callee)
+                        pending.append(callee)
+            reach[label] = seen
+
+        # A procedure reaches more than every procedure it calls, apart from
+        # the ones which call it back, so these come first in this order
+        depth = {}
+        recursive = False
+        for label in sorted(costs, key=lambda l: len(reach[l] | {l})):
+            if label in depth:
+                continue
+
+            # Procedures calling each other share one depth
+            cycle = [other for other in reach[label] if label in reach[other]]
+            members = cycle or [label]
+
+            cost = max(costs[member] for member in members)
+            if cycle:
+                cost *= self._recursion_depth
+                recursive = True
+
+            deeper = [depth[callee] for member in members
+                      for callee in callees.get(member, ())
+                      if callee not in members]
+
+            for member in members:
+                depth[member] = cost + max(deeper, default=0)
+
+        return depth[self._program_label], recursive
+
     def get_mm(self, id_size, is_param=False):
         """Get Memory Space
 
@@ -337,7 +1526,8 @@ class CodeGenerator:
             referenced as follows: R[<reg_num>]
         """
         # Increment the register if we're getting a brand new one
-        self._reg += 1 if inc else 0
+        if inc and not self._check_only:
+            self._reg += 1
 
         return self._reg
 
@@ -350,6 +1540,9 @@ class CodeGenerator:
         Returns:
             A label id to append to the procedure label.
         """
+        if self._check_only:
+            return self._label_id
+
         self._label_id += 1
 
         return self._label_id
@@ -363,10 +1556,111 @@ class CodeGenerator:
         Returns:
             A unique id to append to the procedure return label.
         """
+        if self._check_only:
+            return self._unique_id
+
         self._unique_id += 1
 
         return self._unique_id
 
+    def add_profile_slot(self, kind, name, scope, line, label=None):
+        """Add Profile Slot
+
+        Registers a region of the program to be profiled. Nothing is
+        registered if profiling is disabled.
+
+        Arguments:
+            kind: The kind of region ('program', 'function', 'runtime' or
+                'loop').
+            name: The RDDS name of the region.
+            scope: The name of the scope enclosing the region.
+            line: The source line of the region, or None if it has none.
+            label: The (name, label id) pair of the procedure owning this
+                region, used to find the slot at call sites. (Default: None)
+
+        Returns:
+            The slot number of the region, or None if not profiling.
+        """
+        if self._profile_path is None:
+            return None
+
+        slot = len(self._profile_slots)
+        self._profile_slots.append((kind, name, scope, line))
+
+        if label is not None:
+            self._profile_labels[label] = slot
+
+        return slot
+
+    def generate_profile_count(self, slot):
+        """Generate Profile Count
+
+        Generates code to increment the counter of a profile slot.
+
+        Arguments:
+            slot: The profile slot to count, or None if not profiling.
+        """
+        if slot is not None:
+            self.generate('PROF_COUNT[%d]++;' % slot)
+
+        return
+
+    def generate_profile_enter(self, slot):
+        """Generate Profile Enter
+
+        Generates code to start the timer of a profile slot.
+
+        Arguments:
+            slot: The profile slot to time, or None if not profiling.
+        """
+        if slot is not None:
+            self.generate('PROF_ENTER(%d)' % slot)
+
+        return
+
+    def generate_profile_exit(self, slot):
+        """Generate Profile Exit
+
+        Generates code to stop the timer of a profile slot and accumulate
+        the elapsed time and cycles.
+
+        Arguments:
+            slot: The profile slot to time, or None if not profiling.
+        """
+        if slot is not None:
+            self.generate('PROF_EXIT(%d)' % slot)
+
+        return
+
+    def open_profile_loop(self, slot):
+        """Open Profile Loop
+
+        Starts timing a loop. The loop is remembered so that a return from
+        inside of it still stops its timer.
+
+        Arguments:
+            slot: The profile slot of the loop, or None if not profiling.
+        """
+        if slot is not None:
+            self.generate_profile_enter(slot)
+            self._profile_loops.append(slot)
+
+        return
+
+    def close_profile_loop(self, slot):
+        """Close Profile Loop
+
+        Stops timing the innermost open loop.
+
+        Arguments:
+            slot: The profile slot of the loop, or None if not profiling.
+        """
+        if slot is not None:
+            self._profile_loops.pop()
+            self.generate_profile_exit(slot)
+
+        return
+
     def generate_program_entry(self, program_name, program_num, debug):
         """Generate Program Entry
 
@@ -385,6 +1679,12 @@ class CodeGenerator:
         self.generate('MM[R[FP]] = (int)&&%s_%d_finish;' %
                       (program_name, program_num))
 
+        # Start profiling the program as a whole
+        slot = self._profile_labels.get((program_name, program_num))
+        if slot is not None:
+            self.generate_profile_count(slot)
+            self.generate_profile_enter(slot)
+
         # Make the jump to the entry point
         self.generate('goto %s_%d_body;' % (program_name, program_num))
 
@@ -393,7 +1693,13 @@ class CodeGenerator:
         self.comment('Creating the program exit point', debug)
         self.generate('%s_%d_finish:' % (program_name, program_num))
         self.tab_push()
-        self.generate('return 0;')
+
+        # The profile must be written out before the program exits
+        if self._profile_path is not None:
+            self.generate('goto prof_dump;')
+        else:
+            self.generate('return 0;')
+
         self.tab_pop()
         self.generate('')
 
@@ -411,6 +1717,10 @@ class CodeGenerator:
             procedure_num: The label id of the procedure to call.
             debug: Determines if comments should be written to the code.
         """
+        # Calls are only recorded for code which is generated
+        if self._check_only:
+            return
+
         # Save the FP to the stack. Set next FP to return address
         self.comment('Setting caller FP', debug)
         self.generate('R[SP] = R[SP] - 1;')
@@ -426,12 +1736,33 @@ class CodeGenerator:
         self.generate('MM[R[SP]] = (int)&&%s_%d_%d;' %
                 (procedure_name, procedure_num, call_number))
                 
+        # Count and time the call if the program is being profiled
+        slot = None
+        if self._profile_path is not None:
+            slot = self._profile_labels.get((procedure_name, procedure_num))
+            if slot is None:
+                slot = self.add_profile_slot('runtime', procedure_name,
+                                             'runtime', None,
+                                             label=(procedure_name,
+                                                    procedure_num))
+            self.generate_profile_count(slot)
+            self.generate_profile_enter(slot)
+
+        # Remember the call so that procedures never called can be dropped,
+        # and the stack depth of the program can be worked out
+        self._calls.append((len(self._generated_code),
+                            self._open_procedures[-1],
+                            '%s_%d' % (procedure_name, procedure_num)))
+
         # Make the jump to the function call
         self.generate('goto %s_%d;' % (procedure_name, procedure_num))
 
         # Generate the return label
         self.generate('%s_%d_%d:' % (procedure_name, procedure_num, call_number))
 
+        if slot is not None:
+            self.generate_profile_exit(slot)
+
         # The SP now points to the return address. Restore the old FP
         self.comment('Restore caller FP', debug)
         self.generate('R[SP] = R[SP] + 1;')
@@ -479,6 +1810,10 @@ class CodeGenerator:
         # Get a new register to calculate the main memory address of this id
         id_reg = self.get_reg()
 
+        # Variables may be moved in their frame once all their uses are known
+        if id_location != 'param':
+            self._add_frame_reference(id_obj, id_location, id_reg)
+
         self.generate('R[%d] = %d;' % (id_reg, id_obj.mm_ptr))
 
         if id_obj.size is not None and idx_reg is not None:
@@ -635,6 +1970,10 @@ class CodeGenerator:
         Arguments:
             debug: Determines if comments should be displayed or not.
         """
+        # Leaving the scope also leaves all of its profiled loops
+        for slot in reversed(self._profile_loops):
+            self.generate_profile_exit(slot)
+
         # Smash the local stack
         self.comment('Moving SP to FP (return address)', debug)
         self.generate('R[SP] = R[FP];')
@@ -645,6 +1984,113 @@ class CodeGenerator:
 
         return
 
+    def generate_branch(self, reg, label):
+        """Generate Branch
+
+        Generates code to jump to the label if the condition in the register
+        is false. If the code just generated stores a comparison in the
+        register, the comparison is branched on directly instead, so that
+        its result is never stored.
+
+        Arguments:
+            reg: The register holding the condition. It must not be read by
+                any other code.
+            label: The label to jump to.
+        """
+        # The branch may rewrite the entry generated last
+        if self._check_only:
+            return
+
+        match = self._last_comparison(reg)
+
+        if match:
+            self._replace_code(len(self._generated_code) - 1,
+                               'if (%s %s %s) goto %s;' % (
+                                   match.group(2),
+                                   self.negated_comparisons[match.group(3)],
+                                   match.group(4), label))
+        else:
+            self.generate('if (!R[%d]) goto %s;' % (reg, label))
+
+        return
+
+    def open_short_circuit(self, reg, type1, operation):
+        """Open Short Circuit
+
+        Generates code to skip the right operand of "&" or "|" on bools if
+        the left operand decides the result, which is then the left operand.
+
+        Arguments:
+            reg: The register of the left operand.
+            type1: The type of the left operand.
+            operation: The operation symbol.
+
+        Returns:
+            A (label id, index) tuple of the label skipped to and the entry
+            skipping to it, or None if the right operand is always worked
+            out.
+        """
+        if (not self._short_circuit or self._check_only or
+                type1 != 'bool' or operation not in ('&', '|')):
+            return None
+
+        label_id = self.get_label_id()
+
+        # False decides "&" and true decides "|"
+        test = '!' if operation == '&' else ''
+        self.generate('if (%sR[%d]) goto skip_%d;' % (test, reg, label_id))
+
+        return label_id, len(self._generated_code) - 1
+
+    def close_short_circuit(self, reg1, reg2, type2, operation, skip):
+        """Close Short Circuit
+
+        Generates the operation opened by open_short_circuit(), with the
+        skipped code joining it. If the right operand is not a bool, the
+        skip is dropped and the operation works on every bit as usual.
+
+        Arguments:
+            reg1: The register of the first operand.
+            reg2: The register of the second operand.
+            type2: The type of the second operand.
+            operation: The operation symbol.
+            skip: The tuple returned by open_short_circuit().
+
+        Returns:
+            The register number where the result of the operation
+            is stored.
+        """
+        label_id, index = skip
+
+        if type2 != 'bool':
+            self._drop_code(index)
+            return self.generate_operation(reg1, 'bool', reg2, type2,
+                                           operation)
+
+        # Both ways into the label leave the result in the first operand
+        self.generate('R[%d] = R[%d] %s R[%d];' % (reg1, reg1, operation,
+                                                   reg2))
+        self.generate('skip_%d:' % label_id)
+
+        result = self.get_reg()
+        self.generate('R[%d] = R[%d];' % (result, reg1))
+
+        return result
+
+    def _last_comparison(self, reg):
+        """Last Comparison (Protected)
+
+        Returns:
+            The match of the last generated entry if it stores a comparison
+            in the register, otherwise None.
+        """
+        match = self._comparison_re.match(self._generated_code[-1].strip())
+
+        if match and int(match.group(1)) == reg:
+            return match
+
+        return None
+
     def generate_operation(self, reg1, type1, reg2, type2, operation):
         """Generate Operation
 
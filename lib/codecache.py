@@ -0,0 +1,261 @@
+"""Code Cache module
+
+Provides a cache of the code generated for each procedure, so that unchanged
+procedures are not generated again when a program is recompiled after an
+edit. The cache may be kept in memory between compiles or saved to a file.
+
+Cached code is stored as a template. The labels, call numbers and registers
+allocated while generating the procedure are stored relative to the counters
+at the start of the procedure, and the labels of called global procedures
+are stored by name, so the code can be reused at any place in any program.
+
+Author: RDDS TEAM
+
+Classes:
+    CodeCache: Stores generated procedure code by key.
+
+Functions:
+    cache_key: Builds the cache key of a procedure.
+    make_template: Turns generated code into a relocatable template.
+    fill_template: Turns a template back into generated code.
+"""
+
+import hashlib
+import json
+import os
+import re
+
+# Matches string literals (which are never changed), registers and names
+_CODE_RE = re.compile(r'"(?:[^"\\]|\\.)*"|R\[(\d+)\]|\b([A-Za-z_]\w*)\b')
+
+# Matches the part of a label after its name: the label id, then either
+# the body suffix or a call number
+_LABEL_RE = re.compile(r'(\d+)(_body|_(\d+))?$')
+
+# Matches the placeholders of a template
+_HOLE_RE = re.compile(r'@([LCR])(\d+)@|@F:(\w+)@|@@')
+
+# Label names which do not belong to a procedure
+_STATEMENT_LABELS = ('else', 'endif', 'loop', 'endloop', 'skip')
+
+
+class CodeCache:
+    """Code Cache
+
+    Stores the templates of generated procedure code by key. If a path is
+    given, the cache is read from it when created and written back to it by
+    save().
+    """
+    def __init__(self, path=None):
+        super().__init__()
+
+        # Holds the file path of the cache. If None, it is kept in memory
+        self._path = path
+
+        # Holds all cached entries by key
+        self._entries = {}
+
+        # Holds the entries put since the cache was created, by key
+        self._added = {}
+
+        # Holds the number of lookups which found and missed an entry
+        self.hits = 0
+        self.misses = 0
+
+        if path is not None:
+            try:
+                with open(path) as f:
+                    self._entries = json.load(f)
+            except (IOError, ValueError):
+                self._entries = {}
+
+        return
+
+    def get(self, key):
+        """Get Entry
+
+        Arguments:
+            key: The cache key of the procedure.
+
+        Returns:
+            The cached entry, or None if there is none.
+        """
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return entry
+
+    def put(self, key, entry):
+        """Put Entry
+
+        Arguments:
+            key: The cache key of the procedure.
+            entry: A JSON serializable dictionary describing the procedure.
+        """
+        self._entries[key] = entry
+        self._added[key] = entry
+
+        return
+
+    def added(self):
+        """Added Entries
+
+        Returns:
+            A dictionary of the entries put since the cache was created, by
+            key. Batch mode collects these from each compile and saves them
+            all at once.
+        """
+        return dict(self._added)
+
+    def save(self):
+        """Save Cache
+
+        Writes the cache to its file, if it has one.
+
+        Returns:
+            True on success, False otherwise.
+        """
+        if self._path is None:
+            return True
+
+        # Write to a temporary file first, so that compiles running at once
+        # never read a half written cache
+        tmp_path = '%s.%d.tmp' % (self._path, os.getpid())
+
+        try:
+            with open(tmp_path, 'w+') as f:
+                json.dump(self._entries, f)
+
+            os.replace(tmp_path, self._path)
+        except (IOError, OSError) as e:
+            print('Error: "%s"' % self._path)
+            print('    Could not write code cache: %s' % e.strerror)
+            return False
+
+        return True
+
+
+def cache_key(tokens, env):
+    """Cache Key
+
+    Builds the cache key of a procedure from its tokens and from everything
+    outside of it the generated code depends on.
+
+    Arguments:
+        tokens: All tokens of the procedure declaration.
+        env: A JSON serializable description of the state the procedure is
+            parsed in, such as the signatures of the global names it uses.
+
+    Returns:
+        The key as a string.
+    """
+    data = json.dumps([[(t.type, t.value) for t in tokens], env])
+
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def make_template(code, bases, counts, names, callees):
+    """Make Template
+
+    Turns generated code into a template by replacing every allocated
+    label, call number and register with a placeholder.
+
+    Arguments:
+        code: The list of generated code entries.
+        bases: The (label, call, register) counters before the code was
+            generated.
+        counts: The number of labels, call numbers and registers allocated
+            while generating the code.
+        names: All names used in the procedure.
+        callees: Maps the names of called global procedures to their labels.
+
+    Returns:
+        The list of template entries, or None if the code can not be turned
+        into a template.
+    """
+    prefixes = set(names) | set(_STATEMENT_LABELS)
+    template = []
+
+    def replace(match):
+        literal = match.group(0)
+
+        if literal.startswith('"'):
+            return literal
+
+        if match.group(1) is not None:
+            register = int(match.group(1)) - bases[2]
+            if not 0 < register <= counts[2]:
+                raise ValueError(literal)
+
+            return 'R[@R%d@]' % register
+
+        # Find every way this name can be read as a label
+        readings = set()
+        for prefix in prefixes:
+            if not literal.startswith(prefix + '_'):
+                continue
+
+            label = _LABEL_RE.match(literal, len(prefix) + 1)
+            if label is None:
+                continue
+
+            label_id = int(label.group(1))
+            if callees.get(prefix) == label_id:
+                reading = '%s_@F:%s@' % (prefix, prefix)
+            elif 0 < label_id - bases[0] <= counts[0]:
+                reading = '%s_@L%d@' % (prefix, label_id - bases[0])
+            else:
+                continue
+
+            if label.group(3) is not None:
+                call = int(label.group(3)) - bases[1]
+                if not 0 < call <= counts[1]:
+                    continue
+                reading += '_@C%d@' % call
+            elif label.group(2) is not None:
+                reading += label.group(2)
+
+            readings.add(reading)
+
+        if len(readings) > 1:
+            raise ValueError(literal)
+
+        return readings.pop() if readings else literal
+
+    try:
+        for entry in code:
+            template.append(_CODE_RE.sub(replace, entry.replace('@', '@@')))
+    except ValueError:
+        return None
+
+    return template
+
+
+def fill_template(template, bases, callees):
+    """Fill Template
+
+    Turns a template back into generated code.
+
+    Arguments:
+        template: The list of template entries.
+        bases: The (label, call, register) counters before the code.
+        callees: Maps the names of called global procedures to their labels.
+
+    Returns:
+        The list of generated code entries.
+    """
+    offsets = {'L': bases[0], 'C': bases[1], 'R': bases[2]}
+
+    def replace(match):
+        if match.group(1) is not None:
+            return str(offsets[match.group(1)] + int(match.group(2)))
+        elif match.group(3) is not None:
+            return str(callees[match.group(3)])
+
+        return '@'
+
+    return [_HOLE_RE.sub(replace, entry) for entry in template]
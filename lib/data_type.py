@@ -7,39 +7,132 @@ Author: RDDS TEAM
 
 Classes:
     Token: A named tuple object containing token information.
-    Identifier: A named tuple object containing identifier information.
-    Parameter: A named tuple object containing procedure param information.
-    IdentifierTable: Extends the list type to provide ID table functionality.
+    Identifier: A compact object containing identifier information.
+    Parameter: A compact object containing procedure param information.
+    IdentifierTable: Provides ID table functionality over a list of scopes.
 """
 
 from lib.errors import ParserNameError
 from collections import namedtuple
 
-Token = namedtuple('Token', ['type', 'value', 'line'])
+Token = namedtuple('Token', ['type', 'value', 'line', 'column'])
 
-Identifier = namedtuple('Identifier',
-        ['name', 'type', 'size', 'params', 'mm_ptr'])
 
-Parameter = namedtuple('Parameter', ['id', 'direction'])
+class Identifier:
+    """Identifier
 
+    Holds the details of a declared name. Identifiers are shared between
+    scopes and between parsers, so they are never changed once created;
+    _replace() returns a changed copy instead.
 
-class IdentifierTable(list):
+    The storage class ('global', 'local' or 'param') and param direction of
+    an identifier are filled in when it is added to an IdentifierTable.
+    """
+    __slots__ = ('name', 'type', 'size', 'params', 'mm_ptr', 'storage',
+                 'direction')
 
-    def __init__(self):
+    def __init__(self, name, type, size, params, mm_ptr, storage=None,
+                 direction=None):
+        # The params are kept in a tuple so that they cannot change either
+        if params is not None:
+            params = tuple(params)
+
+        values = (name, type, size, params, mm_ptr, storage, direction)
+
+        # Fields are only set here, __setattr__() refuses any later change
+        for field, value in zip(self.__slots__, values):
+            object.__setattr__(self, field, value)
+
+        return
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Identifier is immutable, use _replace()')
+
+    def __delattr__(self, name):
+        raise AttributeError('Identifier is immutable, use _replace()')
+
+    def _replace(self, **changes):
+        """Replace Fields
+
+        Arguments:
+            changes: The new values of the fields to change, by name.
+
+        Returns:
+            A new Identifier with the given fields changed.
+        """
+        fields = {field: getattr(self, field) for field in self.__slots__}
+        fields.update(changes)
+
+        return Identifier(**fields)
+
+    def __eq__(self, other):
+        if not isinstance(other, Identifier):
+            return NotImplemented
+
+        return all(getattr(self, field) == getattr(other, field)
+                   for field in self.__slots__)
+
+    def __repr__(self):
+        return 'Identifier(%s)' % ', '.join('%s=%r' % (field,
+                                            getattr(self, field))
+                                            for field in self.__slots__)
+
+
+class Parameter:
+    """Parameter
+
+    Holds the identifier and direction ('in' or 'out') of a procedure param.
+    Like an Identifier, a Parameter is never changed once created.
+    """
+    __slots__ = ('id', 'direction')
+
+    def __init__(self, id, direction):
+        object.__setattr__(self, 'id', id)
+        object.__setattr__(self, 'direction', direction)
+
+        return
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Parameter is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('Parameter is immutable')
+
+    def __eq__(self, other):
+        if not isinstance(other, Parameter):
+            return NotImplemented
+
+        return self.id == other.id and self.direction == other.direction
+
+    def __repr__(self):
+        return 'Parameter(id=%r, direction=%r)' % (self.id, self.direction)
+
+
+class IdentifierTable:
+
+    def __init__(self, global_scope=None):
         super().__init__()
 
-        # Create the global scope
-        self.append({})
+        # Create the global scope. A given global scope may be shared with
+        # other tables, so it is only copied once a name is added to it
+        self._scopes = [global_scope if global_scope is not None else {}]
+        self._shared_global = global_scope is not None
 
         # Create a list of scope parent names (the owner of the scope)
         self._owner_ids = ['global']
 
         return
 
+    def __len__(self):
+        return len(self._scopes)
+
+    def __getitem__(self, index):
+        return self._scopes[index]
+
     def push_scope(self, owner_id):
 
         # Create a brand new scope for the identifiers table
-        self.append({})
+        self._scopes.append({})
 
         # Save the owner of this scope for future lookup
         self._owner_ids.append(owner_id)
@@ -49,14 +142,14 @@ class IdentifierTable(list):
     def pop_scope(self):
 
         # Remove this entire scope from the identifiers table
-        self.pop(-1)
+        self._scopes.pop()
 
         # Remove the identifier from the owner list
         self._owner_ids.pop()
 
         return
 
-    def add(self, identifier, is_global=False):
+    def add(self, identifier, is_global=False, direction=None):
         scope = -1 if not is_global else 0
 
         if is_global and len(self) > 2:
@@ -69,57 +162,54 @@ class IdentifierTable(list):
         if not is_global and identifier.name in self[-1]:
             raise ParserNameError('name already declared at this scope')
 
-        self[scope][identifier.name] = identifier
+        # Record where the identifier is stored so that references to it need
+        # only one lookup
+        if direction is not None:
+            storage = 'param'
+        elif is_global or len(self) == 1:
+            storage = 'global'
+        else:
+            storage = 'local'
+
+        # Copy a shared global scope before changing it
+        if scope == 0 or len(self) == 1:
+            self._own_global_scope()
+
+        self[scope][identifier.name] = identifier._replace(storage=storage,
+                                                           direction=direction)
+
+        return
+
+    def _own_global_scope(self):
+        if self._shared_global:
+            self._scopes[0] = dict(self._scopes[0])
+            self._shared_global = False
 
         return
 
     def find(self, name):
+        scopes = self._scopes
 
-        if name in self[-1]:
-            identifier = self[-1][name]
-        elif name in self[0]:
-            identifier = self[0][name]
+        if name in scopes[-1]:
+            identifier = scopes[-1][name]
+        elif name in scopes[0]:
+            identifier = scopes[0][name]
         else:
             raise ParserNameError()
 
         return identifier
 
     def get_id_location(self, name):
-
-        if self.is_global(name):
-            return 'global'
-        elif self.is_param(name):
-            return 'param'
-
-        return 'local'
+        return self.find(name).storage
 
     def is_global(self, name):
         return name in self[0]
 
     def is_param(self, name):
-        owner = self.get_current_scope_owner()
-
-        if owner == 'global' or not owner.params:
-            return False
-
-        for param in owner.params:
-            if name == param.id.name:
-                return True
-
-        return False
+        return self.find(name).storage == 'param'
 
     def get_param_direction(self, name):
-
-        owner = self.get_current_scope_owner()
-        
-        if owner == 'global':
-            return None
-
-        for param in owner.params:
-            if name == param.id.name:
-                return param.direction
-
-        return None
+        return self.find(name).direction
 
     def get_current_scope_owner(self):
         owner = self._owner_ids[-1]
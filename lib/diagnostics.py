@@ -0,0 +1,201 @@
+"""Diagnostics module
+
+Collects the warnings and errors found while scanning and parsing a source
+file. Diagnostics are stored as structured records and only rendered, as
+text or JSON, once compilation has finished.
+
+Author: RDDS TEAM
+
+Classes:
+    Diagnostic: A named tuple object containing a single diagnostic.
+    DiagnosticCollector: Stores diagnostics and renders them as a report.
+"""
+
+import json
+from collections import namedtuple
+
+from lib.errors import DiagnosticLimitError
+
+Diagnostic = namedtuple('Diagnostic',
+        ['severity', 'code', 'line', 'column', 'message'])
+
+
+class DiagnosticCollector:
+    """Diagnostic Collector
+
+    Stores every diagnostic reported during compilation. An optional error
+    cap aborts compilation once too many errors have been found.
+    """
+    def __init__(self, max_errors=None):
+        super().__init__()
+
+        # Holds all diagnostics in the order they were reported
+        self.records = []
+
+        # Holds the number of errors and warnings reported
+        self.error_count = 0
+        self.warning_count = 0
+
+        # Holds the number of errors after which compilation is aborted. If
+        # None, compilation is never aborted
+        self.max_errors = max_errors
+
+        return
+
+    def add(self, severity, code, line, message, column=None):
+        """Add Diagnostic
+
+        Stores a new diagnostic record.
+
+        Arguments:
+            severity: Either 'error' or 'warning'.
+            code: A short name for the kind of diagnostic, e.g. 'type-error'.
+            line: The source line of the diagnostic.
+            message: The diagnostic message.
+            column: The 1-based source column, or None if unknown.
+                (Default: None)
+
+        Raises:
+            DiagnosticLimitError: If this error reaches the error cap.
+        """
+        self.records.append(Diagnostic(severity, code, line, column, message))
+
+        if severity == 'error':
+            self.error_count += 1
+
+            if (self.max_errors is not None and
+                    self.error_count >= self.max_errors):
+                raise DiagnosticLimitError()
+        else:
+            self.warning_count += 1
+
+        return
+
+    def detach(self, start):
+        """Detach Diagnostics
+
+        Removes the most recent diagnostics so that they may be reported
+        again later with attach().
+
+        Arguments:
+            start: The number of diagnostics to keep.
+
+        Returns:
+            The list of removed diagnostics.
+        """
+        detached = self.records[start:]
+        del self.records[start:]
+
+        for record in detached:
+            if record.severity == 'error':
+                self.error_count -= 1
+            else:
+                self.warning_count -= 1
+
+        return detached
+
+    def attach(self, records):
+        """Attach Diagnostics
+
+        Reports diagnostics which were removed with detach() again.
+
+        Arguments:
+            records: The list of diagnostics to report.
+        """
+        for record in records:
+            self.add(record.severity, record.code, record.line,
+                     record.message, column=record.column)
+
+        return
+
+    def has_errors(self):
+        """Has Errors
+
+        Returns:
+            True if any error has been reported, False otherwise.
+        """
+        return self.error_count != 0
+
+    def is_aborted(self):
+        """Is Aborted
+
+        Returns:
+            True if the error cap has been reached, False otherwise.
+        """
+        return (self.max_errors is not None and
+                self.error_count >= self.max_errors)
+
+    def render(self, fmt, src_path, src_lines):
+        """Render Diagnostics
+
+        Renders all diagnostics in the given format.
+
+        Arguments:
+            fmt: Either 'text' or 'json'.
+            src_path: The path of the source file.
+            src_lines: The lines of the source file, used to quote the
+                offending line in text reports.
+
+        Returns:
+            The rendered report as a string.
+        """
+        if fmt == 'json':
+            return self.render_json(src_path)
+
+        return self.render_text(src_path, src_lines)
+
+    def render_text(self, src_path, src_lines):
+        """Render Text
+
+        Renders all diagnostics as a human readable report. Each diagnostic
+        quotes its source line and, if the column is known, points at it.
+
+        Arguments:
+            src_path: The path of the source file.
+            src_lines: The lines of the source file.
+
+        Returns:
+            The rendered report as a string.
+        """
+        out = []
+
+        for record in self.records:
+            prefix = 'Error' if record.severity == 'error' else 'Warning'
+            out.append('%s: "%s", line %d' % (prefix, src_path, record.line))
+            out.append('    %s' % record.message)
+
+            line = ''
+            if 0 < record.line <= len(src_lines):
+                line = src_lines[record.line-1].rstrip('\n')
+
+            stripped = line.strip()
+            out.append('    %s' % stripped)
+
+            if record.column is not None and stripped:
+                left_spaces = line.find(stripped[0])
+                out.append('    %s^' %
+                           (' '*abs(record.column-1-left_spaces)))
+
+        if self.is_aborted():
+            out.append('Stopped after %d error(s)' % self.error_count)
+
+        return '\n'.join(out) + '\n' if out else ''
+
+    def render_json(self, src_path):
+        """Render JSON
+
+        Renders all diagnostics as a JSON document.
+
+        Arguments:
+            src_path: The path of the source file.
+
+        Returns:
+            The rendered report as a string.
+        """
+        return json.dumps({
+            'source': src_path,
+            'errors': self.error_count,
+            'warnings': self.warning_count,
+            'aborted': self.is_aborted(),
+            'diagnostics': [record._asdict() for record in self.records],
+        })
@@ -40,3 +40,13 @@ class ParserRuntimeError(ParserError):
     Thrown when a runtime error occurs in the parser.
     """
     pass
+
+
+class DiagnosticLimitError(Exception):
+    """DiagnosticLimitError class
+
+    Thrown when the error cap of the diagnostics collector is reached. This
+    is deliberately not a ParserError so that resync points do not catch it
+    and the whole compilation is aborted.
+    """
+    pass
@@ -0,0 +1,954 @@
+"""Incremental module
+
+Provides an incremental front end for editors which resubmit the whole
+program on every change. The tokens of every line and the parse results of
+every top level declaration and statement of the program are kept between
+updates. After an edit only the edited lines are scanned again and only the
+declarations or statements touching them are parsed again.
+
+The parser always runs in check-only mode here. Anything which could change
+how the rest of the program parses (an edit to the program structure, or to
+a declaration which then declares something different) falls back to a full
+parse.
+
+Author: RDDS TEAM
+
+Classes:
+    Segment: The parse results of one top level declaration or statement.
+    IncrementalChecker: Checks a program again after each edit.
+"""
+
+import sys
+from bisect import bisect_left
+
+from lib.errors import ParserSyntaxError
+from lib.data_type import Token, IdentifierTable
+from lib.diagnostics import DiagnosticCollector
+from lib.scanner import Scanner
+from lib.rd_parser import Parser
+
+# Column used for a position past the last token of a line
+END_OF_LINE = sys.maxsize
+
+# Position used for the end of file token, past every line
+END_OF_FILE = (sys.maxsize, sys.maxsize)
+
+
+def shift_position(position, delta):
+    """Shift Position
+
+    Arguments:
+        position: A (line index, column) position, or END_OF_FILE.
+        delta: The number of lines to move the position by.
+
+    Returns:
+        The moved position. END_OF_FILE never moves.
+    """
+    if position == END_OF_FILE:
+        return position
+
+    return (position[0] + delta, position[1])
+
+
+def shift_record(record, delta):
+    """Shift Record
+
+    Arguments:
+        record: A (sort key, diagnostic) pair built by IncrementalChecker.
+        delta: The number of lines to move the record by.
+
+    Returns:
+        The moved record.
+    """
+    key, diagnostic = record
+
+    if key[1] == 0:
+        # A scanner warning: (position, 0, line, order)
+        key = (shift_position(key[0], delta), 0, key[2] + delta, key[3])
+    else:
+        # A parser diagnostic: (future, 1, current, (unit, rank), index)
+        key = (shift_position(key[0], delta), 1,
+               shift_position(key[2], delta),
+               (shift_position(key[3][0], delta), key[3][1]), key[4])
+
+    return key, diagnostic._replace(line=diagnostic.line + delta)
+
+
+class Segment:
+    """Segment
+
+    The parse results of one top level declaration (in the 'define' part of
+    the program) or statement (in the 'body' part of the program).
+    Positions are (line index, column) pairs of tokens.
+    """
+    def __init__(self, kind, start, end, diagnostics, reports, env_before,
+                 env_after):
+        super().__init__()
+
+        # Either 'declaration' or 'statement'
+        self.kind = kind
+
+        # Holds the positions of the first and last token of the segment
+        self.start = start
+        self.end = end
+
+        # Holds all parser diagnostics reported inside of the segment
+        self.diagnostics = diagnostics
+
+        # Holds the positions of the future and current token when each
+        # diagnostic was reported
+        self.reports = reports
+
+        # Holds the (sort key, diagnostic) records of the whole program
+        # which are reported while reading the tokens from the start of this
+        # segment up to the start of the next, in the order they are reported
+        self.records = []
+
+        # Holds the identifiers visible before and after the segment
+        self.env_before = env_before
+        self.env_after = env_after
+
+        return
+
+    def shift(self, delta):
+        """Shift
+
+        Moves the segment by a number of lines.
+
+        Arguments:
+            delta: The number of lines to move the segment by.
+        """
+        self.start = (self.start[0] + delta, self.start[1])
+        self.end = (self.end[0] + delta, self.end[1])
+        self.diagnostics = [d._replace(line=d.line + delta)
+                            for d in self.diagnostics]
+        self.reports = [(shift_position(future, delta),
+                         shift_position(current, delta))
+                        for future, current in self.reports]
+        self.records = [shift_record(record, delta)
+                        for record in self.records]
+
+        return
+
+
+class _UnitParser(Parser):
+    """Unit Parser (Protected)
+
+    A check-only parser which reads already scanned tokens and records a
+    segment for every top level declaration and statement it parses.
+    """
+    def __init__(self, lexed, start, end):
+        super().__init__()
+
+        self._check_only = True
+
+        # Holds the tokens to be parsed
+        self._feed = self._feed_tokens(lexed, start, end)
+
+        # Holds the position of the first token after the tokens to be
+        # parsed, which a full parse reads where this one reads end of file
+        self._end_position = self._next_position(lexed, end)
+
+        # Holds the positions of the future and current token when each
+        # diagnostic was reported, in the order of the diagnostics
+        self.reports = []
+
+        # Holds the segments parsed, in source order
+        self.segments = []
+
+        # Holds the name of the program which owns the segments
+        self.program_name = None
+
+        # Holds the identifiers visible to all statements of the body
+        self._body_env = None
+
+        # Set if a unit left a scope other than the program scope open
+        self.unbalanced = False
+
+        # Holds the last token read. A parse which stops before the end of
+        # file never scans the lines after it
+        self.last_token = None
+
+        return
+
+    def next_token(self):
+        """Next Token
+
+        Returns:
+            The next scanned token, or end of file after the last one.
+        """
+        self.last_token = next(self._feed)
+
+        return self.last_token
+
+    def parse_units(self, kind, env, program_name):
+        """Parse Units
+
+        Parses a run of declarations or statements in the given scope.
+
+        Arguments:
+            kind: Either 'declaration' or 'statement'.
+            env: The identifiers visible before the first unit.
+            program_name: The name of the program owning the units.
+
+        Returns:
+            The identifiers visible after the last unit, or None if the
+            units did not end exactly at the end of the tokens.
+        """
+        self._ids = IdentifierTable(env[0])
+        self._ids.push_scope(program_name)
+        self._ids[1].update(env[1])
+        self._local_ptr = env[2]
+        self.program_name = program_name
+
+        if kind == 'statement':
+            self._body_env = env
+
+        self._advance_token()
+        self._advance_token()
+
+        # The keyword which ends the run of units in the full program
+        terminator = 'body' if kind == 'declaration' else 'finish'
+
+        try:
+            while not self._check('eof'):
+                if self._check('keyword', terminator):
+                    return None
+
+                if kind == 'declaration':
+                    self._parse_declaration_unit()
+                else:
+                    self._parse_statement_unit()
+        except ParserSyntaxError:
+            return None
+
+        if self.unbalanced:
+            return None
+
+        return self._snapshot_env()
+
+    def _warning(self, msg, line, code='warning', column=None):
+        """Warning (Protected)
+
+        Reports a warning, recording the position it was reported at.
+        """
+        self.reports.append(self._report())
+
+        return super()._warning(msg, line, code=code, column=column)
+
+    def _error(self, code, msg, line, column=None):
+        """Error (Protected)
+
+        Reports an error, recording the position it was reported at.
+        """
+        self.reports.append(self._report())
+
+        return super()._error(code, msg, line, column=column)
+
+    def _report(self):
+        """Report (Protected)
+
+        Returns:
+            The positions of the future token, which is the token read
+            last, and of the current token. Both only move forward while
+            parsing, so together they order diagnostics as they are
+            reported. Scanner warnings reported while reading a token come
+            before diagnostics reported once it has been read.
+        """
+        return (self._token_position(self._future),
+                self._token_position(self._current))
+
+    def _token_position(self, token):
+        """Token Position (Protected)
+
+        Arguments:
+            token: A token read from the feed, or None.
+
+        Returns:
+            The position of the token. End of file is where a full parse
+            reads the first token after the tokens to be parsed.
+        """
+        if token is None or token.type == 'eof':
+            return self._end_position
+
+        return self._position(token)
+
+    def _parse_declaration_unit(self):
+        """Parse Declaration Unit (Protected)
+
+        Parses one declaration and records its segment.
+
+        Returns:
+            The memory size of the declaration.
+        """
+        start = self._position(self._current)
+        first = len(self.diagnostics.records)
+        env_before = self._snapshot_env()
+
+        size = super()._parse_declaration_unit()
+
+        self._record('declaration', start, first, env_before,
+                     self._snapshot_env())
+
+        return size
+
+    def _parse_statement_unit(self):
+        """Parse Statement Unit (Protected)
+
+        Parses one statement and records its segment.
+        """
+        if self._body_env is None:
+            self._body_env = self._snapshot_env()
+
+        start = self._position(self._current)
+        first = len(self.diagnostics.records)
+
+        super()._parse_statement_unit()
+
+        self._record('statement', start, first, self._body_env,
+                     self._body_env)
+
+        return
+
+    def _record(self, kind, start, first, env_before, env_after):
+        """Record (Protected)
+
+        Records the segment of the unit parsed last.
+
+        Arguments:
+            kind: Either 'declaration' or 'statement'.
+            start: The position of the first token of the unit.
+            first: The number of diagnostics reported before the unit.
+            env_before: The identifiers visible before the unit.
+            env_after: The identifiers visible after the unit.
+        """
+        end = self._position(self._previous)
+        diagnostics = self.diagnostics.records[first:]
+        reports = self.reports[first:]
+
+        self.segments.append(Segment(kind, start, end, diagnostics,
+                                     reports, env_before, env_after))
+
+        # Error recovery may leave a procedure scope open, which the units
+        # that follow would then be parsed in
+        if len(self._ids) != 2:
+            self.unbalanced = True
+        elif self.program_name is None:
+            self.program_name = self._scope_name()
+
+        return
+
+    def _snapshot_env(self):
+        """Snapshot Environment (Protected)
+
+        Returns:
+            A copy of the global and program scopes and the local pointer.
+        """
+        return (dict(self._ids[0]), dict(self._ids[1]), self._local_ptr)
+
+    @staticmethod
+    def _position(token):
+        """Position (Protected)
+
+        Arguments:
+            token: A token read from the feed.
+
+        Returns:
+            The (line index, column) position of the token.
+        """
+        return (token.line - 1, token.column)
+
+    @staticmethod
+    def _next_position(lexed, end):
+        """Next Position (Protected)
+
+        Arguments:
+            lexed: The (tokens, warnings, reads) scan results of each line.
+            end: The position of the last token to be parsed.
+
+        Returns:
+            The position of the first token after the end, or END_OF_FILE.
+        """
+        for line in range(end[0], len(lexed)):
+            for token in lexed[line][0]:
+                if (line, token.column) > end:
+                    return (line, token.column)
+
+        return END_OF_FILE
+
+    @staticmethod
+    def _feed_tokens(lexed, start, end):
+        """Feed Tokens (Protected)
+
+        Arguments:
+            lexed: The (tokens, warnings, reads) scan results of each line.
+            start: The position of the first token to be parsed.
+            end: The position of the last token to be parsed.
+
+        Yields:
+            The tokens from start to end, with 1-based lines, then end of
+            file tokens.
+        """
+        line, column = start
+        last_line, last_column = end
+
+        while line <= last_line and line < len(lexed):
+            for token in lexed[line][0]:
+                if line == start[0] and token.column < column:
+                    continue
+                if line == last_line and token.column > last_column:
+                    break
+
+                yield token._replace(line=line + 1)
+
+            line += 1
+
+        while True:
+            yield Token('eof', None, line, None)
+
+
+class IncrementalChecker:
+    """Incremental Checker
+
+    Keeps the scanned lines and parsed segments of a program so that it can
+    be checked again after an edit in time proportional to the edit.
+    """
+    def __init__(self, src_path='<editor>'):
+        super().__init__()
+
+        # Holds the name of the source shown in diagnostics
+        self._src_path = src_path
+
+        # Holds the scanner used to scan edited lines
+        self._scanner = Scanner()
+
+        # Holds the source text with every line ending in a newline, or None
+        # if it must be joined from the source lines
+        self._text = ''
+
+        # Holds the source lines and their (tokens, warnings, reads) scan
+        # results
+        self._lines = []
+        self._lexed = []
+
+        # Holds the segments of the last parse, in source order
+        self._segments = []
+
+        # Holds the records reported before the first segment, as
+        # Segment.records holds those of each segment
+        self._head_records = []
+
+        # Holds the sorted line indexes of tokens outside of all segments,
+        # such as the program header and the 'body' keyword
+        self._structural = []
+
+        # Holds the parser diagnostics reported outside of all segments, and
+        # the positions of the future and current token when each was
+        # reported
+        self._other_diagnostics = []
+        self._other_reports = []
+
+        # Holds the (line index, warning count) of the point where the last
+        # full parse stopped scanning, or None if it scanned every line. Only
+        # the first count scanner warnings of that line are reported
+        self._scan_end = None
+
+        # Holds the name of the program
+        self._program_name = None
+
+        # If False, the next update must parse the whole program
+        self._reusable = False
+
+        # Holds all diagnostics of the last update
+        self.diagnostics = DiagnosticCollector()
+
+        # Either 'full' or 'incremental' depending on the last update
+        self.last_update = None
+
+        return
+
+    def update(self, text):
+        """Update
+
+        Checks the new text of the whole program. Only the lines which
+        differ from the previous text are treated as edited.
+
+        Arguments:
+            text: The complete source text.
+
+        Returns:
+            True if the program has no errors, False otherwise.
+        """
+        # The scanner expects every line to end in a newline
+        if text and not text.endswith('\n'):
+            text += '\n'
+
+        old = self._text if self._text is not None else ''.join(self._lines)
+
+        # Find the edited lines by skipping the common start and end. The
+        # texts are compared in slices, so unchanged lines are never split
+        # or compared one by one
+        prefix = self._common_prefix(old, text)
+        suffix = self._common_suffix(old, text,
+                                     min(len(old), len(text)) - prefix)
+
+        # The edit starts at the line holding the first difference, and ends
+        # before the first line which lies wholly in the common end
+        start = old.rfind('\n', 0, prefix) + 1
+        end = old.find('\n', len(old) - suffix) + 1 or len(old)
+
+        first = old.count('\n', 0, start)
+        last = first + old.count('\n', start, end)
+        new_lines = text[start:end + len(text) - len(old)].splitlines(True)
+
+        result = self.edit(first, last, new_lines)
+
+        self._text = text
+
+        return result
+
+    def edit(self, first, last, new_lines):
+        """Edit
+
+        Replaces a range of lines and checks the program again.
+
+        Arguments:
+            first: The index of the first replaced line.
+            last: The index after the last replaced line.
+            new_lines: The lines to put in place of the replaced lines. Each
+                line must end in a newline.
+
+        Returns:
+            True if the program has no errors, False otherwise.
+        """
+        new_last = first + len(new_lines)
+
+        # Scan the edited lines only
+        self._text = None
+        self._lines[first:last] = new_lines
+        self._lexed[first:last] = [self._scanner.scan_line(line)
+                                   for line in new_lines]
+
+        if self._reusable and self._reparse(first, last, new_last):
+            self.last_update = 'incremental'
+        else:
+            self._parse_all()
+            self._collect_all()
+            self.last_update = 'full'
+
+        # Report the records of every segment, which are kept in order
+        diagnostics = DiagnosticCollector()
+        diagnostics.records = [record for _, record in self._head_records]
+        for segment in self._segments:
+            if segment.records:
+                diagnostics.records += [record
+                                        for _, record in segment.records]
+
+        diagnostics.error_count = sum(record.severity == 'error'
+                                      for record in diagnostics.records)
+        diagnostics.warning_count = (len(diagnostics.records) -
+                                     diagnostics.error_count)
+        self.diagnostics = diagnostics
+
+        return not self.diagnostics.has_errors()
+
+    def render_diagnostics(self, fmt='text'):
+        """Render Diagnostics
+
+        Arguments:
+            fmt: Either 'text' or 'json'. (Default: 'text')
+
+        Returns:
+            The diagnostics of the last update, rendered as a string.
+        """
+        return self.diagnostics.render(fmt, self._src_path, self._lines)
+
+    def _parse_all(self):
+        """Parse All (Protected)
+
+        Parses the whole program and records its segments.
+        """
+        parser = _UnitParser(self._lexed, (0, 0),
+                             (len(self._lexed) - 1, END_OF_LINE))
+        parser._parse_source()
+
+        self._segments = parser.segments
+        self._program_name = parser.program_name
+        self._reusable = (not parser._aborted and not parser.unbalanced and
+                          self._segments != [])
+
+        # Parser.check() only reports the scanner warnings found up to the
+        # last token it read, so the line of that token is scanned again up
+        # to there
+        last = parser.last_token
+        self._scan_end = None
+        if last is not None and last.type != 'eof':
+            _, warnings, _ = self._scanner.scan_line(
+                self._lines[last.line - 1], last.column)
+            self._scan_end = (last.line - 1, len(warnings))
+
+        segment_diagnostics = set()
+        for segment in self._segments:
+            segment_diagnostics.update(id(d) for d in segment.diagnostics)
+
+        self._other_diagnostics = []
+        self._other_reports = []
+        for diagnostic, report in zip(parser.diagnostics.records,
+                                      parser.reports):
+            if id(diagnostic) not in segment_diagnostics:
+                self._other_diagnostics.append(diagnostic)
+                self._other_reports.append(report)
+
+        # Find the lines holding tokens which belong to no segment
+        self._structural = []
+        index = 0
+        for line, (tokens, _, _) in enumerate(self._lexed):
+            for token in tokens:
+                position = (line, token.column)
+
+                while (index < len(self._segments) and
+                       self._segments[index].end < position):
+                    index += 1
+
+                if (index == len(self._segments) or
+                        position < self._segments[index].start):
+                    self._structural.append(line)
+                    break
+
+        return
+
+    def _reparse(self, first, last, new_last):
+        """Reparse (Protected)
+
+        Parses again only the segments touched by an edit.
+
+        Arguments:
+            first: The index of the first edited line.
+            last: The index after the last edited line, before the edit.
+            new_last: The index after the last edited line, after the edit.
+
+        Returns:
+            True if the edit was handled, False if a full parse is needed.
+        """
+        segments = self._segments
+        delta = new_last - last
+
+        # Edits to the program structure always need a full parse
+        if self._has_structural(first, last - 1):
+            return False
+
+        # Find the segments on the edited lines
+        i, j = 0, len(segments)
+        while i < j:
+            middle = (i + j) // 2
+
+            if segments[middle].end[0] < first:
+                i = middle + 1
+            else:
+                j = middle
+
+        while j < len(segments) and segments[j].start[0] < last:
+            j += 1
+
+        if i == j:
+            # Lines were only inserted. Parse them together with a
+            # neighbouring segment so that their context is known
+            if (i < len(segments) and
+                    not self._has_structural(first, segments[i].start[0])):
+                j = i + 1
+            elif (i > 0 and
+                  not self._has_structural(segments[i-1].end[0], first - 1)):
+                i = i - 1
+                j = i + 1
+            else:
+                return False
+
+        # A diagnostic reported while reading a token on the edited lines
+        # may be reported at another point now, so the units reporting them
+        # are parsed again
+        edited = (first, 0)
+        while i > 0 and any(future >= edited
+                            for future, _ in segments[i-1].reports):
+            i -= 1
+
+        if any(future >= edited and diagnostic.line - 1 < first
+               for diagnostic, (future, _) in zip(self._other_diagnostics,
+                                                  self._other_reports)):
+            return False
+
+        kind = segments[i].kind
+        if any(segment.kind != kind for segment in segments[i:j]):
+            return False
+
+        # Find the tokens to parse again, in the edited coordinates
+        start = segments[i].start
+        if start[0] >= first:
+            start = (first, 0)
+
+        end = segments[j-1].end
+        if end[0] >= last:
+            end = (end[0] + delta, end[1])
+        else:
+            end = (new_last - 1, END_OF_LINE)
+
+        parser = _UnitParser(self._lexed, start, end)
+        env = parser.parse_units(kind, segments[i].env_before,
+                                 self._program_name)
+
+        # The new units must leave the identifiers as the old ones did
+        if env is None or env != segments[j-1].env_after:
+            return False
+
+        if delta != 0:
+            for segment in segments[j:]:
+                segment.shift(delta)
+
+        segments[i:j] = parser.segments
+
+        self._structural = [line if line < first else line + delta
+                            for line in self._structural]
+        if self._scan_end is not None and self._scan_end[0] >= first:
+            self._scan_end = (self._scan_end[0] + delta, self._scan_end[1])
+        self._other_diagnostics = [
+            d if d.line <= first else d._replace(line=d.line + delta)
+            for d in self._other_diagnostics
+        ]
+        self._other_reports = [
+            tuple(position if position < edited
+                  else shift_position(position, delta)
+                  for position in report)
+            for report in self._other_reports
+        ]
+
+        # Gather the records again from the segment before the new ones,
+        # whose records end where they start, to the segment after them,
+        # which holds the records reported while reading its first tokens
+        for index in range(i - 1, min(i + len(parser.segments) + 1,
+                                      len(segments))):
+            records = self._chunk_records(index)
+
+            if index < 0:
+                self._head_records = records
+            else:
+                segments[index].records = records
+
+        return True
+
+    def _has_structural(self, first, last):
+        """Has Structural (Protected)
+
+        Arguments:
+            first: The index of the first line to look at.
+            last: The index of the last line to look at.
+
+        Returns:
+            True if any token outside of all segments lies on the lines.
+        """
+        index = bisect_left(self._structural, first)
+
+        return (index < len(self._structural) and
+                self._structural[index] <= last)
+
+    def _collect_all(self):
+        """Collect All (Protected)
+
+        Gathers the scanner warnings and parser diagnostics of the whole
+        program in the order a full parse reports them, and hands them out
+        to the segments whose tokens are being read when they are reported.
+        """
+        records = self._warning_records(0, len(self._lexed) - 1)
+        records += self._other_records()
+        for segment in self._segments:
+            records += self._segment_records(segment)
+
+        records.sort(key=lambda record: record[0])
+
+        self._head_records = []
+        for segment in self._segments:
+            segment.records = []
+
+        chunk = self._head_records
+        index = 0
+        for record in records:
+            while (index < len(self._segments) and
+                   record[0][0] >= self._segments[index].start):
+                chunk = self._segments[index].records
+                index += 1
+
+            chunk.append(record)
+
+        return
+
+    def _chunk_records(self, index):
+        """Chunk Records (Protected)
+
+        Gathers the records reported while reading the tokens from the start
+        of a segment up to the start of the next segment.
+
+        Arguments:
+            index: The index of the segment, or -1 for the records before
+                the first segment.
+
+        Returns:
+            The records in the order they are reported.
+        """
+        segments = self._segments
+        low = segments[index].start if index >= 0 else (0, 0)
+        high = segments[index+1].start if index + 1 < len(segments) else None
+
+        # The warnings found after the last token before the segment are
+        # reported while reading its first token
+        first_line = low[0]
+        while first_line > 0:
+            first_line -= 1
+            if self._lexed[first_line][0]:
+                break
+
+        last_line = high[0] if high is not None else len(self._lexed) - 1
+
+        # Only the segment before this one reports diagnostics while reading
+        # its tokens
+        records = self._warning_records(first_line, last_line)
+        records += self._other_records()
+        for source in segments[max(index - 1, 0):index + 1]:
+            records += self._segment_records(source)
+
+        records = [record for record in records
+                   if low <= record[0][0] and
+                   (high is None or record[0][0] < high)]
+        records.sort(key=lambda record: record[0])
+
+        return records
+
+    def _warning_records(self, first_line, last_line):
+        """Warning Records (Protected)
+
+        A scanner warning is reported while reading the token after it.
+        Warnings are ordered by the position of that token, then by line and
+        order of the warning. Scanner warnings are only gathered up to the
+        point where a full parse would have stopped scanning.
+
+        Arguments:
+            first_line: The index of the first line to gather from.
+            last_line: The index of the last line to gather from.
+
+        Returns:
+            The unsorted (sort key, diagnostic) records of the warnings.
+        """
+        records = []
+
+        # Find the first token after the lines, which reports the warnings
+        # found after the last token of the last line
+        next_position = END_OF_FILE
+        for line in range(last_line + 1, len(self._lexed)):
+            tokens = self._lexed[line][0]
+            if tokens:
+                next_position = (line, tokens[0].column)
+                break
+
+        for line in range(last_line, first_line - 1, -1):
+            tokens, warnings, reads = self._lexed[line]
+
+            if self._scan_end is not None and line >= self._scan_end[0]:
+                if line > self._scan_end[0]:
+                    warnings = []
+                else:
+                    warnings = warnings[:self._scan_end[1]]
+
+            for order, (warning, read) in enumerate(zip(warnings, reads)):
+                position = ((line, tokens[read].column)
+                            if read < len(tokens) else next_position)
+                records.append(((position, 0, line + 1, order),
+                                warning._replace(line=line + 1)))
+
+            if tokens:
+                next_position = (line, tokens[0].column)
+
+        return records
+
+    def _other_records(self):
+        """Other Records (Protected)
+
+        A parser diagnostic is reported once its future token has been read,
+        so it is ordered by the position of that token, then by the position
+        of the current token. Diagnostics reported at the same tokens are
+        ordered by the unit reporting them: a diagnostic outside of all
+        segments reported at the first token of a segment comes before the
+        diagnostics of the segment.
+
+        Returns:
+            The unsorted (sort key, diagnostic) records of the parser
+            diagnostics reported outside of all segments.
+        """
+        return [((future, 1, current, (current, 0), index), diagnostic)
+                for index, (diagnostic, (future, current))
+                in enumerate(zip(self._other_diagnostics,
+                                 self._other_reports))]
+
+    @staticmethod
+    def _segment_records(segment):
+        """Segment Records (Protected)
+
+        Arguments:
+            segment: The segment whose diagnostics to gather.
+
+        Returns:
+            The unsorted (sort key, diagnostic) records of the parser
+            diagnostics of the segment, ordered as in _other_records().
+        """
+        unit = (segment.start, 1)
+
+        return [((future, 1, current, unit, index), diagnostic)
+                for index, (diagnostic, (future, current))
+                in enumerate(zip(segment.diagnostics, segment.reports))]
+
+    @staticmethod
+    def _common_prefix(old, new):
+        """Common Prefix (Protected)
+
+        Arguments:
+            old: The previous text.
+            new: The new text.
+
+        Returns:
+            The length of the longest common start of both texts.
+        """
+        low, high = 0, min(len(old), len(new))
+
+        # Only compare the part not known to be equal yet, so that the
+        # texts are compared about once in total
+        while low < high:
+            middle = (low + high + 1) // 2
+
+            if old[low:middle] == new[low:middle]:
+                low = middle
+            else:
+                high = middle - 1
+
+        return low
+
+    @staticmethod
+    def _common_suffix(old, new, limit):
+        """Common Suffix (Protected)
+
+        Arguments:
+            old: The previous text.
+            new: The new text.
+            limit: The longest common end to look for.
+
+        Returns:
+            The length of the longest common end of both texts, up to the
+            limit.
+        """
+        low, high = 0, limit
+
+        while low < high:
+            middle = (low + high + 1) // 2
+
+            if (old[len(old)-middle:len(old)-low] ==
+                    new[len(new)-middle:len(new)-low]):
+                low = middle
+            else:
+                high = middle - 1
+
+        return low
@@ -0,0 +1,1562 @@
+"""Optimizer module
+
+Provides passes which rewrite the generated code of a whole program so that
+it runs faster. The passes work on the register code made by the code
+generator, where each entry of the generated code is a single statement,
+registers are only assigned in short straight-line chains and every
+variable is reached through a register holding its address in MM.
+
+Author: RDDS TEAM
+
+Classes:
+    Instruction: A named tuple object holding one parsed code entry.
+    InlineRecord: A named tuple object describing one inlining decision.
+    CodeOptimizer: Optimization passes over generated code.
+
+Functions:
+    parse_instruction: Parses one entry of generated code.
+    format_instruction: Turns a parsed entry back into code.
+"""
+
+import re
+from collections import namedtuple
+
+# The kind is one of 'const', 'binop', 'not', 'copy', 'addr', 'load',
+# 'store', 'push', 'label', 'jump', 'branch' or 'other'. The dest is the register set
+# by the entry and srcs are the registers read by it. The op holds the
+# literal of a const, the operator of a binop, the base ('local', 'global'
+# or 'param') of an addr and the target label of a jump or branch. The value
+# is the integer value of a const, or the comparison of a branch which
+# compares two registers instead of testing one. A branch testing one
+# register has the value 'true' if it is taken when the register is true
+Instruction = namedtuple('Instruction', ['kind', 'dest', 'srcs', 'op',
+                                         'value', 'indent'])
+
+_CONST_RE = re.compile(r'R\[(\d+)\] = (-?\d+|\(int\)".*");$')
+_BINOP_RE = re.compile(r'R\[(\d+)\] = R\[(\d+)\] '
+                       r'(\+|-|\*|/|<=|>=|==|!=|<|>|&|\|) R\[(\d+)\];$')
+_NOT_RE = re.compile(r'R\[(\d+)\] = ~R\[(\d+)\];$')
+_COPY_RE = re.compile(r'R\[(\d+)\] = R\[(\d+)\];$')
+_ADDR_RE = re.compile(r'R\[(\d+)\] = (R\[FP\] - |MM_SIZE - 1 - |'
+                      r'R\[FP\] \+ 1 \+ )R\[(\d+)\];$')
+_LOAD_RE = re.compile(r'R\[(\d+)\] = MM\[R\[(\d+)\]\];$')
+_STORE_RE = re.compile(r'MM\[R\[(\d+)\]\] = (?:R\[(\d+)\]|MM\[R\[SP\]\]);$')
+_PUSH_RE = re.compile(r'MM\[R\[SP\]\] = R\[(\d+)\];$')
+_LABEL_RE = re.compile(r'(\w+):$')
+_JUMP_RE = re.compile(r'goto (\w+);$')
+_BRANCH_RE = re.compile(r'if \((!?)R\[(\d+)\]\) goto (\w+);$')
+_COMPARE_RE = re.compile(r'if \(R\[(\d+)\] (<=|>=|==|!=|<|>) R\[(\d+)\]\) '
+                         r'goto (\w+);$')
+_REG_RE = re.compile(r'R\[(\d+)\]')
+_NAME_RE = re.compile(r'"(?:[^"\\]|\\.)*"|R\[(\d+)\]|\b([A-Za-z_]\w*)\b')
+_LABEL_ID_RE = re.compile(r'(\w+?)_(\d+)$')
+_MEMCPY_RE = re.compile(r'memcpy\(&R\[(\d+)\]')
+
+# Maps the code before the register of an address to its base
+_ADDR_BASES = {
+    'R[FP] - ': 'local',
+    'MM_SIZE - 1 - ': 'global',
+    'R[FP] + 1 + ': 'param',
+}
+
+# Operators whose operands may be swapped
+_COMMUTATIVE = ('+', '*', '==', '!=', '&', '|')
+
+# Kinds of entries which only set their dest register
+_PURE_KINDS = ('const', 'binop', 'not', 'copy', 'addr', 'load')
+
+# A call sets the frame pointer to the new frame and restores it once the
+# procedure returns. A procedure returns through the address in its frame
+_FRAME_ENTER = 'R[FP] = R[SP];'
+_FRAME_LEAVE = 'R[FP] = MM[R[SP]];'
+_RETURN = 'goto *(void*)MM[R[FP]];'
+
+# A call of a procedure considered for inlining. The reason is None if the
+# procedure was inlined, otherwise it says why not. The size is the number
+# of code entries in the body of the procedure
+InlineRecord = namedtuple('InlineRecord', ['line', 'name', 'size', 'reason'])
+
+# Labels made for if statements, loops and short circuits. Jumps to any other
+# label enter a procedure. Procedures share the label ids, so the entry label
+# of a procedure named like one of these has the same form but another id
+_STATEMENT_LABEL_RE = re.compile(r'(loop|endloop|else|endif|skip)_\d+$')
+
+
+def parse_instruction(entry):
+    """Parse Instruction
+
+    Arguments:
+        entry: An entry of generated code.
+
+    Returns:
+        The Instruction parsed from the entry. Entries which are not one of
+        the simple statements the passes know of are of kind 'other'.
+    """
+    code = entry.lstrip(' ')
+    indent = entry[:len(entry) - len(code)]
+
+    match = _CONST_RE.match(code)
+    if match:
+        literal = match.group(2)
+        value = int(literal) if not literal.startswith('(') else None
+        return Instruction('const', int(match.group(1)), (), literal, value,
+                           indent)
+
+    match = _BINOP_RE.match(code)
+    if match:
+        return Instruction('binop', int(match.group(1)),
+                           (int(match.group(2)), int(match.group(4))),
+                           match.group(3), None, indent)
+
+    match = _NOT_RE.match(code)
+    if match:
+        return Instruction('not', int(match.group(1)),
+                           (int(match.group(2)),), None, None, indent)
+
+    match = _COPY_RE.match(code)
+    if match:
+        return Instruction('copy', int(match.group(1)),
+                           (int(match.group(2)),), None, None, indent)
+
+    match = _ADDR_RE.match(code)
+    if match:
+        return Instruction('addr', int(match.group(1)),
+                           (int(match.group(3)),),
+                           _ADDR_BASES[match.group(2)], None, indent)
+
+    match = _LOAD_RE.match(code)
+    if match:
+        return Instruction('load', int(match.group(1)),
+                           (int(match.group(2)),), None, None, indent)
+
+    match = _STORE_RE.match(code)
+    if match:
+        srcs = (int(match.group(1)),)
+        if match.group(2) is not None:
+            srcs += (int(match.group(2)),)
+        return Instruction('store', None, srcs, None, None, indent)
+
+    match = _PUSH_RE.match(code)
+    if match:
+        return Instruction('push', None, (int(match.group(1)),), None, None,
+                           indent)
+
+    match = _LABEL_RE.match(code)
+    if match:
+        return Instruction('label', None, (), match.group(1), None, indent)
+
+    match = _JUMP_RE.match(code)
+    if match:
+        return Instruction('jump', None, (), match.group(1), None, indent)
+
+    match = _BRANCH_RE.match(code)
+    if match:
+        value = None if match.group(1) else 'true'
+        return Instruction('branch', None, (int(match.group(2)),),
+                           match.group(3), value, indent)
+
+    match = _COMPARE_RE.match(code)
+    if match:
+        return Instruction('branch', None,
+                           (int(match.group(1)), int(match.group(3))),
+                           match.group(4), match.group(2), indent)
+
+    # Anything else reads every register it names. A register whose address
+    # is taken may also be set by it
+    match = _MEMCPY_RE.match(code)
+    dest = int(match.group(1)) if match else None
+    srcs = tuple(int(reg) for reg in _REG_RE.findall(code)
+                 if int(reg) != dest)
+
+    return Instruction('other', dest, srcs, None, None, indent)
+
+
+def format_instruction(ins):
+    """Format Instruction
+
+    Arguments:
+        ins: An Instruction of any kind but 'other'.
+
+    Returns:
+        The entry of generated code for the instruction.
+    """
+    if ins.kind == 'const':
+        code = 'R[%d] = %s;' % (ins.dest, ins.op)
+    elif ins.kind == 'binop':
+        code = 'R[%d] = R[%d] %s R[%d];' % (ins.dest, ins.srcs[0], ins.op,
+                                            ins.srcs[1])
+    elif ins.kind == 'not':
+        code = 'R[%d] = ~R[%d];' % (ins.dest, ins.srcs[0])
+    elif ins.kind == 'copy':
+        code = 'R[%d] = R[%d];' % (ins.dest, ins.srcs[0])
+    elif ins.kind == 'addr':
+        base = [code for code, base in _ADDR_BASES.items()
+                if base == ins.op][0]
+        code = 'R[%d] = %sR[%d];' % (ins.dest, base, ins.srcs[0])
+    elif ins.kind == 'load':
+        code = 'R[%d] = MM[R[%d]];' % (ins.dest, ins.srcs[0])
+    elif ins.kind == 'store':
+        if len(ins.srcs) == 2:
+            code = 'MM[R[%d]] = R[%d];' % ins.srcs
+        else:
+            code = 'MM[R[%d]] = MM[R[SP]];' % ins.srcs
+    elif ins.kind == 'push':
+        code = 'MM[R[SP]] = R[%d];' % ins.srcs
+    elif ins.kind == 'label':
+        code = '%s:' % ins.op
+    elif ins.kind == 'jump':
+        code = 'goto %s;' % ins.op
+    elif len(ins.srcs) == 2:
+        code = 'if (R[%d] %s R[%d]) goto %s;' % (ins.srcs[0], ins.value,
+                                                ins.srcs[1], ins.op)
+    elif ins.value == 'true':
+        code = 'if (R[%d]) goto %s;' % (ins.srcs[0], ins.op)
+    else:
+        code = 'if (!R[%d]) goto %s;' % (ins.srcs[0], ins.op)
+
+    return ins.indent + code
+
+
+class CodeOptimizer:
+    """Code Optimizer
+
+    Runs optimization passes over the generated code of a whole program.
+    The code and its source lines are changed in place.
+    """
+    def __init__(self, code, lines, new_reg, new_label, new_call):
+        super().__init__()
+
+        # Holds the generated code and the source line of each entry
+        self.code = code
+        self.lines = lines
+
+        # Holds the parsed form of each entry of code
+        self._parsed = [parse_instruction(entry) for entry in code]
+
+        # Return a register, label id and call number never used before
+        self._new_reg = new_reg
+        self._new_label = new_label
+        self._new_call = new_call
+
+        return
+
+    def eliminate_tail_calls(self):
+        """Eliminate Tail Calls
+
+        Replaces each call a procedure makes to itself right before it
+        returns with a jump back to the start of its body, after storing the
+        new parameters over the old ones. The procedure then runs in one
+        stack frame however deep it recurses. Only calls without out
+        parameters are replaced, as their values would have to be copied
+        back after the call.
+
+        Returns:
+            The set of labels of the procedures which no longer call
+            themselves.
+        """
+        self._analyze()
+
+        sites = []
+        for label, (_, start, end) in self._procedures.items():
+            sites.extend((index, label) for index in range(start, end)
+                         if self._parsed[index].kind == 'jump' and
+                         self._parsed[index].op == label)
+
+        # Replacing a call moves the code after it, so the last call is
+        # replaced first
+        replaced = set()
+        for index, label in sorted(sites, reverse=True):
+            if self._replace_tail_call(index, label):
+                replaced.add(label)
+
+        self._find_procedures()
+        for label, (_, start, end) in self._procedures.items():
+            if any(self._parsed[index].kind == 'jump' and
+                   self._parsed[index].op == label
+                   for index in range(start, end)):
+                replaced.discard(label)
+
+        return replaced
+
+    def inline_procedures(self, max_size):
+        """Inline Procedures
+
+        Replaces the calls of small procedures which never call themselves,
+        directly or through other procedures, with a copy of their body.
+        The stack frame of the call is kept, but the copy returns by jumping
+        straight to the code after the call, and reads the in parameters
+        pushed from a register from that register instead of the stack.
+        Procedures which are no longer called are dropped.
+
+        Arguments:
+            max_size: The largest number of code entries in the body of a
+                procedure which is inlined.
+
+        Returns:
+            A list of InlineRecord tuples, one for each call of a procedure
+            in the order of the calls.
+        """
+        self._analyze()
+
+        bodies = {}
+        for label, (entry, start, end) in self._procedures.items():
+            bodies[label] = [index for index in range(start + 1, end)
+                             if self.code[index].strip()]
+
+        recursive = self._find_recursive()
+
+        records = []
+        code = []
+        lines = []
+        inlined = set()
+        for index, ins in enumerate(self._parsed):
+            if ins.kind != 'jump' or ins.op not in self._procedures:
+                code.append(self.code[index])
+                lines.append(self.lines[index])
+                continue
+
+            label = ins.op
+            name = _LABEL_ID_RE.match(label).group(1)
+            size = len(bodies[label])
+
+            reason = None
+            if label in recursive:
+                reason = 'recursive'
+            elif size > max_size:
+                reason = '%d entries, limit %d' % (size, max_size)
+
+            store = self._call_site(index)
+            if reason is None and store is None:
+                reason = 'unknown call'
+
+            records.append(InlineRecord(self.lines[index], name, size, reason))
+
+            if reason is not None:
+                code.append(self.code[index])
+                lines.append(self.lines[index])
+                continue
+
+            # Pushed registers must hold the same value wherever they are
+            # read
+            pushed = dict((offset, reg) for offset, reg in
+                          self._pushed_registers(store - 1).items()
+                          if reg not in self._unstable)
+
+            # The return address is never jumped to
+            del code[len(code) - (index - store)]
+            del lines[len(lines) - (index - store)]
+
+            copy = self._copy_body(label, bodies[label], pushed, ins.indent,
+                                   self._parsed[index + 1].op)
+            code.extend(entry for entry, _ in copy)
+            lines.extend(line for _, line in copy)
+            inlined.add(label)
+
+        self.code[:] = code
+        self.lines[:] = lines
+        self._parsed[:] = [parse_instruction(entry) for entry in code]
+
+        # Drop the procedures which are no longer called
+        self._find_procedures()
+        called = set(ins.op for ins in self._parsed if ins.kind == 'jump')
+        dead = set()
+        for label in inlined - called:
+            entry, start, end = self._procedures[label]
+            dead.update((entry, entry + 1))
+            dead.update(range(start, end))
+
+        self._delete(dead)
+
+        return records
+
+    def eliminate_common_subexpressions(self):
+        """Eliminate Common Subexpressions
+
+        Numbers the values worked out in each block of straight-line code,
+        so that a constant, address, operation or load which is worked out
+        again within the block reuses the register holding the earlier
+        result. A load of a variable stored to earlier in the block reuses
+        the register which was stored. Loads are forgotten once a store,
+        call or code the passes do not know may have changed memory.
+
+        Returns:
+            The number of entries no longer needed.
+        """
+        self._analyze()
+        ends = self._find_block_ends()
+        uses = {}
+        for index, ins in enumerate(self._parsed):
+            for src in ins.srcs:
+                uses.setdefault(src, []).append(index)
+
+        same = {}
+        eliminated = 0
+        self._forget_values()
+        for index, ins in enumerate(self._parsed):
+            if ins.kind == 'label':
+                self._forget_values()
+                continue
+
+            srcs = tuple(same.get(src, src) for src in ins.srcs)
+            if srcs != ins.srcs:
+                ins = ins._replace(srcs=srcs)
+                self._set(index, ins)
+
+            if ins.kind == 'store':
+                self._forget_stored(ins.srcs[0])
+                if (len(ins.srcs) == 2 and
+                        ins.srcs[1] not in self._unstable):
+                    self._number(('load', None, ins.srcs[0]), ins.srcs[1])
+                continue
+            if ins.kind in ('push', 'other'):
+                # The frame pointer may change along with memory
+                self._forget_stored(None)
+                self._forget_keys(self._frame_keys)
+                self._frame_keys = set()
+            if ins.dest is None:
+                continue
+
+            # Values worked out from the old value of the register are gone
+            self._forget_keys(self._readers.pop(ins.dest, ()))
+
+            key = self._value_key(ins)
+            if key is None or ins.dest in self._unstable:
+                continue
+
+            # The earlier register can only stand in for this one where
+            # both were set in the same pass through the block
+            reg = self._values.get(key)
+            if reg is not None and all(index < use <= ends[index]
+                                       for use in uses.get(ins.dest, [])):
+                same[ins.dest] = reg
+                eliminated += 1
+            elif ins.dest not in key[2:]:
+                self._number(key, ins.dest)
+
+        self._remove_unused()
+
+        return eliminated
+
+    def hoist_loop_invariants(self):
+        """Hoist Loop Invariants
+
+        Moves the code computing values which are the same in every
+        iteration of a loop in front of the loop, so that it only runs once.
+        This covers constants, address calculations, loads of variables the
+        loop never stores to and operations on any of these. Inner loops
+        are done first, so that code may move out of several loops.
+
+        Returns:
+            The number of entries moved.
+        """
+        self._analyze()
+
+        # Moving code out of a loop does not move any loop around it or
+        # after it, so all loops can be found up front
+        moved = 0
+        for start, end in self._find_loops():
+            count = self._hoist_loop(start, end)
+            if count:
+                self._find_depths()
+            moved += count
+
+        return moved
+
+    def reduce_induction_variables(self):
+        """Reduce Induction Variables
+
+        Finds the loops whose counter is only changed by the constant step
+        at the head of the loop. The addresses of array elements indexed by
+        the counter, such as data[i] or data[i - 1], are then kept in
+        registers which move by the step together with the counter, instead
+        of being worked out from the counter on every iteration.
+
+        Returns:
+            The number of addresses no longer worked out in a loop.
+        """
+        self._analyze()
+
+        # Code put in front of a loop moves every later loop, so each loop
+        # is found again by its label
+        labels = [ins.op for ins in self._parsed
+                  if ins.kind == 'label' and
+                  self._statement_label(ins.op) == 'loop']
+
+        reduced = 0
+        for label in labels:
+            start, end = self._find_loop(label)
+            count = self._reduce_loop(start, end)
+            if count:
+                self._find_values()
+                self._find_depths()
+            reduced += count
+
+        self._remove_unused()
+
+        return reduced
+
+    def _analyze(self):
+        """Analyze (Protected)
+
+        Finds what the passes need to know of the code before changing it.
+        """
+        self._find_opaque()
+        self._split_registers()
+        self._find_values()
+        self._find_procedures()
+        self._find_depths()
+
+        return
+
+    def _find_procedures(self):
+        """Find Procedures (Protected)
+
+        Records the procedures in the code by label, as (entry, start, end)
+        tuples holding the index of the label of the procedure and the
+        [start, end) range of its body. The body starts with its own label.
+        The procedures nested in a procedure come between its label and its
+        body.
+        """
+        self._procedures = {}
+
+        entries = {}
+        open_body = None
+        for index, ins in enumerate(self._parsed):
+            if ins.kind != 'label':
+                continue
+
+            following = self._parsed[index + 1:index + 2]
+            is_entry = (following != [] and following[0].kind == 'jump' and
+                        following[0].op == ins.op + '_body')
+            is_body = ins.op.endswith('_body')
+            if not is_entry and not is_body:
+                continue
+
+            # A body ends where the next procedure or body starts
+            if open_body is not None:
+                label, start = open_body
+                self._procedures[label] = (entries[label], start, index)
+                open_body = None
+
+            if is_entry:
+                entries[ins.op] = index
+            elif ins.op[:-len('_body')] in entries:
+                open_body = (ins.op[:-len('_body')], index)
+
+        return
+
+    def _find_depths(self):
+        """Find Depths (Protected)
+
+        Records for every entry how many calls it is nested in. The frame
+        pointer only holds the frame of the procedure an entry belongs to
+        while the entry is at the same depth.
+        """
+        self._depths = []
+
+        depth = 0
+        for entry in self.code:
+            code = entry.strip()
+            if code == _FRAME_LEAVE:
+                depth -= 1
+            self._depths.append(depth)
+            if code == _FRAME_ENTER:
+                depth += 1
+
+        return
+
+    def _find_recursive(self):
+        """Find Recursive (Protected)
+
+        Returns:
+            The set of procedure labels which may call themselves, directly
+            or through other procedures.
+        """
+        callees = {}
+        for label, (_, start, end) in self._procedures.items():
+            callees[label] = set(self._parsed[index].op
+                                 for index in range(start, end)
+                                 if self._parsed[index].kind == 'jump' and
+                                 self._parsed[index].op in self._procedures)
+
+        recursive = set()
+        for label in callees:
+            seen = set()
+            pending = list(callees[label])
+            while pending:
+                callee = pending.pop()
+                if callee == label:
+                    recursive.add(label)
+                    break
+                if callee not in seen:
+                    seen.add(callee)
+                    pending.extend(callees[callee])
+
+        return recursive
+
+    def _call_site(self, index):
+        """Call Site (Protected)
+
+        Arguments:
+            index: The index of the jump of a call.
+
+        Returns:
+            The index of the entry storing the return address of the call,
+            or None if the call does not have the expected form.
+        """
+        label = self._parsed[index].op
+        back = self._parsed[index + 1] if index + 1 < len(self.code) else None
+        if back is None or back.kind != 'label':
+            return None
+
+        # Only profiling code comes between the return address and the jump
+        store = index - 1
+        while store >= 0 and self._parsed[store].kind == 'other':
+            code = self.code[store].strip()
+            if code == 'MM[R[SP]] = (int)&&%s;' % back.op:
+                break
+            if 'R[SP]' in code or 'R[FP]' in code:
+                return None
+            store -= 1
+        else:
+            return None
+
+        if (store < 1 or self.code[store - 1].strip() != _FRAME_ENTER or
+                not back.op.startswith(label + '_')):
+            return None
+
+        return store
+
+    def _stack_entries(self, enter):
+        """Stack Entries (Protected)
+
+        Walks back from the entry of a call which sets the frame pointer,
+        over the code pushing the parameters of the call, tracking where the
+        stack pointer points relative to the new frame pointer.
+
+        Arguments:
+            enter: The index of the entry setting the frame pointer.
+
+        Returns:
+            A list of (index, kind, offset, reg) tuples, last entry first,
+            for each entry moving the stack pointer (kind 'move') or storing
+            on the stack (kind 'push'). The offset is where the stack pointer
+            points once the entry has run. The reg is the register pushed, or
+            None if the frame pointer is pushed.
+        """
+        entries = []
+        offset = 0
+        for prior in range(enter - 1, -1, -1):
+            ins = self._parsed[prior]
+            code = self.code[prior].strip()
+
+            if code == 'R[SP] = R[SP] - 1;':
+                entries.append((prior, 'move', offset, None))
+                offset += 1
+            elif code == 'R[SP] = R[SP] + 1;':
+                entries.append((prior, 'move', offset, None))
+                offset -= 1
+            elif ins.kind == 'push':
+                entries.append((prior, 'push', offset, ins.srcs[0]))
+            elif code == 'MM[R[SP]] = R[FP];':
+                entries.append((prior, 'push', offset, None))
+            elif (ins.kind in ('label', 'jump', 'branch') or
+                    'R[SP]' in code or 'R[FP]' in code):
+                break
+
+        return entries
+
+    def _pushed_registers(self, enter):
+        """Pushed Registers (Protected)
+
+        Arguments:
+            enter: The index of the entry of a call which sets the frame
+                pointer.
+
+        Returns:
+            A dictionary mapping the offset from the new frame pointer of
+            each stack slot last pushed from a register to that register.
+        """
+        pushed = {}
+        written = set()
+        for _, kind, offset, reg in self._stack_entries(enter):
+            if kind != 'push' or offset in written:
+                continue
+            written.add(offset)
+            if reg is not None:
+                pushed[offset] = reg
+
+        return pushed
+
+    def _replace_tail_call(self, index, label):
+        """Replace Tail Call (Protected)
+
+        Arguments:
+            index: The index of the jump of a call a procedure makes to
+                itself.
+            label: The label of the procedure.
+
+        Returns:
+            True if the call was made right before returning and has been
+            replaced with a jump to the start of the body.
+        """
+        store = self._call_site(index)
+        if store is None:
+            return False
+
+        # After the call returns, the frame pointer is restored and only the
+        # stack pointer moves off the parameters
+        after = index + 2
+        leave = ['R[SP] = R[SP] + 1;', _FRAME_LEAVE]
+        if [entry.strip() for entry in self.code[after:after + 2]] != leave:
+            return False
+        after += 2
+
+        count = -1
+        while (after < len(self.code) and
+               self.code[after].strip() == 'R[SP] = R[SP] + 1;'):
+            count += 1
+            after += 1
+
+        if count < 0 or not self._returns_from(after):
+            return False
+
+        # Every parameter must be pushed from a register. Parameter n is at
+        # R[FP] + 1 + n
+        entries = self._stack_entries(store - 1)
+        pushed = self._pushed_registers(store - 1)
+        if any(1 + number not in pushed for number in range(1, count + 1)):
+            return False
+
+        pushes = set()
+        for prior, kind, offset, _ in entries:
+            pushes.add(prior)
+            if kind == 'move' and offset == count + 1:
+                break
+        else:
+            return False
+
+        indent = self._parsed[index].indent
+        code = []
+        for number in range(1, count + 1):
+            const = self._new_reg()
+            address = self._new_reg()
+            code.extend([
+                Instruction('const', const, (), str(number), number, indent),
+                Instruction('addr', address, (const,), 'param', None, indent),
+                Instruction('store', None, (address, pushed[1 + number]),
+                            None, None, indent),
+            ])
+        code = [format_instruction(ins) for ins in code]
+        code.append(indent + 'R[SP] = R[FP];')
+        code.append(indent + 'goto %s_body;' % label)
+
+        line = self.lines[index]
+        first = min(pushes)
+        kept = [prior for prior in range(first, store - 1)
+                if prior not in pushes]
+
+        self.code[first:after] = [self.code[prior] for prior in kept] + code
+        self.lines[first:after] = ([self.lines[prior] for prior in kept] +
+                                   [line] * len(code))
+        self._parsed[first:after] = ([self._parsed[prior] for prior in kept] +
+                                     [parse_instruction(entry)
+                                      for entry in code])
+
+        return True
+
+    def _returns_from(self, index):
+        """Returns From (Protected)
+
+        Returns:
+            True if the code from the index on returns from the procedure
+            without doing anything else, passing over labels and jumps to
+            the end of if statements.
+        """
+        seen = set()
+        while index < len(self.code) and index not in seen:
+            seen.add(index)
+            ins = self._parsed[index]
+            code = self.code[index].strip()
+
+            if ins.kind == 'label' or not code:
+                index += 1
+            elif (ins.kind == 'jump' and
+                  self._statement_label(ins.op) == 'endif'):
+                index = self._find_label(ins.op)
+            elif code == 'R[SP] = R[FP];':
+                following = self.code[index + 1:index + 2]
+                return [entry.strip() for entry in following] == [_RETURN]
+            else:
+                return False
+
+        return False
+
+    def _find_label(self, label):
+        """Find Label (Protected)
+
+        Returns:
+            The index of the label.
+        """
+        for index, ins in enumerate(self._parsed):
+            if ins.kind == 'label' and ins.op == label:
+                return index
+
+        return len(self._parsed)
+
+    def _copy_body(self, label, body, pushed, indent, back):
+        """Copy Body (Protected)
+
+        Makes a copy of the body of a procedure for one call, with its own
+        registers, labels and call numbers.
+
+        Arguments:
+            label: The label of the procedure.
+            body: The indexes of the body entries to copy.
+            pushed: Maps the stack offsets of the parameters pushed from a
+                register to that register.
+            indent: The indent of the call.
+            back: The label returned to after the call.
+
+        Returns:
+            A list of (code, line) tuples.
+        """
+        # Parameters the procedure stores to can not be read from the
+        # registers they were pushed from
+        stores = set(self._addresses.get(self._parsed[index].srcs[0])
+                     for index in body
+                     if self._parsed[index].kind == 'store')
+
+        regs = {}
+        skip = set()
+        if None not in stores:
+            for index in body:
+                ins = self._parsed[index]
+                if ins.kind != 'load' or ins.dest in self._unstable:
+                    continue
+                address = self._addresses.get(ins.srcs[0])
+                if (address is None or address[0] != 'param' or
+                        address[1] is None or address in stores):
+                    continue
+                # Parameter n is at R[FP] + 1 + n
+                reg = pushed.get(1 + address[1])
+                if reg is not None and ins.dest not in self._opaque:
+                    regs[ins.dest] = reg
+                    skip.add(index)
+
+        # Give every label defined in the body a new id or call number. A
+        # procedure whose tail calls were replaced jumps to its own body
+        names = {}
+        label_ids = {}
+        start = []
+        if any(self._parsed[index].kind == 'jump' and
+               self._parsed[index].op == label + '_body' for index in body):
+            names[label + '_body'] = '%s_%d_start' % (
+                _LABEL_ID_RE.match(label).group(1), self._new_label())
+            start.append(names[label + '_body'] + ':')
+        for index in body:
+            ins = self._parsed[index]
+            if ins.kind != 'label':
+                continue
+            match = _LABEL_ID_RE.match(ins.op)
+            if self._statement_label(ins.op) is not None:
+                old_id = match.group(2)
+                if old_id not in label_ids:
+                    label_ids[old_id] = self._new_label()
+                names[ins.op] = '%s_%d' % (match.group(1), label_ids[old_id])
+            else:
+                names[ins.op] = '%s_%d' % (match.group(1), self._new_call())
+
+        def rename(match):
+            if match.group(1) is not None:
+                reg = int(match.group(1))
+                if reg not in regs:
+                    regs[reg] = self._new_reg()
+                return 'R[%d]' % regs[reg]
+            elif match.group(2) is not None:
+                return names.get(match.group(2), match.group(2))
+            return match.group(0)
+
+        base = min(len(self._parsed[index].indent) for index in body)
+
+        copy = [(indent + entry, self.lines[body[0]]) for entry in start]
+        for position, index in enumerate(body):
+            if index in skip:
+                continue
+
+            code = self.code[index].strip()
+            if code == _RETURN:
+                if position == len(body) - 1:
+                    continue
+                code = 'goto %s;' % back
+
+            depth = self._parsed[index].indent[base:]
+            copy.append((indent + depth + _NAME_RE.sub(rename, code),
+                         self.lines[index]))
+
+        return copy
+
+    def _find_loops(self):
+        """Find Loops (Protected)
+
+        Returns:
+            A list of (start, end) tuples holding the index of the label and
+            of the jump back to it of each loop, inner loops first.
+        """
+        loops = []
+        starts = {}
+        for index, ins in enumerate(self._parsed):
+            if ins.kind == 'label' and self._statement_label(ins.op) == 'loop':
+                starts[ins.op] = index
+            elif ins.kind == 'jump' and ins.op in starts:
+                loops.append((starts[ins.op], index))
+
+        return loops
+
+    def _find_loop(self, label):
+        """Find Loop (Protected)
+
+        Returns:
+            A (start, end) tuple holding the index of the label of the loop
+            and of the jump back to it.
+        """
+        start = None
+        for index, ins in enumerate(self._parsed):
+            if ins.kind == 'label' and ins.op == label:
+                start = index
+            elif ins.kind == 'jump' and ins.op == label and start is not None:
+                return start, index
+
+        return None
+
+    def _statement_label(self, label):
+        """Statement Label (Protected)
+
+        Returns:
+            The kind of statement the label was made for, such as 'loop' or
+            'endif', or None if it is a label of a procedure.
+        """
+        match = _STATEMENT_LABEL_RE.match(label)
+        if match is None or label in self._procedures:
+            return None
+
+        return match.group(1)
+
+    def _find_opaque(self):
+        """Find Opaque (Protected)
+
+        Records the registers used by code the passes do not know. These
+        are never split or moved.
+        """
+        self._opaque = set()
+
+        for entry, ins in zip(self.code, self._parsed):
+            if ins.kind == 'other':
+                self._opaque.update(int(reg) for reg in _REG_RE.findall(entry))
+
+        return
+
+    def _split_registers(self):
+        """Split Registers (Protected)
+
+        Gives every assignment of a register set more than once its own new
+        register, so that each register holds a single value. Registers are
+        only split if all their uses lie in one straight-line chain of code.
+        """
+        defs = {}
+        spans = {}
+        for index, ins in enumerate(self._parsed):
+            if ins.dest is not None:
+                defs.setdefault(ins.dest, []).append(index)
+            for reg in ins.srcs + ((ins.dest,) if ins.dest is not None
+                                   else ()):
+                first, last = spans.get(reg, (index, index))
+                spans[reg] = (min(first, index), max(last, index))
+
+        for reg, indexes in defs.items():
+            if len(indexes) < 2:
+                continue
+
+            first, last = spans[reg]
+            if not self._is_straight(first, last) or reg in self._opaque:
+                continue
+
+            current = reg
+            for index in range(first, last + 1):
+                ins = self._parsed[index]
+                srcs = tuple(current if src == reg else src
+                             for src in ins.srcs)
+                dest = ins.dest
+                if dest == reg and index != indexes[0]:
+                    current = self._new_reg()
+                    dest = current
+
+                if srcs != ins.srcs or dest != ins.dest:
+                    self._set(index, ins._replace(dest=dest, srcs=srcs))
+
+        return
+
+    def _is_straight(self, first, last):
+        """Is Straight (Protected)
+
+        Returns:
+            True if no code from first to last may be jumped to or away
+            from, other than a branch or jump at the very end.
+        """
+        for index in range(first, last + 1):
+            kind = self._parsed[index].kind
+            if kind == 'label' and index != first:
+                return False
+            if kind in ('jump', 'branch') and index != last:
+                return False
+
+        return True
+
+    def _find_values(self):
+        """Find Values (Protected)
+
+        Records which registers are set only once, the constant values of
+        registers and the variable addressed by each address register.
+        """
+        counts = {}
+        for ins in self._parsed:
+            if ins.dest is not None:
+                counts[ins.dest] = counts.get(ins.dest, 0) + 1
+
+        # Registers set more than once, or used by code the passes do not
+        # know, never hold one known value
+        self._unstable = set(reg for reg, count in counts.items()
+                             if count > 1)
+        self._unstable.update(self._opaque)
+
+        self._consts = {}
+        self._addresses = {}
+        for ins in self._parsed:
+            if ins.dest is None or ins.dest in self._unstable:
+                continue
+
+            if ins.kind == 'const' and ins.value is not None:
+                self._consts[ins.dest] = ins.value
+            elif ins.kind == 'addr':
+                # Locals of the program are its globals, so these share one
+                # base. Variables indexed by a register have no known offset
+                base = 'param' if ins.op == 'param' else 'frame'
+                self._addresses[ins.dest] = (base,
+                                             self._consts.get(ins.srcs[0]))
+
+        return
+
+    def _hoist_loop(self, start, end):
+        """Hoist Loop (Protected)
+
+        Moves the loop invariant code of one loop in front of its label.
+
+        Arguments:
+            start: The index of the loop label.
+            end: The index of the jump back to the loop label.
+
+        Returns:
+            The number of entries moved.
+        """
+        body = range(start + 1, end)
+        defined, stores, calls = self._loop_effects(start, end)
+
+        invariant = set()
+        moved = []
+        for index in body:
+            ins = self._parsed[index]
+
+            if ins.kind not in _PURE_KINDS or ins.dest in self._unstable:
+                continue
+
+            # The frame pointer is only the same as at the loop label
+            # outside of the calls made in the loop
+            if (ins.kind == 'addr' and ins.op != 'global' and
+                    self._depths[index] != self._depths[start]):
+                continue
+            if any(src in defined and src not in invariant
+                   for src in ins.srcs):
+                continue
+
+            # Code moved in front of the loop runs even if the loop body
+            # would not have, so it must never fault
+            if ins.kind == 'binop' and ins.op == '/':
+                continue
+            if ins.kind == 'load' and not self._is_stable_load(ins, stores,
+                                                                calls):
+                continue
+
+            invariant.add(ins.dest)
+            moved.append(index)
+
+        if not moved:
+            return 0
+
+        indent = self._parsed[start].indent
+        hoisted = set(moved)
+        kept = [index for index in body if index not in hoisted]
+        order = moved + [start] + kept
+
+        code = []
+        lines = []
+        parsed = []
+        for position, index in enumerate(order):
+            ins = self._parsed[index]
+            if position < len(moved):
+                ins = ins._replace(indent=indent)
+                code.append(format_instruction(ins))
+            else:
+                code.append(self.code[index])
+            lines.append(self.lines[index])
+            parsed.append(ins)
+
+        self.code[start:end] = code
+        self.lines[start:end] = lines
+        self._parsed[start:end] = parsed
+
+        return len(moved)
+
+    def _reduce_loop(self, start, end):
+        """Reduce Loop (Protected)
+
+        Keeps the addresses of array elements indexed by the counter of one
+        loop in registers which move with the counter.
+
+        Arguments:
+            start: The index of the loop label.
+            end: The index of the jump back to the loop label.
+
+        Returns:
+            The number of addresses no longer worked out in the loop.
+        """
+        if end - start < 4:
+            return 0
+
+        # The head of the loop must load the counter, add a constant step to
+        # it and store it back
+        load, update, store = self._parsed[start + 1:start + 4]
+        if (load.kind != 'load' or update.kind != 'binop' or
+                store.kind != 'store' or len(store.srcs) != 2):
+            return 0
+
+        counter = self._addresses.get(load.srcs[0])
+        if counter is None or counter[1] is None:
+            return 0
+        if (self._addresses.get(store.srcs[0]) != counter or
+                store.srcs[1] != update.dest):
+            return 0
+
+        step = self._step(update, load.dest)
+        if step is None:
+            return 0
+
+        # The counter must be loaded in front of the loop, and nothing else
+        # in the loop may change it
+        defined, _, calls = self._loop_effects(start, end)
+        if load.srcs[0] in defined:
+            return 0
+
+        head_stores = set(self._addresses.get(self._parsed[index].srcs[0])
+                          for index in range(start + 4, end)
+                          if self._parsed[index].kind == 'store')
+        if self._may_change(counter, head_stores, calls):
+            return 0
+
+        # Find the addresses worked out from the counter. Each register is
+        # tracked as a times the counter plus b
+        linear = {}
+        pointers = {}
+        replaced = {}
+        for index in range(start + 4, end):
+            ins = self._parsed[index]
+            if (ins.dest is None or ins.dest in self._unstable or
+                    ins.dest in self._opaque):
+                continue
+
+            # Inside a call in the loop, the frame pointer points to the
+            # frame of the procedure called
+            if self._depths[index] != self._depths[start]:
+                continue
+
+            if (ins.kind == 'load' and
+                    self._addresses.get(ins.srcs[0]) == counter):
+                linear[ins.dest] = (1, 0)
+            elif ins.kind == 'binop' and ins.op in ('+', '-', '*'):
+                terms = self._linear_terms(ins, linear)
+                if terms is not None:
+                    linear[ins.dest] = terms
+            elif (ins.kind == 'addr' and ins.srcs[0] in linear and
+                    linear[ins.srcs[0]][0] != 0):
+                key = (ins.op,) + linear[ins.srcs[0]]
+                if key not in pointers:
+                    pointers[key] = self._new_reg()
+                replaced[ins.dest] = pointers[key]
+
+        if not replaced:
+            return 0
+
+        # Work out the first addresses in front of the loop
+        outer = self._parsed[start].indent
+        inner = load.indent
+        before = []
+        after = []
+
+        value = self._new_reg()
+        before.append(Instruction('load', value, load.srcs, None, None,
+                                  outer))
+
+        for (base, scale, offset), pointer in pointers.items():
+            reg = value
+            for op, number in (('*', scale), ('+', offset)):
+                if number == (1 if op == '*' else 0):
+                    continue
+                const = self._new_reg()
+                result = self._new_reg()
+                before.append(Instruction('const', const, (), str(number),
+                                          number, outer))
+                before.append(Instruction('binop', result, (reg, const), op,
+                                          None, outer))
+                reg = result
+            before.append(Instruction('addr', pointer, (reg,), base, None,
+                                      outer))
+
+            # Addresses of locals and globals fall as the index rises
+            delta = scale * step * (1 if base == 'param' else -1)
+            const = self._new_reg()
+            before.append(Instruction('const', const, (), str(delta), delta,
+                                      outer))
+            after.append(Instruction('binop', pointer, (pointer, const), '+',
+                                     None, inner))
+
+        # Use the moving addresses in place of the ones worked out
+        body = []
+        for index in range(start + 4, end):
+            ins = self._parsed[index]
+            if ins.dest in replaced:
+                continue
+            srcs = tuple(replaced.get(src, src) for src in ins.srcs)
+            if srcs != ins.srcs:
+                ins = ins._replace(srcs=srcs)
+                body.append((format_instruction(ins), self.lines[index], ins))
+            else:
+                body.append((self.code[index], self.lines[index], ins))
+
+        line = self.lines[start]
+        entries = [(format_instruction(ins), line, ins) for ins in before]
+        entries.extend((self.code[index], self.lines[index],
+                        self._parsed[index])
+                       for index in range(start, start + 4))
+        entries.extend((format_instruction(ins), self.lines[start + 3], ins)
+                       for ins in after)
+        entries.extend(body)
+
+        self.code[start:end] = [entry[0] for entry in entries]
+        self.lines[start:end] = [entry[1] for entry in entries]
+        self._parsed[start:end] = [entry[2] for entry in entries]
+
+        return len(replaced)
+
+    def _step(self, update, counter):
+        """Step (Protected)
+
+        Arguments:
+            update: The instruction working out the new counter value.
+            counter: The register holding the old counter value.
+
+        Returns:
+            The constant added to the counter, or None if the update is not
+            a constant step.
+        """
+        left, right = update.srcs
+        if update.op == '+' and left == counter:
+            return self._consts.get(right)
+        if update.op == '+' and right == counter:
+            return self._consts.get(left)
+        if update.op == '-' and left == counter and right in self._consts:
+            return -self._consts[right]
+
+        return None
+
+    def _linear_terms(self, ins, linear):
+        """Linear Terms (Protected)
+
+        Arguments:
+            ins: A binop instruction.
+            linear: Maps registers to their (a, b) terms as a times the
+                counter plus b.
+
+        Returns:
+            The (a, b) terms of the result, or None if it is not linear in
+            the counter.
+        """
+        terms = []
+        for src in ins.srcs:
+            if src in linear:
+                terms.append(linear[src])
+            elif src in self._consts:
+                terms.append((0, self._consts[src]))
+            else:
+                return None
+
+        (a, b), (c, d) = terms
+        if ins.op == '+':
+            return a + c, b + d
+        if ins.op == '-':
+            return a - c, b - d
+        if a == 0:
+            return b * c, b * d
+        if c == 0:
+            return a * d, b * d
+
+        return None
+
+    def _loop_effects(self, start, end):
+        """Loop Effects (Protected)
+
+        Arguments:
+            start: The index of the loop label.
+            end: The index of the jump back to the loop label.
+
+        Returns:
+            A (defined, stores, calls) tuple holding the set of registers
+            set in the loop, the set of addresses stored to by the loop and
+            whether the loop calls a procedure. None in the stores stands for
+            a store to an unknown address.
+        """
+        defined = set()
+        stores = set()
+        calls = False
+        for index in range(start + 1, end):
+            ins = self._parsed[index]
+            if ins.dest is not None:
+                defined.add(ins.dest)
+            if ins.kind == 'store':
+                stores.add(self._addresses.get(ins.srcs[0]))
+            elif ins.kind == 'jump' and self._is_call(ins.op):
+                calls = True
+
+        return defined, stores, calls
+
+    def _find_block_ends(self):
+        """Find Block Ends (Protected)
+
+        Returns:
+            A list holding for every entry the index of the last entry
+            before the next label. Code up to there can only be reached by
+            passing the entry first.
+        """
+        ends = [None] * len(self._parsed)
+
+        end = len(self._parsed) - 1
+        for index in range(len(self._parsed) - 1, -1, -1):
+            ends[index] = end
+            if self._parsed[index].kind == 'label':
+                end = index - 1
+
+        return ends
+
+    def _value_key(self, ins):
+        """Value Key (Protected)
+
+        Arguments:
+            ins: An instruction setting a register.
+
+        Returns:
+            A key which is the same for any two instructions working out the
+            same value from the same registers, or None if the value of the
+            instruction can not be shared.
+        """
+        if ins.kind not in _PURE_KINDS:
+            return None
+
+        # String constants may not be the same object each time
+        if ins.kind == 'const' and ins.value is None:
+            return None
+
+        srcs = ins.srcs
+        if ins.kind == 'binop' and ins.op in _COMMUTATIVE:
+            srcs = tuple(sorted(srcs))
+
+        return (ins.kind, ins.op) + srcs
+
+    def _forget_values(self):
+        """Forget Values (Protected)
+
+        Drops all numbered values, along with the indexes used to find the
+        values a change of a register, memory or the frame pointer drops.
+        """
+        # Maps the key of each value to the register holding it
+        self._values = {}
+
+        # Map each register to the keys of the values worked out from it,
+        # and the address stored to by loads to their keys. Keys dropped
+        # from the values may be left in these
+        self._readers = {}
+        self._loads = {}
+
+        # Holds the keys of addresses relative to the frame pointer
+        self._frame_keys = set()
+
+        return
+
+    def _number(self, key, reg):
+        """Number (Protected)
+
+        Records that the register holds the value of the key.
+        """
+        self._values[key] = reg
+
+        for src in key[2:]:
+            self._readers.setdefault(src, set()).add(key)
+
+        if key[0] == 'load':
+            address = self._addresses.get(key[2])
+            self._loads.setdefault(address, set()).add(key)
+        elif key[0] == 'addr' and key[1] != 'global':
+            self._frame_keys.add(key)
+
+        return
+
+    def _forget_keys(self, keys):
+        """Forget Keys (Protected)
+
+        Drops the values of the keys which are still numbered.
+        """
+        for key in keys:
+            self._values.pop(key, None)
+
+        return
+
+    def _forget_stored(self, address_reg):
+        """Forget Stored (Protected)
+
+        Drops the loads which a store may have changed from the numbered
+        values.
+
+        Arguments:
+            address_reg: The register holding the address stored to, or
+                None if any memory may have changed.
+        """
+        stored = self._addresses.get(address_reg)
+
+        # A store to a variable only changes that variable, and a store to
+        # an array element only changes array elements, which are taken to
+        # stay within their array. Loads from unknown addresses may read
+        # anything
+        if stored is None:
+            addresses = list(self._loads)
+        else:
+            addresses = [None, stored]
+
+        for address in addresses:
+            self._forget_keys(self._loads.pop(address, ()))
+
+        return
+
+    def _is_stable_load(self, ins, stores, calls):
+        """Is Stable Load (Protected)
+
+        Arguments:
+            ins: The load instruction.
+            stores: The addresses stored to by the loop. None stands for a
+                store to an unknown address.
+            calls: True if the loop calls a procedure.
+
+        Returns:
+            True if the load reads a variable (not an array element) which
+            the loop never changes.
+        """
+        address = self._addresses.get(ins.srcs[0])
+
+        if address is None or address[1] is None:
+            return False
+
+        return not self._may_change(address, stores, calls)
+
+    def _may_change(self, address, stores, calls):
+        """May Change (Protected)
+
+        Arguments:
+            address: The (base, offset) address of a variable.
+            stores: The addresses stored to by a loop.
+            calls: True if the loop calls a procedure.
+
+        Returns:
+            True if the loop may change the variable. Array elements are
+            taken to stay within their array, so storing to an element
+            never changes a variable.
+        """
+        if None in stores or address in stores:
+            return True
+
+        # Called procedures may change any global variable
+        return calls and address[0] == 'frame'
+
+    def _is_call(self, label):
+        """Is Call (Protected)
+
+        Returns:
+            True if a jump to the label calls a procedure which may change
+            variables of its caller. The runtime functions never do.
+        """
+        return label in self._procedures
+
+    def _count_uses(self):
+        """Count Uses (Protected)
+
+        Returns:
+            A dictionary mapping each register to the number of entries
+            which read it.
+        """
+        uses = {}
+        for ins in self._parsed:
+            for src in ins.srcs:
+                uses[src] = uses.get(src, 0) + 1
+
+        return uses
+
+    def _remove_unused(self):
+        """Remove Unused (Protected)
+
+        Drops the entries which only set a register that is never read.
+        """
+        while True:
+            uses = self._count_uses()
+            unused = set(index for index, ins in enumerate(self._parsed)
+                         if ins.kind in _PURE_KINDS and ins.dest not in uses
+                         and ins.dest not in self._opaque)
+            if not unused:
+                break
+
+            self._delete(unused)
+
+        return
+
+    def _delete(self, indexes):
+        """Delete (Protected)
+
+        Drops the entries at the given indexes.
+        """
+        if not indexes:
+            return
+
+        keep = [index not in indexes for index in range(len(self.code))]
+
+        self.code[:] = [entry for entry, kept in zip(self.code, keep)
+                        if kept]
+        self.lines[:] = [line for line, kept in zip(self.lines, keep)
+                         if kept]
+        self._parsed[:] = [ins for ins, kept in zip(self._parsed, keep)
+                           if kept]
+
+        return
+
+    def _set(self, index, ins):
+        """Set (Protected)
+
+        Replaces the entry at the index with the given instruction.
+        """
+        self._parsed[index] = ins
+        self.code[index] = format_instruction(ins)
+
+        return
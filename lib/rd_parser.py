@@ -10,43 +10,221 @@ Classes:
     Parser: An implementation of a parser for the source language.
 """
 
+from types import MappingProxyType
+
 from lib.errors import *
 from lib.data_type import Identifier, Parameter, IdentifierTable
 
 from lib.scanner import Scanner
 from lib.ICG import CodeGenerator
+from lib.codecache import cache_key, make_template, fill_template
 
 
 class Parser(Scanner, CodeGenerator):
     """13"""
-    def __init__(self, debug=False):
+    # Variable type keywords and the type each one declares
+    type_marks = {'int': 'int', 'float': 'float', 'bool': 'bool', 'str': 'str'}
+
+    # Tokens which may follow a construct that failed to parse, used as the
+    # sync points of error recovery. Every statement and declaration ends
+    # with ';', and the end of the file is always a sync point. A statement
+    # may also be the last one of a block ended by 'else' or 'finish', and
+    # a declaration the last one before 'body' or the end of a procedure
+    follow_sets = {
+        'statement': frozenset([('symbol', ';'), ('keyword', 'finish'),
+                                ('keyword', 'else'), ('eof', None)]),
+        'declaration': frozenset([('symbol', ';'), ('keyword', 'body'),
+                                  ('keyword', 'finish'), ('eof', None)]),
+    }
+
+    # Binding power of each binary operator. Operators with a higher power
+    # bind tighter
+    binding_powers = {
+        '&': 1, '|': 1,
+        '+': 2, '-': 2,
+        '<': 3, '>': 3, '<=': 3, '>=': 3, '==': 3, '!=': 3,
+        '*': 4, '/': 4,
+    }
+
+    # Operand types accepted by the operators of each binding power, with the
+    # type error message used for other operand types
+    operand_types = {
+        1: (('int', 'bool'), 'int or bool'),
+        2: (('int', 'float'), 'int or float'),
+        3: (('int', 'bool'), 'int or bool'),
+        4: (('int', 'float'), 'int or float'),
+    }
+
+    def __init__(self, debug=False, profile=None, line_directives=False,
+                 source_map=False, max_errors=None, code_cache=None,
+                 optimize=False, fast_io=False, recursion_depth=None,
+                 inline_size=None, short_circuit=False):
         super().__init__()
 
+        # Stop compiling once this many errors have been found
+        self._max_errors = max_errors
+        self.diagnostics.max_errors = max_errors
+
         # Public class attributes
         self.debug = debug
 
+        # Instrument the generated code to write a profile to this path
+        self._profile_path = profile
+
+        # Tie the generated code back to the source lines
+        self._line_directives = line_directives
+        self._source_map = source_map
+
+        # Reuse the generated code of procedures found in this CodeCache
+        self._code_cache = code_cache
+
+        # Leave out code which is never used
+        self._optimize = optimize
+
+        # Use the buffered input and output runtime
+        self._fast_io = fast_io
+
+        # Skip the right operand of "&" and "|" if the left decides them
+        self._short_circuit = short_circuit
+
+        # Size the stack for this many nested calls of recursive procedures
+        if recursion_depth is not None:
+            self._recursion_depth = recursion_depth
+            self._recursion_depth_given = True
+
+        # Inline procedures with at most this many code entries in their body
+        if inline_size is not None:
+            self._inline_size = inline_size
+
+        # Maps the first token of each statement to its parse method. Names
+        # are keyed by token type alone
+        self._statement_handlers = {
+            ('keyword', 'return'): self._parse_return_statement,
+            ('keyword', 'if'): self._parse_if_statement,
+            ('keyword', 'for'): self._parse_loop_statement,
+            ('identifier', None): self._parse_identifier_statement,
+        }
+
+        self._reset_parser()
+
+        return
+
+    def reset(self):
+        """81"""
+        # Drop everything left by the last compile, keeping the options
+        self.reset_scanner()
+        self.reset_generator()
+        self._reset_parser()
+
+        self.diagnostics.max_errors = self._max_errors
+
+        return
+
+    def _reset_parser(self):
+        """82"""
         # Define the previous, current, and future token holder
         self._previous = None
         self._current = None
         self._future = None
 
+        # Holds tokens read ahead of the future token, last token first, with
+        # the scanner warnings found while reading them
+        self._lookahead = []
+
         # Define the identifier table to hold all var/program/procedure names
         self._ids = IdentifierTable()
 
         self._has_errors = False
 
+        # Set if parsing stopped before the end of the program was reached
+        self._aborted = False
+
+        # Set once a return statement ends the statements being parsed, so
+        # that the statements after it can be left out
+        self._returned = False
+
         return
 
-    def parse(self, src_path, dest_path):
+    def parse(self, src_path, dest_path=None):
         """14"""
+        self.reset()
+
         # Attach the source file for reading
         if not self.attach_source(src_path):
             return False
 
-        # Attach the destination file for writing
-        if not self.attach_destination(dest_path):
+        # Attach the destination file for writing. Without one, the code is
+        # left in the code buffer for render()
+        if dest_path is not None and not self.attach_destination(dest_path):
+            return False
+
+        # If errors were encountered, don't write code
+        if not self._generate_program():
             return False
 
+        # Commit the code buffer to the output code file
+        if dest_path is not None and not self.commit():
+            return False
+
+        return True
+
+    def parse_text(self, source_text, src_path='<string>'):
+        """83"""
+        self.reset()
+
+        # Attach the source text for reading. Nothing is written, the code
+        # is left in the code buffer for render()
+        self.attach_text(source_text, src_path)
+
+        return self._generate_program()
+
+    def check(self, src_path):
+        """61"""
+        self.reset()
+
+        # Only scope and type check the source, no code is generated
+        self._check_only = True
+
+        # Attach the source file for reading
+        if not self.attach_source(src_path):
+            return False
+
+        return self._parse_source()
+
+    def check_text(self, source_text, src_path='<string>'):
+        """85"""
+        self.reset()
+
+        # Only scope and type check the source, no code is generated
+        self._check_only = True
+
+        # Attach the source text for reading
+        self.attach_text(source_text, src_path)
+
+        return self._parse_source()
+
+    def _generate_program(self):
+        """84"""
+        # If errors were encountered, don't generate the rest of the code
+        if not self._parse_source():
+            return False
+
+        # Drop the procedures, variables and runtime functions never used
+        self.eliminate_dead_code()
+
+        # Make the code which is left run faster
+        self.optimize_code()
+
+        # Generate the compiled code footer
+        self.generate_footer()
+
+        # Fill in the header values which depend on the whole program
+        self.update_header()
+
+        return True
+
+    def _parse_source(self):
+        """62"""
         # Advance the tokens twice to populate both current and future tokens
         self._advance_token()
         self._advance_token()
@@ -60,32 +238,41 @@ class Parser(Scanner, CodeGenerator):
         # Begin parsing the root <program> language structure
         try:
             self._parse_program()
-        except ParserSyntaxError:
+
+            # Make sure there's no junk after the end of program
+            if not self._check('eof'):
+                token = self._current
+                self._warning('Expected end of file, encountered "%s" (%s)' %
+                              (token.value, token.type), token.line,
+                              column=token.column)
+        except (ParserSyntaxError, DiagnosticLimitError):
+            self._aborted = True
             return False
 
-        # Generate the compiled code footer
-        self.generate_footer()
+        return not self._has_errors
 
-        # Make sure there's no junk after the end of program
-        if not self._check('eof'):
-            self._warning('eof', '')
+    def _add_runtime(self):
+        """15"""
+        # The runtime functions are the same for every compile, so their
+        # scope is built once and shared by the identifier table of every
+        # parser. The table copies it before any user global is added
+        self._ids = IdentifierTable(self._runtime_scope())
 
-        # If errors were encountered, don't write code
-        if self._has_errors:
-            return False
+        return
 
-        # Commit the code buffer to the output code file
-        self.commit()
+    @classmethod
+    def _runtime_scope(cls):
+        """78"""
+        scope = cls.__dict__.get('_shared_runtime_scope')
 
-        return True
+        if scope is not None:
+            return scope
 
-    def _add_runtime(self):
-        """15"""
         # The runtime_functions list is defined in the CodeGenerator class
-        for func_name in self.runtime_functions:
+        ids = IdentifierTable()
+        for func_name, param_list in cls.runtime_functions.items():
             # Get all parameters for these functions
             param_ids = []
-            param_list = self.runtime_functions[func_name]
             for index, param in enumerate(param_list):
                 # Build up each param, add it to the list
                 id_obj = Identifier(name=param[0], type=param[1], size=None,
@@ -94,19 +281,32 @@ class Parser(Scanner, CodeGenerator):
                 param_ids.append(p_obj)
 
             # Build the function's identifier
-            func_id = Identifier(name=func_name, type='function', size=None, 
-                                 params=param_ids, mm_ptr=1)
+            func_id = Identifier(name=func_name, type='function', size=None,
+                                 params=tuple(param_ids), mm_ptr=1)
 
             # Add the function to the global scope of the identifier table
-            self._ids.add(func_id, is_global=True)
+            ids.add(func_id, is_global=True)
 
-        return
+        # The shared scope is read only
+        scope = MappingProxyType(ids[0])
+        cls._shared_runtime_scope = scope
+
+        return scope
 
-    def _warning(self, msg, line, prefix='Warning'):
+    def _warning(self, msg, line, code='warning', column=None):
         """16"""
-        print('%s: "%s", line %d' % (prefix, self._src_path, line))
-        print('    %s' % msg)
-        print('    %s' % self._get_line(line))
+        self.diagnostics.add('warning', code, line, msg, column=column)
+
+        return
+
+    def _error(self, code, msg, line, column=None):
+        """60"""
+        # The code will never be written, so only check the rest of the source
+        if not self._has_errors:
+            self._has_errors = True
+            self.stop_generating()
+
+        self.diagnostics.add('error', code, line, msg, column=column)
 
         return
 
@@ -114,35 +314,31 @@ class Parser(Scanner, CodeGenerator):
         """17"""
         token = self._current
 
-        # Print the error message
+        # Record the error message
         msg = ('Expected %s, encountered "%s" (%s)' %
                (expected, token.value, token.type))
-        self._warning(msg, token.line, prefix='Error')
+        self._error('syntax-error', msg, token.line, column=token.column)
 
-        self._has_errors = True
         raise ParserSyntaxError()
 
     def _name_error(self, msg, name, line):
         """18"""
         msg = '%s: %s' % (name, msg)
-        self._warning(msg, line, prefix='Error')
+        self._error('name-error', msg, line)
 
-        self._has_errors = True
         return
 
     def _type_error(self, expected, encountered, line):
         """19"""
         msg = 'Expected %s type, encountered %s' % (expected, encountered)
-        self._warning(msg, line, prefix='Error')
+        self._error('type-error', msg, line)
 
-        self._has_errors = True
         return
 
     def _runtime_error(self, msg, line):
         """20"""
-        self._warning(msg, line, prefix='Error')
+        self._error('runtime-error', msg, line)
 
-        self._has_errors = True
         return
 
     def _advance_token(self):
@@ -150,10 +346,23 @@ class Parser(Scanner, CodeGenerator):
         self._previous = self._current
         self._current = self._future
 
+        # Code generated from here on belongs to the last consumed token
+        if self._previous is not None:
+            self._src_line = self._previous.line
+
         if self._future is None or self._future.type != 'eof':
-            self._future = self.next_token()
+            self._future = self._read_token()
         return
 
+    def _read_token(self):
+        """66"""
+        if self._lookahead:
+            token, warnings = self._lookahead.pop()
+            self.diagnostics.attach(warnings)
+            return token
+
+        return self.next_token()
+
     def _check(self, expected_type, expected_value=None, check_future=False):
         """22"""
         token = self._current
@@ -184,13 +393,32 @@ class Parser(Scanner, CodeGenerator):
         else:
             self._syntax_error(expected_type)
 
-    def _resync_at_token(self, token_type, token_value=None):
+    def _resync(self, construct, start):
         """25"""
-        while not self._check(token_type, token_value):
+        follow = self.follow_sets[construct]
+
+        # A keyword the construct failed on at once does not end the block
+        # it is in, or the block would not have parsed a construct there
+        if self._current is start and self._check('keyword'):
+            self._advance_token()
+
+        # Skip tokens up to the first one which may follow the construct
+        while (self._current.type, self._current.value) not in follow:
             self._advance_token()
 
+        # A block keyword is left to the block it ends. Otherwise the
+        # construct ends with ';', which is missing at the end of the file
+        if not self._check('keyword'):
+            self._match('symbol', ';')
+
         return
 
+    def _scope_name(self):
+        """58"""
+        owner = self._ids.get_current_scope_owner()
+
+        return owner.name if owner is not None else 'global'
+
     def _parse_program(self):
         """26"""
         id_obj = self._parse_program_header()
@@ -201,12 +429,14 @@ class Parser(Scanner, CodeGenerator):
     def _parse_program_header(self):
         """27 """
         while not self._accept('keyword', 'the'):
+            start = self._current
+
             try:
                 self._parse_statement()
             except ParserError:
-                self._resync_at_token('symbol', ';')
-
-            self._match('symbol', ';')
+                self._resync('statement', start)
+            else:
+                self._match('symbol', ';')
         self._match('keyword', 'program')
 
         id_name = self._current.value
@@ -220,6 +450,9 @@ class Parser(Scanner, CodeGenerator):
         id_obj = Identifier(id_name, 'program', None, None, label_id)
         self._ids.add(id_obj, is_global=True)
 
+        self.add_profile_slot('program', id_name, id_name,
+                              self._previous.line, label=(id_name, label_id))
+
         self._match('keyword', 'is')
 
         # Generate the program entry point code
@@ -227,6 +460,7 @@ class Parser(Scanner, CodeGenerator):
 
         # Push the scope to the program body level
         self._ids.push_scope(id_obj.name)
+        self.open_procedure(id_obj.name, id_obj.mm_ptr)
 
         # Add the program to the base scope so it can be resolved as owner
         self._ids.add(id_obj)
@@ -237,49 +471,70 @@ class Parser(Scanner, CodeGenerator):
         """28"""
         local_var_size = 0
         while not self._accept('keyword', 'define'):
+            start = self._current
+
             try:
                 self._parse_statement()
             except ParserError:
-                self._resync_at_token('symbol', ';')
-
-            self._match('symbol', ';')
+                self._resync('statement', start)
+            else:
+                self._match('symbol', ';')
         
 
         while not self._accept('keyword', 'body'):
-            try:
-                size = self._parse_declaration()
-
-                if size is not None:
-                    local_var_size += int(size)
-            except ParserError:
-                self._resync_at_token('symbol', ';')
-
-            self._match('symbol', ';')
+            local_var_size += self._parse_declaration_unit()
 
         # Label the entry point for the program
         self.generate('%s_%d_body:' % (program_id.name, program_id.mm_ptr))
         self.tab_push()
 
-        if local_var_size != 0:
-            self.comment('Allocating space for local variables', self.debug)
-            self.generate('R[SP] = R[SP] - %d;' % local_var_size)
+        self.generate_frame_allocation(local_var_size, self.debug)
 
-        while not self._accept('keyword', 'finish'):
-            try:
-                self._parse_statement()
-            except ParserError:
-                self._resync_at_token('symbol', ';')
+        self._returned = False
 
-            self._match('symbol', ';')
+        while not self._accept('keyword', 'finish'):
+            self._parse_statement_unit()
 
         self._match('keyword', 'program')
 
         # Pop out of the program body scope
         self._ids.pop_scope()
+        self.close_procedure()
         self.tab_pop()
 
         return
 
+    def _parse_declaration_unit(self):
+        """63"""
+        size = 0
+
+        start = self._current
+
+        try:
+            declared_size = self._parse_declaration()
+
+            if declared_size is not None:
+                size = int(declared_size)
+        except ParserError:
+            self._resync('declaration', start)
+        else:
+            self._match('symbol', ';')
+
+        return size
+
+    def _parse_statement_unit(self):
+        """64"""
+        start = self._current
+
+        try:
+            self._parse_statement()
+        except ParserError:
+            self._resync('statement', start)
+        else:
+            self._match('symbol', ';')
+
+        return
+
     def _parse_declaration(self):
         """29"""
         is_global = False
@@ -304,10 +559,8 @@ class Parser(Scanner, CodeGenerator):
 
     def _first_variable_declaration(self):
         """30"""
-        return (self._check('keyword', 'int') or
-                self._check('keyword', 'float') or
-                self._check('keyword', 'bool') or
-                self._check('keyword', 'str'))
+        return (self._current.type == 'keyword' and
+                self._current.value in self.type_marks)
 
     def _parse_variable_declaration(self, is_global=False, is_param=False):
         """31"""
@@ -342,6 +595,9 @@ class Parser(Scanner, CodeGenerator):
         if not is_param:
             try:
                 self._ids.add(id_obj, is_global=is_global)
+                self.add_frame_variable(id_obj.name,
+                                        'global' if is_global else 'local',
+                                        var_size, mm_ptr)
             except ParserNameError as e:
                 self._name_error(str(e),
                                  var_token.value, var_token.line)
@@ -350,20 +606,14 @@ class Parser(Scanner, CodeGenerator):
 
     def _parse_type_mark(self):
         """32"""
-        id_type = None
+        token = self._current
 
-        if self._accept('keyword', 'int'):
-            id_type = 'int'
-        elif self._accept('keyword', 'float'):
-            id_type = 'float'
-        elif self._accept('keyword', 'bool'):
-            id_type = 'bool'
-        elif self._accept('keyword', 'str'):
-            id_type = 'str'
-        else:
+        if token.type != 'keyword' or token.value not in self.type_marks:
             self._syntax_error('variable type')
 
-        return id_type
+        self._advance_token()
+
+        return self.type_marks[token.value]
 
     def _first_procedure_declaration(self):
         """33"""
@@ -371,9 +621,209 @@ class Parser(Scanner, CodeGenerator):
 
     def _parse_procedure_declaration(self, is_global):
         """34"""
+        cached = self._procedure_cache_key()
+
+        if cached is not None and self._reuse_procedure(cached, is_global):
+            return
+
+        start = len(self._generated_code)
+        bases = (self._label_id, self._unique_id, self._reg)
+        marks = self.frame_marks()
+
         id_obj = self._parse_procedure_header(is_global=is_global)
         self._parse_procedure_body(id_obj)
 
+        if cached is not None:
+            self._store_procedure(cached, start, bases, marks, id_obj)
+
+        return
+
+    def _procedure_cache_key(self):
+        """67"""
+        # Only procedures of the program scope are cached, and only code
+        # which does not depend on source lines, profile slots or the frame
+        # layout chosen by dead code elimination
+        if (self._code_cache is None or self._check_only or
+                self._profile_path is not None or self._line_directives or
+                self._source_map or self._optimize or len(self._ids) != 2 or
+                self._lookahead):
+            return None
+
+        tokens = self._read_procedure_tokens()
+
+        if tokens is None:
+            return None
+
+        names = sorted(set(token.value for token in tokens
+                           if token.type == 'identifier'))
+
+        # The code also depends on the global names used by the procedure
+        env = [self.debug, self._short_circuit, self._tab_count,
+               self._local_ptr, self._param_ptr,
+               [[name, self._cache_signature(self._ids[0].get(name))]
+                for name in names]]
+
+        return cache_key(tokens, env), names
+
+    def _read_procedure_tokens(self):
+        """68"""
+        if self._future.type == 'eof':
+            return None
+
+        buffered = []
+        depth = 1
+        previous = self._future
+
+        # Read up to the "function" keyword of the matching "finish function"
+        while depth > 0:
+            first = len(self.diagnostics.records)
+            token = self.next_token()
+            buffered.append((token, self.diagnostics.detach(first)))
+
+            if token.type == 'eof':
+                break
+
+            if token.type == 'keyword' and token.value == 'function':
+                if previous.type == 'keyword' and previous.value == 'finish':
+                    depth -= 1
+                else:
+                    depth += 1
+
+            previous = token
+
+        # The parser reads the buffered tokens before scanning any more
+        self._lookahead = buffered[::-1]
+
+        if depth > 0:
+            return None
+
+        return ([self._current, self._future] +
+                [token for token, warnings in buffered])
+
+    def _cache_signature(self, id_obj):
+        """69"""
+        if id_obj is None:
+            return None
+
+        # Procedure labels are looked up by name when the code is reused
+        if id_obj.type == 'function':
+            return ['function', [[p.id.name, p.id.type, p.id.size,
+                                  p.id.mm_ptr, p.direction]
+                                 for p in id_obj.params]]
+
+        return [id_obj.name, id_obj.type, id_obj.size, id_obj.params,
+                id_obj.mm_ptr, id_obj.storage, id_obj.direction]
+
+    def _cache_callees(self, names):
+        """70"""
+        callees = {}
+
+        for name in names:
+            id_obj = self._ids[0].get(name)
+
+            if id_obj is not None and id_obj.type == 'function':
+                callees[name] = id_obj.mm_ptr
+
+        return callees
+
+    def _reuse_procedure(self, cached, is_global):
+        """71"""
+        key, names = cached
+        entry = self._code_cache.get(key)
+
+        # Entries without frames were stored before memory was sized
+        if entry is None or 'frames' not in entry:
+            return False
+
+        params = [Parameter(Identifier(name, id_type, size, None, mm_ptr),
+                            direction)
+                  for name, id_type, size, mm_ptr, direction
+                  in entry['params']]
+        id_obj = Identifier(entry['name'], 'function', None, params,
+                            self._label_id + entry['label'])
+
+        # Parse the procedure normally if it can not be declared here
+        try:
+            self._ids.add(id_obj, is_global=is_global)
+        except ParserNameError:
+            return False
+
+        bases = (self._label_id, self._unique_id, self._reg)
+        callees = self._cache_callees(names)
+        code = fill_template(entry['code'], bases, callees)
+
+        # Relabel the frames and calls the memory of the program is sized by
+        labels = fill_template([frame[0] for frame in entry['frames']],
+                               bases, callees)
+        frames = [(label, frame[1], frame[2])
+                  for label, frame in zip(labels, entry['frames'])]
+        calls = [tuple(fill_template(call, bases, callees))
+                 for call in entry['calls']]
+
+        self.generate_cached(code, entry['counts'], frames, calls)
+
+        self._local_ptr = entry['local_ptr']
+        self._param_ptr = entry['param_ptr']
+
+        # Skip the procedure tokens, still reporting their scanner warnings
+        last_token = self._lookahead[0][0]
+        for token, warnings in reversed(self._lookahead):
+            self.diagnostics.attach(warnings)
+
+        self._lookahead = []
+        self._current = last_token
+        self._future = self._read_token()
+        self._advance_token()
+
+        return True
+
+    def _store_procedure(self, cached, start, bases, marks, id_obj):
+        """72"""
+        # Code with errors is never generated, so there is nothing to store
+        if self._check_only:
+            return
+
+        key, names = cached
+        code = self._generated_code[start:]
+        counts = (self._label_id - bases[0], self._unique_id - bases[1],
+                  self._reg - bases[2])
+        callees = self._cache_callees(names)
+
+        template = make_template(code, bases, counts, names, callees)
+
+        # Only store code which can be rebuilt exactly
+        if template is None or fill_template(template, bases,
+                                             callees) != code:
+            return
+
+        # The labels of the frames and calls are stored the same way
+        frames, calls = self.frames_since(marks)
+        labels = ([label for label, _, _ in frames] +
+                  [label for call in calls for label in call])
+        label_template = make_template(labels, bases, counts, names, callees)
+
+        if label_template is None or fill_template(label_template, bases,
+                                                   callees) != labels:
+            return
+
+        frame_labels = label_template[:len(frames)]
+        call_labels = label_template[len(frames):]
+
+        self._code_cache.put(key, {
+            'name': id_obj.name,
+            'label': id_obj.mm_ptr - bases[0],
+            'params': [[p.id.name, p.id.type, p.id.size, p.id.mm_ptr,
+                        p.direction] for p in id_obj.params],
+            'code': template,
+            'counts': counts,
+            'frames': [[label, frame[1], frame[2]]
+                       for label, frame in zip(frame_labels, frames)],
+            'calls': [call_labels[index:index + 2]
+                      for index in range(0, len(call_labels), 2)],
+            'local_ptr': self._local_ptr,
+            'param_ptr': self._param_ptr,
+        })
+
         return
 
     def _parse_procedure_header(self, is_global):
@@ -400,6 +850,9 @@ class Parser(Scanner, CodeGenerator):
 
         id_obj = Identifier(id_name, 'function', None, params, label_id)
 
+        self.add_profile_slot('function', id_name, self._scope_name(),
+                              id_line, label=(id_name, label_id))
+
         try:
             # Add the procedure identifier to the parent and its own table
             self._ids.add(id_obj, is_global=is_global)
@@ -412,12 +865,14 @@ class Parser(Scanner, CodeGenerator):
         # Attempt to add each encountered param at the procedure scope
         for param in params:
             try:
-                self._ids.add(param.id, is_global=False)
+                self._ids.add(param.id, is_global=False,
+                              direction=param.direction)
             except ParserNameError:
                 self._name_error('name already declared at global scope',
                                  param.id.name, id_line)
 
         # Define the entry point for the function w/ unique identifier
+        self.open_procedure(id_obj.name, id_obj.mm_ptr, len(params))
         self.generate('%s_%d:' % (id_obj.name, id_obj.mm_ptr))
         self.tab_push()
 
@@ -437,6 +892,8 @@ class Parser(Scanner, CodeGenerator):
 
         # Accept any declarations
         while not self._accept('keyword', 'body'):
+            start = self._current
+
             try:
                 size = self._parse_declaration()
 
@@ -444,9 +901,9 @@ class Parser(Scanner, CodeGenerator):
                 if size is not None:
                     local_var_size += size
             except ParserError:
-                self._resync_at_token('symbol', ';')
-
-            self._match('symbol', ';')
+                self._resync('declaration', start)
+            else:
+                self._match('symbol', ';')
 
         # Define the function begin point
         self.generate('%s_%d_body:' %
@@ -454,21 +911,26 @@ class Parser(Scanner, CodeGenerator):
 
         self.tab_push()
 
-        if local_var_size != 0:
-            self.comment('Allocating space for local variables', self.debug)
-            self.generate('R[SP] = R[SP] - %d;' % local_var_size)
+        self.generate_frame_allocation(local_var_size, self.debug)
 
         # Accept any statements
+        returned = self._returned
+        self._returned = False
+
         while not self._accept('keyword', 'finish'):
+            start = self._current
+
             try:
                 self._parse_statement()
             except ParserError:
-                self._resync_at_token('symbol', ';')
-
-            self._match('symbol', ';')
+                self._resync('statement', start)
+            else:
+                self._match('symbol', ';')
 
         self._match('keyword', 'function')
 
+        self._returned = returned
+
         # Generate code to jump back to the caller scope
         self.generate_return(self.debug)
         self.generate('')
@@ -476,18 +938,17 @@ class Parser(Scanner, CodeGenerator):
         self.tab_pop()
         self._ids.pop_scope()
         self.tab_pop()
+        self.close_procedure()
 
         return
 
     def _parse_parameter_list(self, params):
         """37"""
-        # Get one parameter
-        param = self._parse_parameter()
-        params.append(param)
+        # Get one parameter, then all following parameters
+        params.append(self._parse_parameter())
 
-        # Get all following parameters
-        if self._accept('symbol', ','):
-            params = self._parse_parameter_list(params)
+        while self._accept('symbol', ','):
+            params.append(self._parse_parameter())
 
         # All parameters found will be returned in the list
         return params
@@ -512,25 +973,48 @@ class Parser(Scanner, CodeGenerator):
 
     def _parse_statement(self):
         """39"""
-        if self._accept('keyword', 'return'):
-            # Go to the return label to exit the procedure/program
-            self.generate_return(self.debug)
-        elif self._first_if_statement():
-            self._parse_if_statement()
-        elif self._first_loop_statement():
-            self._parse_loop_statement()
-        elif self._first_procedure_call():
-            self._parse_procedure_call()
-        elif self._first_assignment_statement():
-            self._parse_assignment_statement()
+        token = self._current
+        handlers = self._statement_handlers
+
+        handler = handlers.get((token.type, token.value))
+        if handler is None:
+            handler = handlers.get((token.type, None))
+
+        if handler is None:
+            # Anything else followed by "(" can only be a procedure call
+            if not self._first_procedure_call():
+                self._syntax_error('statement')
+
+            handler = self._parse_procedure_call
+
+        # Statements after a return can never run, so their code is dropped
+        if self._returned and self._optimize:
+            start = len(self._generated_code)
+            handler()
+            self.discard_code(start)
         else:
-            self._syntax_error('statement')
+            handler()
 
         return
 
-    def _first_assignment_statement(self):
+    def _parse_return_statement(self):
         """40"""
-        return self._check('identifier')
+        self._match('keyword', 'return')
+
+        # Go to the return label to exit the procedure/program
+        self.generate_return(self.debug)
+        self._returned = True
+
+        return
+
+    def _parse_identifier_statement(self):
+        """77"""
+        if self._first_procedure_call():
+            self._parse_procedure_call()
+        else:
+            self._parse_assignment_statement()
+
+        return
 
     def _parse_assignment_statement(self):
         """41"""
@@ -555,16 +1039,14 @@ class Parser(Scanner, CodeGenerator):
         if dest_type != expr_type:
             self._type_error(dest_type, expr_type, id_line)
 
-        # Determine the location of the identifier in the stack
-        id_location = self._ids.get_id_location(id_name)
+        # The location of the identifier in the stack
+        id_location = id_obj.storage
 
         # Verify the direction of the id if it is a param
-        if id_location == 'param':
-            direction = self._ids.get_param_direction(id_name)
-            if direction != 'out':
-                self._type_error('\'out\' param',
-                                 '\'%s\' param' % direction, id_line)
-                raise ParserTypeError()
+        if id_location == 'param' and id_obj.direction != 'out':
+            self._type_error('\'out\' param',
+                             '\'%s\' param' % id_obj.direction, id_line)
+            raise ParserTypeError()
 
         # Generate all code associated with retrieving this value
         self.generate_assignment(id_obj, id_location, index_reg, expr_reg,
@@ -572,10 +1054,6 @@ class Parser(Scanner, CodeGenerator):
 
         return
 
-    def _first_if_statement(self):
-        """42"""
-        return self._check('keyword', 'if')
-
     def _parse_if_statement(self):
         """43"""
         self._match('keyword', 'if')
@@ -587,16 +1065,23 @@ class Parser(Scanner, CodeGenerator):
         label_id = self.get_label_id()
         expr_reg = self.get_reg(inc=False)
 
-        self.generate('if (!R[%d]) goto else_%d;' % (expr_reg, label_id))
+        self.generate_branch(expr_reg, 'else_%d' % label_id)
         self.tab_push()
 
+        # The code after the if statement can only be left out if both of
+        # its branches return
+        returned = self._returned
+        self._returned = False
+
         while True:
+            start = self._current
+
             try:
                 self._parse_statement()
             except ParserError:
-                self._resync_at_token('symbol', ';')
-
-            self._match('symbol', ';')
+                self._resync('statement', start)
+            else:
+                self._match('symbol', ';')
 
             if self._check('keyword', 'else') or self._check('keyword', 'finish'):
                 break
@@ -607,14 +1092,19 @@ class Parser(Scanner, CodeGenerator):
         self.generate('else_%d:' % label_id)
         self.tab_push()
 
+        then_returned = self._returned
+        self._returned = False
+
         if self._accept('keyword', 'else'):
             while True:
+                start = self._current
+
                 try:
                     self._parse_statement()
                 except ParserError:
-                    self._resync_at_token('symbol', ';')
-
-                self._match('symbol', ';')
+                    self._resync('statement', start)
+                else:
+                    self._match('symbol', ';')
 
                 if self._check('keyword', 'finish'):
                     break
@@ -625,11 +1115,9 @@ class Parser(Scanner, CodeGenerator):
         self.tab_pop()
         self.generate('endif_%d:' % label_id)
 
-        return
+        self._returned = returned or (then_returned and self._returned)
 
-    def _first_loop_statement(self):
-        """44"""
-        return self._check('keyword', 'for')
+        return
 
     def _parse_loop_statement(self):
         """45"""
@@ -637,35 +1125,53 @@ class Parser(Scanner, CodeGenerator):
         self._match('symbol', '(')
 
         label_id = self.get_label_id()
+
+        slot = self.add_profile_slot('loop', 'loop_%d' % label_id,
+                                     self._scope_name(), self._previous.line)
+        self.open_profile_loop(slot)
+
         self.generate('loop_%d:' % label_id)
         self.tab_push()
 
+        start = self._current
+
         try:
             self._parse_assignment_statement()
         except ParserError:
-            self._resync_at_token('symbol', ';')
-
-        self._match('symbol', ';')
+            self._resync('statement', start)
+        else:
+            self._match('symbol', ';')
 
         self._parse_expression()
         self._match('symbol', ')')
 
         expr_reg = self.get_reg(inc=False)
-        self.generate('if (!R[%d]) goto endloop_%d;' % (expr_reg, label_id))
+        self.generate_branch(expr_reg, 'endloop_%d' % label_id)
+        self.generate_profile_count(slot)
+
+        # The loop body may never run, so a return in it does not make the
+        # code after the loop unreachable
+        returned = self._returned
+        self._returned = False
 
         while not self._accept('keyword', 'finish'):
+            start = self._current
+
             try:
                 self._parse_statement()
             except ParserError:
-                self._resync_at_token('symbol', ';')
-
-            self._match('symbol', ';')
+                self._resync('statement', start)
+            else:
+                self._match('symbol', ';')
 
         self._match('keyword', 'for')
 
+        self._returned = returned
+
         self.generate('goto loop_%d;' % label_id)
         self.tab_pop()
         self.generate('endloop_%d:' % label_id)
+        self.close_profile_loop(slot)
 
         return
 
@@ -727,11 +1233,8 @@ class Parser(Scanner, CodeGenerator):
                 # Get the identifier object of the destination
                 out_id = self._ids.find(out_name)
 
-                # Determine where on the stack this identifier exists
-                out_location = self._ids.get_id_location(out_name)
-
                 # Store the parameter in the appropriate location
-                self.generate_param_store(out_id, out_location, self.debug)
+                self.generate_param_store(out_id, out_id.storage, self.debug)
 
         # Finish the procedure call
         self.generate_procedure_call_end(self.debug)
@@ -740,47 +1243,51 @@ class Parser(Scanner, CodeGenerator):
 
     def _parse_argument_list(self, params, out_names, index=0):
         """48"""
-        arg_line = self._current.line
-        arg_type = None
+        # Holds the register of each argument in the order parsed
+        arg_regs = []
 
-        # Make sure that too many arguments are not used
-        if index > len(params) - 1:
-            self._runtime_error('procedure call accepts only %d argument(s)' %
-                                len(params), arg_line)
-            raise ParserRuntimeError()
+        while True:
+            arg_line = self._current.line
+            arg_type = None
 
-        # Get the parameter information for this position in the arg list
-        param = params[index]
+            # Make sure that too many arguments are not used
+            if index > len(params) - 1:
+                self._runtime_error(
+                    'procedure call accepts only %d argument(s)' %
+                    len(params), arg_line)
+                raise ParserRuntimeError()
 
-        if param.direction == 'out':
-            # We may only parse a single identifier if the direction is 'out'
-            arg_name = self._current.value
-            arg_type = self._parse_name()
+            # Get the parameter information for this position in the list
+            param = params[index]
 
-            out_names.append(arg_name)
-        elif param.direction == 'in':
-            # This is a 'in' parameter with only one element (not array)
-            arg_type = self._parse_expression()
+            if param.direction == 'out':
+                # We may only parse a single identifier if the direction is
+                # 'out'
+                arg_name = self._current.value
+                arg_type = self._parse_name()
 
-            out_names.append(None)
+                out_names.append(arg_name)
+            elif param.direction == 'in':
+                # This is a 'in' parameter with only one element (not array)
+                arg_type = self._parse_expression()
 
-        # Get the last reg assignment in the expr. This is argument's register
-        expr_reg = self.get_reg(inc=False)
+                out_names.append(None)
 
-        if arg_type != param.id.type:
-            self._type_error(param.id.type, arg_type, arg_line)
+            # Get the last reg assignment in the expr. This is the argument's
+            # register
+            arg_regs.append(self.get_reg(inc=False))
 
-        index += 1
+            if arg_type != param.id.type:
+                self._type_error(param.id.type, arg_type, arg_line)
 
-        if self._accept('symbol', ','):
-            index, out_names = self._parse_argument_list(
-                params,
-                out_names,
-                index=index)
+            index += 1
+
+            if not self._accept('symbol', ','):
+                break
 
-        # Push the parameters onto the stack in reverse order. The last param
-        # will reach this point first
-        self.generate_param_push(expr_reg, self.debug)
+        # Push the parameters onto the stack in reverse order
+        for expr_reg in reversed(arg_regs):
+            self.generate_param_push(expr_reg, self.debug)
 
         return index, out_names
 
@@ -820,201 +1327,185 @@ class Parser(Scanner, CodeGenerator):
 
     def _parse_expression(self):
         """50"""
-        self.comment('Parsing expression', self.debug)
-
-        negate = False
+        # Operands and pending operations are kept on an explicit stack
+        # rather than the Python call stack, so that deeply nested
+        # parentheses and array indexes can not exhaust the recursion limit
+        stack = []
+        self._open_expression(stack, None, None)
 
-        if self._accept('keyword', 'not'):
-            negate = True
-
-        line = self._current.line
-        id_type = self._parse_arith_op()
-
-        if negate and id_type not in ['int', 'bool']:
-            self._type_error('int or bool', id_type, line)
-            raise ParserTypeError()
+        binding_powers = self.binding_powers
 
         while True:
-            operand1 = self.get_reg(inc=False)
-
-            if self._accept('symbol', '&'):
-                operation = '&'
-            elif self._accept('symbol', '|'):
-                operation = '|'
-            else:
-                break
-
-            if id_type not in ['int', 'bool']:
-                self._type_error('int or bool', id_type, line)
-                raise ParserTypeError()
-
-            next_type = self._parse_arith_op()
-
-            operand2 = self.get_reg(inc=False)
-
-            if next_type not in ['int', 'bool']:
-                self._type_error('int or bool', next_type, line)
-                raise ParserTypeError()
-
-            result = self.generate_operation(operand1, id_type, operand2,
-                                             next_type, operation)
+            line = self._current.line
+            id_type = self._parse_factor(stack, line)
 
-            if negate:
-                self.generate('R[%d] = ~R[%d];' % (result, result))
+            # The factor opened a nested expression, parse its first factor
+            if id_type is None:
+                continue
 
-        return id_type
+            while True:
+                token = self._current
+                power = 0
 
-    def _parse_arith_op(self):
-        """51"""
-        line = self._current.line
-        id_type = self._parse_relation()
+                if token.type == 'symbol':
+                    power = binding_powers.get(token.value, 0)
 
-        while True:
-            operand1 = self.get_reg(inc=False)
+                # Complete the pending operations binding at least as tight
+                # as the next operator. The result has the left operand type
+                limit = power or 1
+                while stack[-1][0] >= limit:
+                    id_type, line = self._complete_operation(stack.pop(),
+                                                             id_type)
 
-            if self._accept('symbol', '+'):
-                operation = '+'
-            elif self._accept('symbol', '-'):
-                operation = '-'
-            else:
-                break
+                base = stack[-1]
 
-            if id_type not in ['int', 'float']:
-                self._type_error('int or float', id_type, line)
-                raise ParserTypeError()
+                # "not" only applies to operands of "&" and "|"
+                if power <= 1 and base[1] and id_type not in ['int', 'bool']:
+                    self._type_error('int or bool', id_type, line)
+                    raise ParserTypeError()
 
-            next_type = self._parse_relation()
+                if power:
+                    break
 
-            operand2 = self.get_reg(inc=False)
-            
-            if next_type not in ['int', 'float']:
-                self._type_error('int or float', next_type, line)
-                raise ParserTypeError()
+                # The expression is complete, close it
+                stack.pop()
 
-            self.generate_operation(operand1, id_type, operand2, next_type,
-                                    operation)
+                if base[2] is None:
+                    return id_type
+                elif base[2] == ')':
+                    self._match('symbol', ')')
+                else:
+                    self._parse_name_index(base[2], id_type)
+                    id_type = self._parse_name_tail(base[2], indexed=True)
 
-        return id_type
+                line = base[3]
 
-    def _parse_relation(self):
-        """52 """
-        line = self._current.line
-        id_type = self._parse_term()
-
-        # Check for relational operators. Note that relational operators
-        # are only valid for integer or boolean tokens
-        while True:
+            # Start a new operation with the value as its left operand
+            types, expected = self.operand_types[power]
             operand1 = self.get_reg(inc=False)
 
-            if self._accept('symbol', '<'):
-                operation = '<'
-            elif self._accept('symbol', '>'):
-                operation = '>'
-            elif self._accept('symbol', '<='):
-                operation = '<='
-            elif self._accept('symbol', '>='):
-                operation = '>='
-            elif self._accept('symbol', '=='):
-                operation = '=='
-            elif self._accept('symbol', '!='):
-                operation = '!='
-            else:
-                break
+            self._advance_token()
 
-            if id_type not in ['int', 'bool']:
-                self._type_error('int or bool', id_type, line)
+            if id_type not in types:
+                self._type_error(expected, id_type, line)
                 raise ParserTypeError()
 
-            next_type = self._parse_term()
+            # Terms report errors in their right operand at its own line
+            error_line = self._current.line if power == 4 else line
+            negate = base[1] and power == 1
+            skip = self.open_short_circuit(operand1, id_type, token.value)
 
-            operand2 = self.get_reg(inc=False)
+            stack.append([power, id_type, operand1, token.value, line,
+                          error_line, negate, skip])
 
-            if next_type not in ['int', 'bool']:
-                self._type_error('int or bool', next_type, line)
-                raise ParserTypeError()
-
-            self.generate_operation(operand1, id_type, operand2, next_type,
-                                    operation)
-
-        return id_type
+    def _open_expression(self, stack, closer, line):
+        """51"""
+        self.comment('Parsing expression', self.debug)
 
-    def _parse_term(self):
-        """53"""
-        line = self._current.line
-        id_type = self._parse_factor()
+        negate = self._accept('keyword', 'not')
 
-        # Check for multiplication or division operators. Note that these
-        # operators are only valid for integer or float values
-        while True:
-            operand1 = self.get_reg(inc=False)
+        # The base of an expression holds power 0, the negate flag, what
+        # closes the expression (None, ')' or the name being indexed) and
+        # the line the enclosing operand started at
+        stack.append([0, negate, closer, line])
 
-            if self._accept('symbol', '*'):
-                operation = '*'
-            elif self._accept('symbol', '/'):
-                operation = '/'
-            else:
-                break
+        return
 
-            if id_type not in ['int', 'float']:
-                self._type_error('int or float', id_type, line)
-                raise ParserTypeError()
+    def _complete_operation(self, entry, rhs_type):
+        """52"""
+        (power, lhs_type, operand1, operation, line, error_line, negate,
+         skip) = entry
+        types, expected = self.operand_types[power]
 
-            line = self._current.line
-            next_type = self._parse_factor()
+        operand2 = self.get_reg(inc=False)
 
-            operand2 = self.get_reg(inc=False)
+        if rhs_type not in types:
+            self._type_error(expected, rhs_type, error_line)
+            raise ParserTypeError()
 
-            if next_type not in ['int', 'float']:
-                self._type_error('int or float', next_type, line)
-                raise ParserTypeError()
+        if skip is None:
+            result = self.generate_operation(operand1, lhs_type, operand2,
+                                             rhs_type, operation)
+        else:
+            result = self.close_short_circuit(operand1, operand2, rhs_type,
+                                              operation, skip)
 
-            self.generate_operation(operand1, id_type, operand2, next_type,
-                                    operation)
+        if negate:
+            self.generate('R[%d] = ~R[%d];' % (result, result))
 
-        return id_type
+        return lhs_type, line
 
-    def _parse_factor(self):
+    def _parse_factor(self, stack, line):
         """54"""
+        token = self._current
+        token_type = token.type
         id_type = None
 
-        if self._accept('symbol', '('):
-            id_type = self._parse_expression()
-            self._match('symbol', ')')
-        elif self._accept('str'):
+        # Dispatch on the token type first, so that the common factors need
+        # only one or two compares
+        if token_type == 'identifier':
+            id_type = self._parse_factor_name(stack, line)
+        elif token_type == 'int' or token_type == 'float':
+            id_type = self._parse_number(negate=False)
+        elif token_type == 'symbol' and token.value == '(':
+            self._advance_token()
+            self._open_expression(stack, ')', line)
+        elif token_type == 'symbol' and token.value == '-':
+            self._advance_token()
+
+            if self._first_name():
+                id_type = self._parse_factor_name(stack, line)
+            elif self._check('int') or self._check('float'):
+                id_type = self._parse_number(negate=True)
+            else:
+                self._syntax_error('variable name, int, or float')
+        elif token_type == 'str':
+            self._advance_token()
             id_type = 'str'
-            str_val = self._previous.value
 
-            self.generate('R[%d] = (int)"%s";' % (self.get_reg(), str_val))
-        elif self._accept('keyword', 'true'):
+            self.generate('R[%d] = (int)"%s";' % (self.get_reg(), token.value))
+        elif token_type == 'keyword' and token.value == 'true':
+            self._advance_token()
             id_type = 'bool'
 
             self.generate('R[%d] = 1;' % (self.get_reg()))
-        elif self._accept('keyword', 'false'):
+        elif token_type == 'keyword' and token.value == 'false':
+            self._advance_token()
             id_type = 'bool'
 
             self.generate('R[%d] = 0;' % (self.get_reg()))
-        elif self._accept('symbol', '-'):
-            if self._first_name():
-                id_type = self._parse_name()
-            elif self._check('int') or self._check('float'):
-                id_type = self._parse_number(negate=True)
-            else:
-                self._syntax_error('variable name, int, or float')
-        elif self._first_name():
-            id_type = self._parse_name()
-        elif self._check('int') or self._check('float'):
-            id_type = self._parse_number(negate=False)
         else:
             self._syntax_error('factor')
 
         return id_type
 
+    def _parse_factor_name(self, stack, line):
+        """73"""
+        name = self._parse_name_head()
+
+        # An array index is parsed as a nested expression on the stack
+        if self._accept('symbol', '['):
+            self._open_expression(stack, name, line)
+            return None
+
+        return self._parse_name_tail(name, indexed=False)
+
     def _first_name(self):
         """55"""
         return self._check('identifier')
 
     def _parse_name(self):
         """56"""
+        name = self._parse_name_head()
+        indexed = self._accept('symbol', '[')
+
+        if indexed:
+            self._parse_name_index(name, self._parse_expression())
+
+        return self._parse_name_tail(name, indexed)
+
+    def _parse_name_head(self):
+        """74"""
         id_name = self._current.value
         id_line = self._current.line
 
@@ -1033,35 +1524,43 @@ class Parser(Scanner, CodeGenerator):
             self._type_error('variable', id_type, id_line)
             raise ParserTypeError()
 
-        if self._accept('symbol', '['):
-            index_type = self._parse_expression()
+        return id_name, id_line, id_obj
 
-            if not index_type == 'int':
-                self._type_error('int', index_type, id_line)
-                raise ParserTypeError()
+    def _parse_name_index(self, name, index_type):
+        """75"""
+        id_name, id_line, id_obj = name
 
-            self._match('symbol', ']')
-        elif id_obj.size is not None:
+        if not index_type == 'int':
+            self._type_error('int', index_type, id_line)
+            raise ParserTypeError()
+
+        self._match('symbol', ']')
+
+        return
+
+    def _parse_name_tail(self, name, indexed):
+        """76"""
+        id_name, id_line, id_obj = name
+
+        if not indexed and id_obj.size is not None:
             self._runtime_error('%s: array requires index' % id_name, id_line)
 
         # Get the last register allocated. The index will be here if it's used
         index_reg = self.get_reg(inc=False)
 
-        # Determine the location of the identifier in the stack
-        id_location = self._ids.get_id_location(id_name)
+        # The location of the identifier in the stack
+        id_location = id_obj.storage
 
         # Verify the direction of the id if it is a param
-        if id_location == 'param':
-            direction = self._ids.get_param_direction(id_name)
-            if direction != 'in':
-                self._type_error('\'in\' param',
-                                 '\'%s\' param' % direction, id_line)
-                raise ParserTypeError()
+        if id_location == 'param' and id_obj.direction != 'in':
+            self._type_error('\'in\' param',
+                             '\'%s\' param' % id_obj.direction, id_line)
+            raise ParserTypeError()
 
         # Generate all code associated with retrieving this value
         self.generate_name(id_obj, id_location, index_reg, self.debug)
 
-        return id_type
+        return id_obj.type
 
     def _parse_number(self, negate=False, generate_code=True):
         """57"""
@@ -12,6 +12,7 @@ Classes:
 from os.path import isfile
 
 from lib.data_type import Token
+from lib.diagnostics import DiagnosticCollector
 
 
 class Scanner:
@@ -32,6 +33,12 @@ class Scanner:
     def __init__(self):
         super().__init__()
 
+        self.reset_scanner()
+
+        return
+
+    def reset_scanner(self):
+        """79"""
         # Holds the file path of the attached source file
         self._src_path = ''
 
@@ -42,6 +49,9 @@ class Scanner:
         self._line_pos = 0
         self._char_pos = 0
 
+        # Holds all warnings and errors found in the source file
+        self.diagnostics = DiagnosticCollector()
+
         return
 
     def attach_source(self, src_path):
@@ -52,55 +62,107 @@ class Scanner:
             print('    Inputted path is not a file')
             return False
 
-        # Try to read all data from the file and split by line
+        # Try to read all data from the file
         try:
             with open(src_path) as f:
-                keepends = True
-                self._src = f.read().splitlines(keepends)
+                text = f.read()
         except IOError:
             print('Error: "%s"' % src_path)
             print('    Could not read inputted file')
             return False
 
-        # The file was attached and read successfully, store the path
+        # The file was read successfully, attach its contents
+        return self.attach_text(text, src_path)
+
+    def attach_text(self, text, src_path='<string>'):
+        """80"""
+        # Split the source by line, keeping the line endings
+        keepends = True
+        self._src = text.splitlines(keepends)
+        self._line_pos = 0
+        self._char_pos = 0
+
+        # Store the name the source is reported under
         self._src_path = src_path
 
         return True
 
     def next_token(self):
         """3"""
-        # Get the first character, narrow down the data type possibilities
-        char = self._next_word()
-
-        if char is None:
-            return Token('eof', None, self._line_pos)
-
-        # Use the first character to choose the token type to expect
-        if char == '"':
-            value, token_type = self._expect_string()
-        elif char.isdigit():
-            value, token_type = self._expect_number(char)
-        elif char.isalpha():
-            value, token_type = self._expect_identifier(char)
-        elif char in self.symbols:
-            value, token_type = self._expect_symbol(char)
-        else:
-            # We've run across a character that shouldn't be here
-            msg = 'Invalid character \'%s\' encountered' % char
-            self._scan_warning(msg, hl=self._char_pos-1)
-
-            # Run this function again until we find something good
-            return self.next_token()
-
-        if token_type == 'comment':
-            # If we find a comment, get a token on the next line
-            self._next_line()
-            return self.next_token()
-
-        # Build the new token object
-        new_token = Token(token_type, value, self._line_pos+1)
-
-        return new_token
+        # Skip comments and invalid characters in a loop rather than by
+        # recursion, so that long runs of them can not exhaust the stack
+        while True:
+            # Get the first character, narrow down the data type possibilities
+            char = self._next_word()
+
+            if char is None:
+                return Token('eof', None, self._line_pos, None)
+
+            # The first character has been consumed, so this is its 1-based
+            # column
+            column = self._char_pos
+
+            # Use the first character to choose the token type to expect
+            if char == '"':
+                value, token_type = self._expect_string()
+            elif char.isdigit():
+                value, token_type = self._expect_number(char)
+            elif char.isalpha():
+                value, token_type = self._expect_identifier(char)
+            elif char in self.symbols:
+                value, token_type = self._expect_symbol(char)
+            else:
+                # We've run across a character that shouldn't be here
+                msg = 'Invalid character \'%s\' encountered' % char
+                self._scan_warning(msg, hl=self._char_pos-1)
+
+                # Keep scanning until we find something good
+                continue
+
+            if token_type == 'comment':
+                # If we find a comment, get a token on the next line
+                if not self._next_line():
+                    return Token('eof', None, self._line_pos, None)
+
+                continue
+
+            # Build the new token object
+            return Token(token_type, value, self._line_pos+1, column)
+
+    def scan_line(self, line, last_column=None):
+        """65"""
+        # Scan the line on its own. Tokens never span more than one line
+        self._src = [line]
+        self._line_pos = 0
+        self._char_pos = 0
+
+        first_warning = len(self.diagnostics.records)
+        tokens = []
+
+        # Holds the index of the token being read when each warning was
+        # reported, or the number of tokens if it was the end of the line
+        reads = []
+
+        token = self.next_token()
+        while True:
+            reported = len(self.diagnostics.records) - first_warning
+            reads += [len(tokens)] * (reported - len(reads))
+
+            if token.type == 'eof':
+                break
+
+            tokens.append(token)
+
+            # Stop like a parser would after reading its last token
+            if token.column == last_column:
+                break
+
+            token = self.next_token()
+
+        # Hand the warnings of this line over to the caller
+        warnings = self.diagnostics.detach(first_warning)
+
+        return tokens, warnings, reads
 
     def _get_line(self, line_number):
         """4"""
@@ -109,18 +171,17 @@ class Scanner:
 
     def _scan_warning(self, msg, hl=-1):
         """5"""
-        line = self._src[self._line_pos][0:-1]
+        column = hl + 1 if hl != -1 else None
 
-        print('Warning: "', self._src_path, '", ', sep='', end='')
-        print('line ', self._line_pos+1, sep='')
-        print('    ', msg, '\n    ', line.strip(), sep='')
-
-        if hl != -1:
-            left_spaces = line.find(line.strip()[0])
-            print('    %s^' % (' '*(abs(hl)-left_spaces)))
+        self.diagnostics.add('warning', 'scan-warning', self._line_pos+1, msg,
+                             column=column)
 
         return
 
+    def render_diagnostics(self, fmt='text'):
+        """59"""
+        return self.diagnostics.render(fmt, self._src_path, self._src)
+
     def _next_word(self):
         """6"""
         char = ''
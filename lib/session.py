@@ -0,0 +1,112 @@
+"""Session module
+
+Provides a compiler session for long-running processes, such as a compile
+server or a benchmark, which compile many programs one after another. The
+session keeps a single parser and resets it between compiles instead of
+building a new one, and works on source text in memory. No source file is
+read and no code file is written.
+
+Author: RDDS TEAM
+
+Classes:
+    CompileResult: A named tuple object containing the result of a compile.
+    CompilerSession: Compiles or checks source text in memory.
+"""
+
+from collections import namedtuple
+
+from lib.rd_parser import Parser
+
+# The code is None if the source has errors
+CompileResult = namedtuple('CompileResult', ['success', 'code', 'diagnostics'])
+
+
+class CompilerSession:
+    """Compiler Session
+
+    Compiles source text to C code with one reusable parser. The options
+    given when the session is created apply to every compile.
+    """
+    def __init__(self, debug=False, profile=None, line_directives=False,
+                 max_errors=None, code_cache=None, optimize=False,
+                 fast_io=False, recursion_depth=None, inline_size=None,
+                 short_circuit=False):
+        super().__init__()
+
+        # Holds the parser used for every compile
+        self._parser = Parser(debug, profile=profile,
+                              line_directives=line_directives,
+                              max_errors=max_errors, code_cache=code_cache,
+                              optimize=optimize, fast_io=fast_io,
+                              recursion_depth=recursion_depth,
+                              inline_size=inline_size,
+                              short_circuit=short_circuit)
+
+        return
+
+    def reset(self):
+        """Reset Session
+
+        Drops all state left by the last compile. compile() resets the
+        session itself, so this is only needed to release the memory held
+        by the last compile early.
+        """
+        self._parser.reset()
+
+        return
+
+    def compile(self, source_text, src_path='<string>'):
+        """Compile Source Text
+
+        Compiles a complete program.
+
+        Arguments:
+            source_text: The source code of the program.
+            src_path: The name the source is reported under in #line
+                directives. (Default: '<string>')
+
+        Returns:
+            A CompileResult holding the generated C code and the diagnostics
+            of the compile.
+        """
+        parser = self._parser
+
+        if not parser.parse_text(source_text, src_path):
+            return CompileResult(False, None, parser.diagnostics)
+
+        code, _ = parser.render()
+
+        return CompileResult(True, code, parser.diagnostics)
+
+    def check(self, source_text, src_path='<string>'):
+        """Check Source Text
+
+        Scans, parses, scope checks and type checks a complete program
+        without generating code, which is cheap enough to run on every
+        pause in typing.
+
+        Arguments:
+            source_text: The source code of the program.
+            src_path: The name the source is reported under.
+                (Default: '<string>')
+
+        Returns:
+            A CompileResult holding no code and the diagnostics of the
+            check.
+        """
+        parser = self._parser
+
+        success = parser.check_text(source_text, src_path)
+
+        return CompileResult(success, None, parser.diagnostics)
+
+    def render_diagnostics(self, fmt='text'):
+        """Render Diagnostics
+
+        Arguments:
+            fmt: Either 'text' or 'json'. (Default: 'text')
+
+        Returns:
+            The warning and error report of the last compile.
+        """
+        return self._parser.render_diagnostics(fmt)
@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""Check Test module
+
+Checks that checking source text in memory gives the same report as
+checking the source file and as compiling it. The sample programs in
+rdds_tests and a set of programs with errors are checked with
+Parser.check(), Parser.check_text() and CompilerSession.check(), with
+and without -O, and compiled with CompilerSession.compile(). The parser
+and sessions are reused for every program, as an editor would.
+
+The IncrementalChecker must give the same report as Parser.check() for
+every program, and again after statements are edited in place so that
+scanner warnings and parser errors land on the same line.
+
+Run from the repository root:
+
+    python3 rdds_tests/check_test.py
+
+Author: RDDS Team
+
+Functions:
+    check_program: Checks that every entry point gives the same report.
+    check_edits: Checks the IncrementalChecker after edits.
+    main: Runs every check test.
+"""
+
+import glob
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.incremental import IncrementalChecker
+from lib.rd_parser import Parser
+from lib.session import CompilerSession
+
+# Programs with scanner warnings, name errors, type errors and syntax
+# errors, some of them on the same line or at the end of a block
+BROKEN_PROGRAMS = [
+    ('undeclared', 'the program p is\ndefine\nbody\n    x = 1;\n'
+                   'finish program\n'),
+    ('same line', 'the program p is\ndefine\nbody\n    x = ) $;\n'
+                  'finish program\n'),
+    ('type error', 'the program p is\ndefine\n    int x;\n    bool b;\n'
+                   'body\n    x = b + 1.5;\n    putint(x);\nfinish program\n'),
+    ('syntax error', 'the program p is\ndefine\n    int x;\nbody\n'
+                     '    x = (1 + ;\n    putint(x);\nfinish program\n'),
+    ('bad call', 'the program p is\ndefine\n    function f(int a in) is\n'
+                 '    body\n        putint(a);\n    finish function;\nbody\n'
+                 '    f(1, 2);\n    f(true);\n    g(1);\nfinish program\n'),
+    ('junk', 'the program p is\ndefine\nbody\n    putint(1);\n'
+             'finish program\n# $ junk\n'),
+    ('no finish', 'the program p is\ndefine\n    global int result;\n'
+                  '    function c() is\n    body\n    finish function;\n'
+                  'body\n    result = counter;\n'),
+    ('block end', 'the program p is\ndefine\n    int x;\nbody\n'
+                  '    for (x = 1; x < 3)\n        x = x +\n    finish for;\n'
+                  '    if (x) then else x = 1; finish if;\n    putint(y);\n'
+                  'finish program\n'),
+]
+
+# Statements put in place of the first statement of the body, one after
+# another. Each reports a scanner warning and a parser error on one line
+EDITS = [
+    '    x = ) $;\n',
+    '    $ y = 1;\n',
+    '    putint(z $);\n',
+    '    putint(1 + "abc);\n',
+]
+
+
+def check_program(name, source, parser, sessions, directory):
+    """Check Program
+
+    Arguments:
+        name: The name of the program.
+        source: The source of the program.
+        parser: The Parser reused for every program.
+        sessions: The CompilerSession reused for every program, and one
+            with -O.
+        directory: The directory to write the source in.
+
+    Returns:
+        True if every entry point gives the same result and report, and
+        checking generates no code.
+    """
+    src_path = os.path.join(directory, 'check.src')
+
+    with open(src_path, 'w') as src_file:
+        src_file.write(source)
+
+    reports = []
+
+    success = parser.check(src_path)
+    reports.append(('Parser.check', success, parser.render_diagnostics()))
+
+    success = parser.check_text(source, src_path)
+    reports.append(('Parser.check_text', success,
+                    parser.render_diagnostics()))
+
+    if parser._generated_code:
+        print('FAIL %s: Parser.check_text generated code' % name)
+        return False
+
+    for session in sessions:
+        result = session.check(source, src_path)
+        reports.append(('CompilerSession.check', result.success,
+                        session.render_diagnostics()))
+
+        if result.code is not None:
+            print('FAIL %s: CompilerSession.check returned code' % name)
+            return False
+
+    session = sessions[0]
+    result = session.compile(source, src_path)
+    reports.append(('CompilerSession.compile', result.success,
+                    session.render_diagnostics()))
+
+    checker = IncrementalChecker(src_path)
+    success = checker.update(source)
+    reports.append(('IncrementalChecker', success,
+                    checker.render_diagnostics()))
+
+    _, expected_success, expected = reports[0]
+
+    for entry, success, report in reports[1:]:
+        if success != expected_success or report != expected:
+            print('FAIL %s: %s differs from Parser.check' % (name, entry))
+            return False
+
+    return True
+
+
+def check_edits(name, source, parser):
+    """Check Edits
+
+    Arguments:
+        name: The name of the program.
+        source: The source of the program.
+        parser: The Parser reused for every program.
+
+    Returns:
+        True if the IncrementalChecker gives the same report as
+        Parser.check_text() after each edit.
+    """
+    lines = source.splitlines(True)
+
+    # Edit the first statement of the body, which is parsed again on its
+    # own as long as the program structure is left alone
+    try:
+        index = next(index for index, line in enumerate(lines)
+                     if line.strip() == 'body') + 1
+    except StopIteration:
+        return True
+
+    if index >= len(lines) or not lines[index].strip().endswith(';'):
+        return True
+
+    checker = IncrementalChecker('<editor>')
+    checker.update(source)
+
+    for edit in EDITS:
+        lines[index] = edit
+        text = ''.join(lines)
+
+        success = checker.update(text)
+        expected_success = parser.check_text(text, '<editor>')
+
+        if (success != expected_success or
+                checker.render_diagnostics() != parser.render_diagnostics()):
+            print('FAIL %s: IncrementalChecker differs from Parser.check '
+                  'after %s' % (name, edit.strip()))
+            return False
+
+    return True
+
+
+def main():
+    """Main
+
+    Runs every check test.
+
+    Returns:
+        True if all tests pass, False otherwise.
+    """
+    sample_dir = os.path.dirname(os.path.abspath(__file__))
+
+    programs = []
+    for path in sorted(glob.glob(os.path.join(sample_dir, '*.src'))):
+        with open(path) as source_file:
+            programs.append((os.path.basename(path), source_file.read()))
+
+    programs += BROKEN_PROGRAMS
+
+    parser = Parser()
+    sessions = [CompilerSession(), CompilerSession(optimize=True)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = [check_program(name, source, parser, sessions, directory)
+                   for name, source in programs]
+
+    results += [check_edits(name, source, parser)
+                for name, source in programs]
+
+    print('%d of %d checks give the same report from every entry point' %
+          (results.count(True), len(results)))
+
+    return all(results)
+
+
+if __name__ == '__main__':
+    sys.exit(not main())
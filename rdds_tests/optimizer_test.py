@@ -0,0 +1,470 @@
+#!/usr/bin/env python3
+
+"""Optimizer Test module
+
+Checks that -O never changes what a program does. The sample programs in
+rdds_tests and a set of generated programs are compiled with and without
+-O, built, run with the same input, and their output and exit status are
+compared. Large generated programs are then compiled with -O at a quarter
+of their size and at full size, and the ratio of the compile times is
+printed. About 4 is linear, while a pass taking time quadratic in the
+length of a function, a loop body or an argument list gives about 16.
+
+Run from the repository root (gcc must be able to build with CC):
+
+    python3 rdds_tests/optimizer_test.py [--programs N] [--seed S] [--cc CC]
+
+Author: RDDS Team
+
+Classes:
+    ProgramGenerator: Builds random programs using the features -O
+        rewrites.
+
+Functions:
+    straight_line: Builds a program with a long run of straight-line code.
+    loop_body: Builds a program with a long loop body.
+    build_and_run: Builds and runs generated code.
+    check_program: Checks that -O keeps the output of a program.
+    main: Runs every optimizer test.
+"""
+
+import argparse
+import glob
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.session import CompilerSession
+from stress_test import check_scaling, long_call
+
+# The input given to every program, which every read of the sample programs
+# can parse
+PROGRAM_INPUT = '5\n1\n2\n3\n4\n5\n'
+
+# The longest a program may run, in seconds
+RUN_TIMEOUT = 10
+
+
+class ProgramGenerator:
+    """Program Generator
+
+    Builds random programs with nested loops over arrays, branches, calls
+    of small functions and self recursive functions. Every variable is
+    assigned before it is read and every array index stays within its
+    array, so the output of each program is fully defined.
+    """
+    # Holds the loop counters, one per nesting level
+    counters = ['i', 'j', 'k']
+
+    # Holds the bounds of the loops, all within the 8 element arrays
+    bounds = [2, 3, 4, 8]
+
+    def __init__(self, seed):
+        super().__init__()
+
+        # Holds the random number generator of the program
+        self._random = random.Random(seed)
+
+        return
+
+    def _value(self, names, counters):
+        """Random Value
+
+        Arguments:
+            names: The scalar variables which may be read.
+            counters: The loop counters which may be read.
+
+        Returns:
+            The source of a variable, array element or constant.
+        """
+        choice = self._random.random()
+
+        if choice < 0.3:
+            return self._random.choice(names)
+        elif choice < 0.45 and counters:
+            return self._random.choice(counters)
+        elif choice < 0.65:
+            index = (self._random.choice(counters)
+                     if counters and self._random.random() < 0.6
+                     else str(self._random.randint(0, 7)))
+            return 'ga[%s]' % index
+
+        return str(self._random.randint(0, 9))
+
+    def _expression(self, names, counters, depth=2):
+        """Random Expression
+
+        Arguments:
+            names: The scalar variables which may be read.
+            counters: The loop counters which may be read.
+            depth: The deepest the expression may nest.
+
+        Returns:
+            The source of an int expression.
+        """
+        if depth == 0 or self._random.random() < 0.3:
+            return self._value(names, counters)
+
+        left = self._expression(names, counters, depth - 1)
+        right = self._expression(names, counters, depth - 1)
+        operation = self._random.choice(['+', '-', '*', '+', '-'])
+
+        if self._random.random() < 0.2:
+            return '(%s %s %s)' % (left, operation, right)
+
+        return '%s %s %s' % (left, operation, right)
+
+    def _boolean(self):
+        """Random Boolean
+
+        Returns:
+            The source of a bool expression.
+        """
+        if self._random.random() < 0.2:
+            return self._random.choice(['true', 'false'])
+
+        return '%s %s %s' % (self._random.choice(['b0', 'b1']),
+                             self._random.choice(['&', '|']),
+                             self._random.choice(['b0', 'b1']))
+
+    def _condition(self, names, counters):
+        """Random Condition
+
+        Arguments:
+            names: The scalar variables which may be read.
+            counters: The loop counters which may be read.
+
+        Returns:
+            The source of a comparison or of a bool expression.
+        """
+        if self._random.random() < 0.25:
+            return self._boolean()
+
+        return '%s %s %s' % (self._value(names, counters),
+                             self._random.choice(['<', '>', '==', '!=',
+                                                  '<=', '>=']),
+                             self._expression(names, counters, 1))
+
+    def _statements(self, names, targets, calls, counters, depth, indent):
+        """Random Statements
+
+        Arguments:
+            names: The scalar variables which may be read.
+            targets: The scalar variables which may be assigned. The out
+                parameter r is never passed on to a call, as it cannot be
+                read.
+            calls: The functions which may be called.
+            counters: The loop counters of the enclosing loops.
+            depth: The deepest statements may nest.
+            indent: The indent of the statements.
+
+        Returns:
+            A list of source lines.
+        """
+        lines = []
+
+        for _ in range(self._random.randint(1, 4)):
+            choice = self._random.random()
+
+            if choice < 0.25:
+                lines.append('%s%s = %s;' % (
+                    indent, self._random.choice(targets),
+                    self._expression(names, counters)))
+            elif choice < 0.35:
+                index = (self._random.choice(counters) if counters
+                         else str(self._random.randint(0, 7)))
+                lines.append('%sga[%s] = %s;' % (
+                    indent, index, self._expression(names, counters)))
+            elif choice < 0.45:
+                lines.append('%sputint(%s);' % (
+                    indent, self._expression(names, counters)))
+            elif choice < 0.5:
+                lines.append('%s%s = %s;' % (
+                    indent, self._random.choice(['b0', 'b1']),
+                    self._boolean()))
+            elif choice < 0.6 and calls:
+                lines.append('%s%s(%s, %s);' % (
+                    indent, self._random.choice(calls),
+                    self._expression(names, counters, 1),
+                    self._random.choice([target for target in targets
+                                         if target != 'r'])))
+            elif choice < 0.75 and depth > 0:
+                lines.append('%sif (%s) then' % (
+                    indent, self._condition(names, counters)))
+                lines += self._statements(names, targets, calls, counters,
+                                          depth - 1, indent + '    ')
+                if self._random.random() < 0.5:
+                    lines.append('%selse' % indent)
+                    lines += self._statements(names, targets, calls,
+                                              counters, depth - 1,
+                                              indent + '    ')
+                lines.append('%sfinish if;' % indent)
+            elif choice < 0.9 and depth > 0 and len(counters) < 3:
+                counter = self.counters[len(counters)]
+                lines.append('%s%s = 0;' % (indent, counter))
+                lines.append('%sfor (%s = %s + 1; %s < %d)' % (
+                    indent, counter, counter, counter,
+                    self._random.choice(self.bounds)))
+                lines += self._statements(names, targets, calls,
+                                          counters + [counter], depth - 1,
+                                          indent + '    ')
+                lines.append('%sfinish for;' % indent)
+            elif choice < 0.93:
+                lines.append('%sreturn;' % indent)
+            else:
+                lines.append('%s%s = %s;' % (
+                    indent, self._random.choice(targets),
+                    self._expression(names, counters)))
+
+        return lines
+
+    def _function(self, name, calls):
+        """Random Function
+
+        Arguments:
+            name: The name of the function.
+            calls: The functions which may be called.
+
+        Returns:
+            A list of source lines.
+        """
+        lines = ['    global function %s(int a in, int r out) is' % name,
+                 '        int l0;', '        int l1;', '        int i;',
+                 '        int j;', '        int k;', '    body',
+                 '        r = 0;', '        l0 = a;', '        l1 = 1;']
+
+        lines += self._statements(['a', 'l0', 'l1', 'g0', 'g1'],
+                                  ['r', 'l0', 'l1', 'g0'], calls, [], 2,
+                                  '        ')
+        lines.append('    finish function;')
+
+        return lines
+
+    def _recursive_function(self):
+        """Random Recursive Function
+
+        Returns:
+            A list of source lines for rec(int n in), which calls itself
+            either last or before more statements.
+        """
+        lines = ['    global function rec(int n in) is', '        int l0;',
+                 '        int i;', '    body', '        l0 = n * 2;']
+
+        lines += self._statements(['n', 'l0', 'g0', 'g1'], ['l0', 'g1'], [],
+                                  [], 1, '        ')
+
+        call = ['        if (n > 0) then', '            rec(n - 1);',
+                '        finish if;']
+        tail = ['        g1 = g1 + l0;', '        ga[1] = ga[1] + n;']
+
+        if self._random.random() < 0.5:
+            lines += tail + call
+        else:
+            lines += call + tail
+
+        lines.append('    finish function;')
+
+        return lines
+
+    def program(self):
+        """Random Program
+
+        Returns:
+            The source of a program.
+        """
+        lines = ['the program generated is', 'define',
+                 '    global int g0;', '    global int g1;',
+                 '    global int ga[8];', '    global bool b0;',
+                 '    global bool b1;', '    int p0;', '    int p1;',
+                 '    int i;', '    int j;', '    int k;']
+
+        calls = []
+        for index in range(self._random.randint(0, 3)):
+            lines += self._function('f%d' % index, list(calls))
+            calls.append('f%d' % index)
+
+        lines += self._recursive_function()
+
+        lines += ['body', '    g0 = 1;', '    g1 = 2;', '    p0 = 3;',
+                  '    p1 = 4;', '    b0 = true;', '    b1 = false;',
+                  '    i = 0;', '    for (i = i + 1; i < 8)',
+                  '        ga[i] = i;', '    finish for;',
+                  '    ga[0] = 0;',
+                  '    rec(%d);' % self._random.randint(0, 20)]
+
+        lines += self._statements(['p0', 'p1', 'g0', 'g1'],
+                                  ['p0', 'p1', 'g0', 'g1'], calls, [], 3,
+                                  '    ')
+
+        lines += ['    putint(g0);', '    putint(g1);', '    putint(p0);',
+                  '    putint(p1);', '    putint(ga[1]);',
+                  'finish program']
+
+        return '\n'.join(lines) + '\n'
+
+
+def straight_line(size):
+    """Straight Line
+
+    Arguments:
+        size: The number of statements.
+
+    Returns:
+        The source of the program.
+    """
+    stores = ''.join('    y[%d] = x + %d;\n' % (index, index)
+                     for index in range(size))
+
+    return ('the program straight is\ndefine\n    int x;\n    int y[%d];\n'
+            'body\n    x = 1;\n%s    putint(y[0]);\nfinish program\n' %
+            (size, stores))
+
+
+def loop_body(size):
+    """Loop Body
+
+    Arguments:
+        size: The number of statements in the loop.
+
+    Returns:
+        The source of the program.
+    """
+    stores = ''.join('        y[%d] = x + %d;\n' % (index, index)
+                     for index in range(size))
+
+    return ('the program loopbody is\ndefine\n    int x;\n    int i;\n'
+            '    int y[%d];\nbody\n    x = 1;\n    i = 0;\n'
+            '    for (i = i + 1; i < 3)\n%s    finish for;\n'
+            '    putint(y[0]);\nfinish program\n' % (size, stores))
+
+
+def build_and_run(code, cc, directory):
+    """Build And Run
+
+    Arguments:
+        code: The generated C code.
+        cc: The C compiler command, as a list.
+        directory: The directory to build in.
+
+    Returns:
+        The output and exit status of the program, or None if it could
+        not be built.
+    """
+    target = os.path.join(directory, 'program')
+
+    build = subprocess.run(cc + ['-w', '-o', target, '-x', 'c', '-'],
+                           input=code, universal_newlines=True)
+    if build.returncode != 0:
+        return None
+
+    try:
+        run = subprocess.run([target], input=PROGRAM_INPUT,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             universal_newlines=True, timeout=RUN_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return 'timed out'
+
+    return '%s\nexit status %d' % (run.stdout, run.returncode)
+
+
+def check_program(name, source, cc, directory, short_circuit):
+    """Check Program
+
+    Arguments:
+        name: The name of the program.
+        source: The source of the program.
+        cc: The C compiler command, as a list.
+        directory: The directory to build in.
+        short_circuit: If True, both compiles use --short-circuit.
+
+    Returns:
+        True if the program behaves the same with and without -O, or does
+        not compile without -O.
+    """
+    plain = CompilerSession(short_circuit=short_circuit).compile(source)
+    if not plain.success:
+        print('skip %s: does not compile' % name)
+        return True
+
+    optimized = CompilerSession(optimize=True,
+                                short_circuit=short_circuit).compile(source)
+    if not optimized.success:
+        print('FAIL %s: does not compile with -O' % name)
+        return False
+
+    expected = build_and_run(plain.code, cc, directory)
+    actual = build_and_run(optimized.code, cc, directory)
+
+    if expected is None or actual is None:
+        print('FAIL %s: could not be built' % name)
+        return False
+
+    if expected != actual:
+        print('FAIL %s: output differs with -O' % name)
+        return False
+
+    return True
+
+
+def main():
+    """Main
+
+    Runs every optimizer test.
+
+    Returns:
+        True if all tests pass, False otherwise.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--programs',
+                        help='number of generated programs (default: 200)',
+                        type=int, default=200)
+    parser.add_argument('--seed',
+                        help='seed of the first generated program',
+                        type=int, default=0)
+    parser.add_argument('--cc',
+                        help='C compiler command (default: gcc -m32)',
+                        default='gcc -m32')
+    parser.add_argument('--short-circuit',
+                        help='compile the programs with --short-circuit',
+                        action='store_true')
+    args = parser.parse_args()
+
+    cc = shlex.split(args.cc)
+    sample_dir = os.path.dirname(os.path.abspath(__file__))
+
+    programs = []
+    for path in sorted(glob.glob(os.path.join(sample_dir, '*.src'))):
+        with open(path) as source_file:
+            programs.append((os.path.basename(path), source_file.read()))
+
+    for seed in range(args.seed, args.seed + args.programs):
+        programs.append(('seed %d' % seed, ProgramGenerator(seed).program()))
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = [check_program(name, source, cc, directory,
+                                 args.short_circuit)
+                   for name, source in programs]
+
+    print('%d of %d programs behave the same with -O' %
+          (results.count(True), len(results)))
+
+    tests = [
+        ('-O straight line', straight_line, 8000),
+        ('-O loop body', loop_body, 4000),
+        ('-O long call', long_call, 10000),
+    ]
+
+    results += [check_scaling(name, build, size, True)
+                for name, build, size in tests]
+
+    return all(results)
+
+
+if __name__ == '__main__':
+    sys.exit(not main())
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+
+"""Stress Test module
+
+Compiles generated programs with very long comment blocks, runs of invalid
+characters, argument lists and nested expressions. Each program must
+compile at a quarter of its size and at full size without a
+RecursionError, which a parser recursing once per line or argument
+raises. The ratio of the two compile times is printed but never fails a
+test, as it depends on the load of the machine. Time growing linearly
+with size gives a ratio of about 4 and quadratic time about 16.
+
+Run from the repository root:
+
+    python3 rdds_tests/stress_test.py [-O]
+
+Author: RDDS Team
+
+Functions:
+    comment_block: Builds a program with a long block of comment lines.
+    invalid_characters: Builds a program with a long run of invalid
+        characters.
+    long_call: Builds a program calling a function with many arguments.
+    nested_parentheses: Builds a program with deeply nested parentheses.
+    nested_indexes: Builds a program with deeply nested array indexes.
+    compile_time: Times the compile of a program.
+    check_scaling: Checks that a program compiles at two sizes.
+    main: Runs every stress test.
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lib.session import CompilerSession
+
+
+def comment_block(size):
+    """Comment Block
+
+    Arguments:
+        size: The number of comment lines.
+
+    Returns:
+        The source of the program.
+    """
+    comments = '// comment line\n' * size
+
+    return ('the program stress is\ndefine\n%sbody\n'
+            '    putint(1);\nfinish program\n' % comments)
+
+
+def invalid_characters(size):
+    """Invalid Characters
+
+    Arguments:
+        size: The number of invalid characters.
+
+    Returns:
+        The source of the program.
+    """
+    return ('the program stress is\ndefine\n%s\nbody\n'
+            '    putint(1);\nfinish program\n' % ('$' * size))
+
+
+def long_call(size):
+    """Long Call
+
+    Arguments:
+        size: The number of arguments of the call.
+
+    Returns:
+        The source of the program.
+    """
+    params = ', '.join('int p%d in' % index for index in range(size))
+    args = ', '.join(str(index) for index in range(size))
+
+    return ('the program stress is\ndefine\n    global int total;\n\n'
+            '    function f(%s) is\n    body\n        total = p0;\n'
+            '    finish function;\n\nbody\n    f(%s);\n    putint(total);\n'
+            'finish program\n' % (params, args))
+
+
+def nested_parentheses(size):
+    """Nested Parentheses
+
+    Arguments:
+        size: The depth of the parentheses.
+
+    Returns:
+        The source of the program.
+    """
+    return ('the program stress is\ndefine\n    int x;\nbody\n'
+            '    x = %s1%s;\n    putint(x);\nfinish program\n' %
+            ('(' * size, ')' * size))
+
+
+def nested_indexes(size):
+    """Nested Indexes
+
+    Arguments:
+        size: The depth of the array indexes.
+
+    Returns:
+        The source of the program.
+    """
+    return ('the program stress is\ndefine\n    int x;\n    int a[1];\n'
+            'body\n    a[0] = 0;\n    x = %s0%s;\n    putint(x);\n'
+            'finish program\n' % ('a[' * size, ']' * size))
+
+
+def compile_time(source, optimize):
+    """Compile Time
+
+    Arguments:
+        source: The source of the program.
+        optimize: If True, the program is compiled with -O.
+
+    Returns:
+        A (time, success) tuple holding the fastest of three compiles in
+        seconds and whether the program compiled.
+    """
+    session = CompilerSession(optimize=optimize)
+
+    best = None
+    for _ in range(3):
+        start = time.perf_counter()
+        result = session.compile(source)
+        elapsed = time.perf_counter() - start
+
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, result.success
+
+
+def check_scaling(name, build, size, optimize):
+    """Check Scaling
+
+    Arguments:
+        name: The name of the test.
+        build: The function building the program of a given size.
+        size: The full size of the program.
+        optimize: If True, the programs are compiled with -O.
+
+    Returns:
+        True if the program compiles at both sizes.
+    """
+    try:
+        small, small_ok = compile_time(build(size // 4), optimize)
+        large, large_ok = compile_time(build(size), optimize)
+    except RecursionError:
+        print('FAIL %s: RecursionError' % name)
+        return False
+
+    # The ratio is only reported, as timings are too noisy to fail on
+    ratio = large / max(small, 1e-6)
+    passed = small_ok and large_ok
+
+    print('%s %s: %.2fs at %d, %.2fs at %d (x%.1f)' % (
+        'ok' if passed else 'FAIL', name, small, size // 4, large, size,
+        ratio))
+
+    return passed
+
+
+def main():
+    """Main
+
+    Runs every stress test.
+
+    Returns:
+        True if all tests pass, False otherwise.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-O', '--optimize',
+                        help='compile the programs with -O',
+                        action='store_true')
+    args = parser.parse_args()
+
+    tests = [
+        ('comment block', comment_block, 100000),
+        ('invalid characters', invalid_characters, 100000),
+        ('long call', long_call, 10000),
+        ('nested parentheses', nested_parentheses, 10000),
+        ('nested indexes', nested_indexes, 10000),
+    ]
+
+    results = [check_scaling(name, build, size, args.optimize)
+               for name, build, size in tests]
+
+    return all(results)
+
+
+if __name__ == '__main__':
+    sys.exit(not main())